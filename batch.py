@@ -0,0 +1,185 @@
+import argparse
+import csv
+import json
+import math
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+from function import FunctionManager
+from lossfunction import loss_name
+from parallel import attach_block, share_block
+from regression import classify_points
+from search import PrunedSearch, minimise_loss_pruned
+from utils import classification_names, write_mapping_columns
+
+# State of a worker process, set once by _attach_library
+_worker_state = {}
+
+
+def read_manifest(path):
+    """
+    Reads the jobs of a batch. A .json manifest holds a list of objects, any other file is read as CSV with a header.
+    Every job needs the keys "train", "test" and "output", the output prefix of its files, e.g. "results/run1/".
+    :param path: local path of the manifest
+    :return: list of dictionaries, one per job
+    """
+    with open(path, newline="") as file:
+        jobs = json.load(file) if path.endswith(".json") else list(csv.DictReader(file))
+    for position, job in enumerate(jobs):
+        missing = [key for key in ["train", "test", "output"] if not job.get(key)]
+        if missing:
+            raise ValueError("Job {} of {} is missing {}".format(position, path, missing))
+    return jobs
+
+
+def _attach_library(description, columns, loss_function, parser):
+    # Runs once per worker process: the library is attached instead of being parsed or pickled per job,
+    # and the summary statistics of the pruned search are computed once for all jobs of the worker
+    segment, block = attach_block(description)
+    candidate_function_manager = FunctionManager.from_data(columns, block)
+    _worker_state.update(segment=segment, candidate_function_manager=candidate_function_manager, parser=parser,
+                         search=PrunedSearch(candidate_function_manager.y_values, loss_function))
+
+
+def _run_job(job, loss_function, accepted_factor):
+    # Runs one job in a worker. Every failure is turned into a result, so one broken job never stops the batch
+    timings = {}
+    result = {"job": job, "status": "failed", "timings": timings}
+    started = time.perf_counter()
+    try:
+        stage_started = time.perf_counter()
+        train_function_manager = FunctionManager(path_of_csv=job["train"], parser=_worker_state["parser"])
+        test_function = FunctionManager(path_of_csv=job["test"], parser=_worker_state["parser"]).functions[0]
+        timings["load"] = time.perf_counter() - stage_started
+
+        stage_started = time.perf_counter()
+        ideal_functions = minimise_loss_pruned(train_function_manager, _worker_state["candidate_function_manager"],
+                                               loss_function, search=_worker_state["search"])
+        for ideal_function in ideal_functions:
+            ideal_function.tolerance_factor = accepted_factor
+        timings["fit"] = time.perf_counter() - stage_started
+
+        stage_started = time.perf_counter()
+        assigned, deltas = classify_points(test_function.x, test_function.y, ideal_functions)
+        timings["classify"] = time.perf_counter() - stage_started
+
+        stage_started = time.perf_counter()
+        output_directory = os.path.dirname(job["output"])
+        if output_directory:
+            os.makedirs(output_directory, exist_ok=True)
+        write_mapping_columns(test_function.x, test_function.y, np.where(assigned < 0, -1, deltas),
+                              classification_names(ideal_functions, assigned), file_name=job["output"] + "mapping")
+        timings["persist"] = time.perf_counter() - stage_started
+
+        counts = np.bincount(assigned + 1, minlength=len(ideal_functions) + 1)
+        result.update(status="ok", points=len(assigned), unmatched=int(counts[0]),
+                      ideal_functions=[{"training": ideal_function.training_function.name,
+                                        "ideal": ideal_function.name, "error": float(ideal_function.error),
+                                        "matches": int(count)}
+                                       for ideal_function, count in zip(ideal_functions, counts[1:])])
+        with open(job["output"] + "report.json", "w") as file:
+            json.dump(result, file, indent=2)
+    except Exception as error:
+        result.update(error="{}: {}".format(type(error).__name__, error), traceback=traceback.format_exc())
+    result["seconds"] = time.perf_counter() - started
+    return result
+
+
+def summarise(results, wall_seconds):
+    """
+    Aggregates the results of a batch.
+    :param results: list of job results as returned by run_batch
+    :param wall_seconds: the wall time of the whole batch
+    :return: dictionary with the number of jobs per status, the timings and the failed jobs
+    """
+    succeeded = [result for result in results if result["status"] == "ok"]
+    job_seconds = [result["seconds"] for result in results if "seconds" in result]
+    stage_seconds = {}
+    for result in succeeded:
+        for stage, seconds in result["timings"].items():
+            stage_seconds[stage] = stage_seconds.get(stage, 0.0) + seconds
+    return {"jobs": len(results), "succeeded": len(succeeded), "failed": len(results) - len(succeeded),
+            "points": sum(result["points"] for result in succeeded), "wall_seconds": wall_seconds,
+            "job_seconds": sum(job_seconds), "slowest_job_seconds": max(job_seconds, default=0.0),
+            "jobs_per_second": len(results) / wall_seconds if wall_seconds else 0.0,
+            "stage_seconds": stage_seconds,
+            "failures": [{"job": result["job"], "error": result.get("error")}
+                         for result in results if result["status"] != "ok"]}
+
+
+def run_batch(ideal_path, jobs, workers=None, loss_function="squared_error", accepted_factor=math.sqrt(2),
+              use_cache=False, progress=None, parser="pandas"):
+    """
+    Runs many training/test jobs against one candidate library.
+    The library is parsed once and copied into shared memory, every worker process attaches to it on start.
+    A job fits the ideal functions, classifies its test data and writes <output>mapping.db and <output>report.json.
+    :param ideal_path: local path of the CSV with the candidate functions
+    :param jobs: list of dictionaries with "train", "test" and "output", see read_manifest
+    :param workers: number of worker processes, defaults to the number of CPUs
+    :param loss_function: a registered loss, either by name or as the pairwise loss function
+    :param accepted_factor: the tolerance factor of the ideal functions
+    :param use_cache: if True, the library is memory-mapped from its binary cache, see FunctionManager
+    :param progress: optional callable receiving every job result as soon as it finished
+    :param parser: "pandas" or "numpy", see read_csv_block. With "numpy", the workers never import Pandas
+    :return: a tuple of the job results, in the order of the jobs, and the summary
+    """
+    started = time.perf_counter()
+    candidate_function_manager = FunctionManager(path_of_csv=ideal_path, use_cache=use_cache, parser=parser)
+    # The block includes the x-values, so the workers get complete functions
+    segment, description = share_block(np.column_stack([candidate_function_manager.x_values,
+                                                        candidate_function_manager.y_values]))
+    columns = ["x"] + [function.name for function in candidate_function_manager]
+    name_of_loss = loss_name(loss_function)
+
+    results = [None] * len(jobs)
+    try:
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1, initializer=_attach_library,
+                                 initargs=(description, columns, name_of_loss, parser)) as executor:
+            futures = {executor.submit(_run_job, job, name_of_loss, accepted_factor): position
+                       for position, job in enumerate(jobs)}
+            for future in as_completed(futures):
+                position = futures[future]
+                try:
+                    results[position] = future.result()
+                except BrokenProcessPool as error:
+                    # A worker died, e.g. it ran out of memory. Its jobs fail, the others are still reported
+                    results[position] = {"job": jobs[position], "status": "failed", "timings": {},
+                                         "error": "BrokenProcessPool: {}".format(error)}
+                if progress is not None:
+                    progress(results[position])
+    finally:
+        segment.close()
+        segment.unlink()
+
+    return results, summarise(results, time.perf_counter() - started)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Runs many training/test jobs against one candidate library")
+    parser.add_argument("manifest", help="a .json or .csv file listing the jobs with train, test and output")
+    parser.add_argument("--ideal", default="data/ideal.csv", help="path of the CSV with the candidate functions")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes")
+    parser.add_argument("--csv-cache", action="store_true", help="memory-map the library from its binary cache")
+    parser.add_argument("--parser", choices=["pandas", "numpy"], default="pandas",
+                        help="parse the CSVs with Pandas or with NumPy, which avoids importing Pandas")
+    parser.add_argument("--summary", default=None, help="write the summary and all job results as JSON to this path")
+    arguments = parser.parse_args()
+
+    def print_result(result):
+        if result["status"] == "ok":
+            print("ok     {:>8.3f}s {}".format(result["seconds"], result["job"]["output"]))
+        else:
+            print("FAILED {} {}".format(result["job"]["output"], result["error"]))
+
+    job_results, summary = run_batch(arguments.ideal, read_manifest(arguments.manifest), workers=arguments.workers,
+                                     use_cache=arguments.csv_cache, progress=print_result, parser=arguments.parser)
+    print("{succeeded} of {jobs} jobs succeeded in {wall_seconds:.3f}s ({jobs_per_second:.1f} jobs/s), "
+          "{failed} failed".format(**summary))
+    if arguments.summary:
+        with open(arguments.summary, "w") as file:
+            json.dump({"summary": summary, "results": job_results}, file, indent=2)
@@ -0,0 +1,367 @@
+import argparse
+import itertools
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from csvcache import remove_csv_cache
+from function import FunctionManager
+from lossfunction import squared_error
+from pipeline import assignment_pipeline
+from plotting import plot_classification_overview, plot_ideal_functions
+from regression import classify_points, find_classification, minimise_loss, minimise_loss_batch
+from utils import classification_names, write_deviation_results_to_sqlite, write_mapping_columns
+
+# A stage counts as regression if it is this much slower than the baseline
+DEFAULT_THRESHOLD = 0.2
+
+# The dependencies that dominate the start of a run, the startup benchmark reports which of them an entry mode imports
+HEAVY_MODULES = ("pandas", "sqlalchemy", "bokeh")
+
+# The entry modes of the startup benchmark, each one runs in a fresh interpreter from the directory of this file.
+# "fit_classify" fits and classifies the given CSVs with the NumPy parser, "eager" imports all heavy
+# dependencies, which every entry mode paid before they were imported per stage
+STARTUP_MODES = {
+    "interpreter": "pass",
+    "core": "import function, regression",
+    "fit_classify": "\n".join([
+        "from function import FunctionManager",
+        "from regression import classify_points, minimise_loss_batch",
+        "ideal_functions = minimise_loss_batch(FunctionManager({train!r}, parser='numpy'),",
+        "                                      FunctionManager({ideal!r}, parser='numpy'), 'squared_error')",
+        "test_function = FunctionManager({test!r}, parser='numpy').functions[0]",
+        "classify_points(test_function.x, test_function.y, ideal_functions)"]),
+    "main": "import main",
+    "service": "import service",
+    "batch": "import batch",
+    "whatif": "import whatif",
+    "plotting": "import plotting",
+    "eager": "import pandas, sqlalchemy, bokeh.plotting",
+}
+
+
+def generate_dataset(directory, rows=400, candidates=50, training_columns=4, test_points=100, seed=0):
+    """
+    Writes a synthetic train.csv, ideal.csv and test.csv with the structure of the assignment's data.
+    The candidates are random mixtures of sine, cosine and polynomial terms on a shared x grid. Every training function
+    is a noisy copy of one candidate and the test points are noisy samples of the training candidates, mixed with
+    points that do not belong to any of them.
+    :param directory: the directory the CSV files are written to
+    :param rows: number of x-values
+    :param candidates: number of candidate functions in ideal.csv
+    :param training_columns: number of training functions in train.csv
+    :param test_points: number of points in test.csv
+    :param seed: seed of the random generator, the same parameters and seed always give the same files
+    :return: dictionary with the paths of "train", "ideal" and "test"
+    """
+    rng = np.random.default_rng(seed)
+    # Rounding keeps the x-values on an exact decimal grid, like in the assignment's data
+    x_values = np.round(-20 + 40 * np.arange(rows) / rows, 6)
+
+    coefficients = rng.normal(size=(4, candidates))
+    frequencies = rng.uniform(0.1, 2, size=candidates)
+    ideal = (coefficients[0] * np.sin(frequencies * x_values[:, None]) +
+             coefficients[1] * np.cos(frequencies * x_values[:, None]) +
+             coefficients[2] * x_values[:, None] + coefficients[3] * 0.05 * x_values[:, None] ** 2)
+
+    chosen = rng.choice(candidates, size=training_columns, replace=candidates < training_columns)
+    train = ideal[:, chosen] + rng.normal(scale=0.3, size=(rows, training_columns))
+
+    test_rows = rng.integers(rows, size=test_points)
+    test_columns = chosen[rng.integers(training_columns, size=test_points)]
+    test_y = ideal[test_rows, test_columns] + rng.normal(scale=0.3, size=test_points)
+    outliers = rng.random(test_points) < 0.3
+    test_y[outliers] += rng.normal(scale=20, size=int(outliers.sum()))
+
+    paths = {name: os.path.join(directory, "{}.csv".format(name)) for name in ["train", "ideal", "test"]}
+    _write_csv(paths["ideal"], x_values, ideal)
+    _write_csv(paths["train"], x_values, train)
+    pd.DataFrame({"x": x_values[test_rows], "y": test_y}).to_csv(paths["test"], index=False)
+    return paths
+
+
+def _write_csv(path, x_values, block):
+    columns = {"x": x_values}
+    columns.update(("y{}".format(column + 1), block[:, column]) for column in range(block.shape[1]))
+    pd.DataFrame(columns).to_csv(path, index=False)
+
+
+def measure(function, repeat=1, memory=False):
+    """
+    Measures a stage. The wall time is the best of repeat runs without tracing,
+    the peak memory is taken from one additional run with tracemalloc, as tracing slows down Python code.
+    :param function: the stage as callable without arguments
+    :param repeat: the number of timed runs
+    :param memory: if True, the peak memory is measured as well
+    :return: a tuple of the measurement as dictionary and the result of the last run
+    """
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - started)
+    measurement = {"seconds": min(timings)}
+
+    if memory:
+        tracemalloc.start()
+        try:
+            result = function()
+            measurement["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return measurement, result
+
+
+def _import_times(stderr):
+    # Parses the output of python -X importtime: the modules that were imported and the total import time.
+    # Top-level imports are not indented, their cumulative times add up to the time spent importing
+    modules = set()
+    microseconds = 0
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        modules.add(name.strip().split(".")[0])
+        if not name.startswith("  "):
+            microseconds += int(cumulative)
+    return modules, microseconds / 1e6
+
+
+def measure_startup(paths, modes=None, repeat=3):
+    """
+    Measures the cold start of the entry modes, every run in a fresh interpreter.
+    The wall time is the best of repeat runs of the whole process. One additional run with python -X importtime
+    gives the time spent importing and the heavy dependencies that were imported.
+    :param paths: dictionary with the paths of "train", "ideal" and "test", used by the "fit_classify" mode
+    :param modes: names of the entry modes, see STARTUP_MODES, defaults to all of them
+    :param repeat: the number of timed runs per mode
+    :return: dictionary mapping the name of each mode to its measurement
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    for name in modes or STARTUP_MODES:
+        code = STARTUP_MODES[name].format(**{key: os.path.abspath(path) for key, path in paths.items()})
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            subprocess.run([sys.executable, "-c", code], cwd=directory, check=True)
+            timings.append(time.perf_counter() - started)
+        traced = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=directory, check=True,
+                                capture_output=True, text=True)
+        modules, import_seconds = _import_times(traced.stderr)
+        results[name] = {"seconds": min(timings), "import_seconds": import_seconds,
+                         "heavy_modules": [module for module in HEAVY_MODULES if module in modules]}
+    return results
+
+
+def run_benchmark(paths, output_directory, repeat=1, memory=False, reference=False, accepted_factor=math.sqrt(2)):
+    """
+    Runs every stage of main.py on the given dataset and measures each of them separately.
+    :param paths: dictionary with the paths of "train", "ideal" and "test", as returned by generate_dataset
+    :param output_directory: the directory the databases and plots are written to
+    :param repeat: the number of timed runs per stage
+    :param memory: if True, the peak memory of each stage is measured as well
+    :param reference: if True, the per-item functions (minimise_loss, find_classification,
+                      write_deviation_results_to_sqlite) are measured as well, to compare against the batch paths
+    :param accepted_factor: the tolerance factor of the ideal functions
+    :return: dictionary mapping the name of each stage to its measurement
+    """
+    stages = {}
+
+    def run(name, function):
+        stages[name], result = measure(function, repeat=repeat, memory=memory)
+        return result
+
+    candidate_function_manager = run("load_ideal", lambda: FunctionManager(paths["ideal"]))
+    train_function_manager = run("load_train", lambda: FunctionManager(paths["train"]))
+    test_function = run("load_test", lambda: FunctionManager(paths["test"])).functions[0]
+
+    # The binary CSV cache: the cold load parses the CSV and writes the sidecar, the warm load memory-maps it
+    def load_ideal_cache_cold():
+        remove_csv_cache(paths["ideal"])
+        return FunctionManager(paths["ideal"], use_cache=True)
+
+    run("load_ideal_cache_cold", load_ideal_cache_cold)
+    run("load_ideal_cache_warm", lambda: FunctionManager(paths["ideal"], use_cache=True))
+
+    run("to_sql_training", lambda: train_function_manager.to_sql(os.path.join(output_directory, "training"),
+                                                                 " (training func)"))
+    run("to_sql_ideal", lambda: candidate_function_manager.to_sql(os.path.join(output_directory, "ideal"),
+                                                                  " (ideal func)"))
+
+    ideal_functions = run("minimise_loss_batch", lambda: minimise_loss_batch(train_function_manager,
+                                                                            candidate_function_manager, squared_error))
+    for ideal_function in ideal_functions:
+        ideal_function.tolerance_factor = accepted_factor
+
+    assigned, deltas = run("classify_points", lambda: classify_points(test_function.x, test_function.y,
+                                                                      ideal_functions))
+    names = classification_names(ideal_functions, assigned)
+    run("write_mapping", lambda: write_mapping_columns(test_function.x, test_function.y,
+                                                       np.where(assigned < 0, -1, deltas), names,
+                                                       file_name=os.path.join(output_directory, "mapping")))
+
+    run("plot_ideal_functions", lambda: plot_ideal_functions(ideal_functions,
+                                                             os.path.join(output_directory, "train_and_ideal"),
+                                                             show_plot=False))
+    run("plot_classification_overview", lambda: plot_classification_overview(
+        ideal_functions, test_function.x, test_function.y, assigned,
+        os.path.join(output_directory, "point_and_ideal"), show_plot=False))
+
+    if reference:
+        run("minimise_loss", lambda: [minimise_loss(train_function, candidate_function_manager.functions,
+                                                    squared_error) for train_function in train_function_manager])
+        results = run("find_classification", lambda: [
+            dict(zip(("classification", "delta_y"), find_classification(point, ideal_functions)), point=point)
+            for point in test_function])
+        # write_deviation_results_to_sqlite always writes output/mapping.db, so it runs from the output directory
+        working_directory = os.getcwd()
+        os.makedirs(os.path.join(output_directory, "output"), exist_ok=True)
+        os.chdir(output_directory)
+        try:
+            run("write_deviation_results_to_sqlite", lambda: write_deviation_results_to_sqlite(results))
+        finally:
+            os.chdir(working_directory)
+
+    return stages
+
+
+def measure_pipeline(paths, output_directory, workers, repeat=1, accepted_factor=math.sqrt(2)):
+    """
+    Measures the end-to-end wall time of the pipeline of main.py, once with a serial schedule and once with the
+    stages spread over a thread pool. Every run is forced, so no stage is skipped or loaded from the cache.
+    :param paths: dictionary with the paths of "train", "ideal" and "test", as returned by generate_dataset
+    :param output_directory: the directory the databases, plots and the cache of the pipeline are written to
+    :param workers: the number of threads of the concurrent schedule, see Pipeline.run
+    :param repeat: the number of timed runs per schedule
+    :param accepted_factor: the tolerance factor of the ideal functions
+    :return: dictionary with the measurements "pipeline_serial" and "pipeline_workers"
+    """
+    def run_pipeline(stage_workers):
+        pipeline = assignment_pipeline(paths["train"], paths["ideal"], paths["test"], accepted_factor,
+                                       output_directory=output_directory, show_plot=False, force=True)
+        return pipeline.run(workers=stage_workers)
+
+    serial, _ = measure(lambda: run_pipeline(None), repeat=repeat)
+    concurrent, _ = measure(lambda: run_pipeline(workers), repeat=repeat)
+    concurrent["workers"] = workers
+    return {"pipeline_serial": serial, "pipeline_workers": concurrent}
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    Compares benchmark results against a stored baseline.
+    Runs are matched by their parameters, stages by their name.
+    :param results: the results of the current benchmark, as written by main
+    :param baseline: the results of an earlier benchmark
+    :param threshold: the relative slowdown that counts as regression, 0.2 means 20 % slower
+    :return: list of dictionaries describing every regression
+    """
+    baseline_runs = {json.dumps(run["parameters"], sort_keys=True): run for run in baseline["runs"]}
+    regressions = []
+    for run in results["runs"]:
+        baseline_run = baseline_runs.get(json.dumps(run["parameters"], sort_keys=True))
+        if baseline_run is None:
+            continue
+        for name, measurement in run["stages"].items():
+            if name not in baseline_run["stages"]:
+                continue
+            for metric in ["seconds", "peak_bytes"]:
+                current = measurement.get(metric)
+                previous = baseline_run["stages"][name].get(metric)
+                if current is None or not previous:
+                    continue
+                ratio = current / previous
+                if ratio > 1 + threshold:
+                    regressions.append({"parameters": run["parameters"], "stage": name, "metric": metric,
+                                        "baseline": previous, "current": current, "ratio": ratio})
+    return regressions
+
+
+def _environment():
+    return {"python": platform.python_version(), "numpy": np.__version__, "pandas": pd.__version__,
+            "platform": platform.platform()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks every stage of main.py on synthetic datasets")
+    parser.add_argument("--rows", type=int, nargs="+", default=[400], help="number of x-values")
+    parser.add_argument("--candidates", type=int, nargs="+", default=[50], help="number of candidate functions")
+    parser.add_argument("--training-columns", type=int, nargs="+", default=[4], help="number of training functions")
+    parser.add_argument("--test-points", type=int, nargs="+", default=[100], help="number of test points")
+    parser.add_argument("--repeat", type=int, default=1, help="timed runs per stage, the best one counts")
+    parser.add_argument("--memory", action="store_true", help="also measure the peak memory of every stage")
+    parser.add_argument("--reference", action="store_true",
+                        help="also measure the per-item functions the batch paths replaced")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic datasets")
+    parser.add_argument("--output", default="benchmark.json", help="file the results are written to")
+    parser.add_argument("--startup", action="store_true",
+                        help="only measure the cold start of every entry mode on the data of the assignment")
+    parser.add_argument("--stage-workers", type=int, default=None, metavar="WORKERS",
+                        help="also measure the wall time of the whole pipeline, serial and on this many threads")
+    parser.add_argument("--compare", default=None, help="baseline results to compare against")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="relative slowdown that counts as regression")
+    arguments = parser.parse_args(argv)
+
+    results = {"environment": _environment(), "runs": []}
+    if arguments.startup:
+        data_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+        paths = {name: os.path.join(data_directory, "{}.csv".format(name)) for name in ["train", "ideal", "test"]}
+        results["startup"] = measure_startup(paths, repeat=arguments.repeat)
+        for name, measurement in results["startup"].items():
+            print("  {:<15} {:>8.4f}s, imports {:>8.4f}s {}".format(
+                name, measurement["seconds"], measurement["import_seconds"],
+                ", ".join(measurement["heavy_modules"]) or "-"))
+    else:
+        # Every combination of the parameters is one run, which gives the scaling curves
+        for rows, candidates, training_columns, test_points in itertools.product(
+                arguments.rows, arguments.candidates, arguments.training_columns, arguments.test_points):
+            parameters = {"rows": rows, "candidates": candidates, "training_columns": training_columns,
+                          "test_points": test_points, "seed": arguments.seed}
+            with tempfile.TemporaryDirectory() as directory:
+                paths = generate_dataset(directory, rows, candidates, training_columns, test_points, arguments.seed)
+                stages = run_benchmark(paths, directory, repeat=arguments.repeat, memory=arguments.memory,
+                                       reference=arguments.reference)
+                if arguments.stage_workers:
+                    stages.update(measure_pipeline(paths, directory, arguments.stage_workers,
+                                                   repeat=arguments.repeat))
+            results["runs"].append({"parameters": parameters, "stages": stages})
+            print(json.dumps(parameters))
+            for name, measurement in stages.items():
+                print("  {:<35} {:>10.4f}s".format(name, measurement["seconds"]))
+            if arguments.stage_workers:
+                speed_up = stages["pipeline_serial"]["seconds"] / stages["pipeline_workers"]["seconds"]
+                print("  speed-up of {} stage workers over the serial schedule: {:.2f}x".format(
+                    arguments.stage_workers, speed_up))
+
+    with open(arguments.output, "w") as file:
+        json.dump(results, file, indent=2)
+    print("Results written to {}".format(arguments.output))
+
+    if arguments.compare:
+        with open(arguments.compare) as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline, arguments.threshold)
+        for regression in regressions:
+            print("REGRESSION {stage} ({metric}): {baseline:.4g} -> {current:.4g} ({ratio:.2f}x) for {parameters}"
+                  .format(**regression))
+        if regressions:
+            return 1
+        print("No regressions against {}".format(arguments.compare))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
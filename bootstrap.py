@@ -0,0 +1,192 @@
+import argparse
+import json
+import time
+
+import numpy as np
+
+from function import FunctionManager
+from instrumentation import instrumented
+from lossfunction import get_accumulator, get_loss, loss_name
+from regression import BLOCK_ELEMENTS, compute_error_matrix
+
+# Number of bootstrap resamples of the training rows
+DEFAULT_RESAMPLES = 1000
+# Number of candidates reported per training function
+DEFAULT_TOP = 3
+# The quantiles of the bootstrap error distribution that are reported, in percent
+PERCENTILES = (2.5, 50, 97.5)
+
+
+def bootstrap_weights(number_of_rows, resamples=DEFAULT_RESAMPLES, seed=0):
+    """
+    Draws the bootstrap resamples of the training rows as weights: how often every row was drawn in every resample.
+    Weighting the per-row losses is the same as summing the loss over the drawn rows, without copying any rows.
+    :param number_of_rows: the number of training rows
+    :param resamples: the number of resamples
+    :param seed: seed of the random generator, the same seed always gives the same resamples
+    :return: array of shape (resamples, number of rows), every row sums up to the number of rows
+    """
+    rng = np.random.default_rng(seed)
+    return rng.multinomial(number_of_rows, np.full(number_of_rows, 1 / number_of_rows),
+                           size=resamples).astype(float)
+
+
+def resampled_error_matrix(training_block, candidate_block, weights, loss_function):
+    """
+    Computes the loss between every training and candidate function for every resample at once.
+    The per-row losses are computed once, every resample is then a weighted sum of them, so all resamples of a
+    set of candidates take one matrix product instead of resamples x candidates loss calls.
+    :param training_block: array of shape (n, k) with the y-values of the training functions
+    :param candidate_block: array of shape (n, m) with the y-values of the candidate functions
+    :param weights: array of shape (resamples, n), see bootstrap_weights
+    :param loss_function: a registered loss that is a sum over the rows, either by name or as the pairwise loss function
+    :return: array of shape (resamples, k, m)
+    """
+    reducer = get_loss(loss_function)
+    number_of_rows, number_of_training = training_block.shape
+    deviations = candidate_block[:, None, :] - training_block[:, :, None]
+    # A batched reducer sums along the first axis, over an axis of length one it returns the loss of every row
+    losses = reducer(deviations[np.newaxis]).reshape(number_of_rows, -1)
+    return (weights @ losses).reshape(len(weights), number_of_training, -1)
+
+
+class SelectionStability:
+
+    def __init__(self, loss, resamples, seed, training_functions):
+        """
+        Describes how robust the selection of the ideal functions is against resampling the training rows.
+        :param loss: the name of the loss the candidates were compared with
+        :param resamples: the number of bootstrap resamples
+        :param seed: the seed the resamples were drawn with
+        :param training_functions: one dictionary per training function with its name, the selected candidate,
+                                   the share of resamples it won and the statistics of the top candidates
+        """
+        self.loss = loss
+        self.resamples = resamples
+        self.seed = seed
+        self.training_functions = training_functions
+
+    def to_dict(self):
+        """
+        Converts the report into a dictionary that can be written as JSON.
+        :return: dictionary with the loss, the resamples, the seed and the training functions
+        """
+        return {"loss": self.loss, "resamples": self.resamples, "seed": self.seed,
+                "training_functions": self.training_functions}
+
+    @classmethod
+    def from_dict(cls, report):
+        """
+        Restores a report converted with to_dict.
+        :param report: the dictionary
+        :return: a SelectionStability
+        """
+        return cls(report["loss"], report["resamples"], report["seed"], report["training_functions"])
+
+    def __repr__(self):
+        lines = ["Selection stability over {} bootstrap resamples ({})".format(self.resamples, self.loss)]
+        for training_function in self.training_functions:
+            lines.append("  {training} -> {selected}: selected in {stability:.1%} of the resamples".format(
+                **training_function))
+            for candidate in training_function["candidates"]:
+                lines.append("    {:<8} wins {:>6.1%}  error {:>12.4f}  resampled {:>12.4f} +- {:<10.4f} [{}]".format(
+                    candidate["name"], candidate["win_frequency"], candidate["error"], candidate["mean"],
+                    candidate["std"], ", ".join("{:.4f}".format(value) for value in candidate["percentiles"])))
+        return "\n".join(lines)
+
+
+@instrumented("bootstrap_selection",
+              rows=lambda result, training_function_manager, *args, **kwargs: len(training_function_manager.x_values))
+def bootstrap_selection(training_function_manager, candidate_function_manager, loss_function="squared_error",
+                        resamples=DEFAULT_RESAMPLES, top=DEFAULT_TOP, seed=0):
+    """
+    Resamples the training rows and counts how often every candidate would have been selected.
+    The candidates are processed in slices, so the memory stays bounded for thousands of candidates.
+    Only losses that are a sum over the rows can be resampled this way, e.g. not max_absolute_error.
+    :param training_function_manager: FunctionManager holding the training functions
+    :param candidate_function_manager: FunctionManager holding the candidate functions
+    :param loss_function: a registered loss, either by name or as the pairwise loss function
+    :param resamples: the number of bootstrap resamples
+    :param top: the number of candidates reported per training function, the ones winning most often
+    :param seed: seed of the random generator
+    :return: a SelectionStability
+    """
+    name_of_loss = loss_name(loss_function)
+    if get_accumulator(name_of_loss) is not np.add:
+        raise ValueError("Loss {} is not a sum over the rows and cannot be resampled".format(name_of_loss))
+    if not np.array_equal(training_function_manager.x_values, candidate_function_manager.x_values):
+        raise ValueError("Training and candidate functions must share the same x-values")
+    if top < 1:
+        raise ValueError("top must be at least 1")
+
+    training_block = training_function_manager.y_values
+    candidate_block = candidate_function_manager.y_values
+    number_of_rows, number_of_training = training_block.shape
+    number_of_candidates = candidate_block.shape[1]
+    weights = bootstrap_weights(number_of_rows, resamples, seed)
+
+    # The winner of every resample is tracked over the slices, the strict comparison keeps the first candidate
+    # on ties, just like argmin in minimise_loss_batch
+    best_errors = np.full((resamples, number_of_training), np.inf)
+    best_candidates = np.zeros((resamples, number_of_training), dtype=int)
+    slice_width = max(1, BLOCK_ELEMENTS // max(1, max(resamples, number_of_rows) * number_of_training))
+    for start in range(0, number_of_candidates, slice_width):
+        end = min(start + slice_width, number_of_candidates)
+        errors = resampled_error_matrix(training_block, candidate_block[:, start:end], weights, name_of_loss)
+        slice_best = errors.argmin(axis=2)
+        slice_errors = np.take_along_axis(errors, slice_best[:, :, None], axis=2)[:, :, 0]
+        better = slice_errors < best_errors
+        best_errors[better] = slice_errors[better]
+        best_candidates[better] = start + slice_best[better]
+
+    # The selection on all rows, as made by minimise_loss_batch
+    full_errors = compute_error_matrix(training_block, candidate_block, name_of_loss)
+    selected = full_errors.argmin(axis=1)
+
+    training_functions = []
+    for row, training_function in enumerate(training_function_manager.functions):
+        wins = np.bincount(best_candidates[:, row], minlength=number_of_candidates)
+        # The most frequent winners first, ties are ordered by the error on all rows
+        order = np.lexsort((full_errors[row], -wins))[:top]
+        if selected[row] not in order:
+            order[-1] = selected[row]
+        # Only the distributions of the reported candidates are needed, they are computed again instead of
+        # keeping all resampled errors of all candidates
+        distributions = resampled_error_matrix(training_block[:, [row]], candidate_block[:, order], weights,
+                                               name_of_loss)[:, 0, :]
+        candidates = []
+        for position, column in enumerate(order):
+            distribution = distributions[:, position]
+            candidates.append({"name": candidate_function_manager.functions[column].name,
+                               "win_frequency": float(wins[column] / resamples),
+                               "error": float(full_errors[row, column]),
+                               "mean": float(distribution.mean()), "std": float(distribution.std()),
+                               "percentiles": np.percentile(distribution, PERCENTILES).tolist()})
+        training_functions.append({"training": training_function.name,
+                                   "selected": candidate_function_manager.functions[selected[row]].name,
+                                   "stability": float(wins[selected[row]] / resamples),
+                                   "candidates": candidates})
+    return SelectionStability(name_of_loss, resamples, seed, training_functions)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Reports how robust the selection of the ideal functions is "
+                                                 "against resampling the training rows")
+    parser.add_argument("--train", default="data/train.csv", help="path of the training CSV")
+    parser.add_argument("--ideal", default="data/ideal.csv", help="path of the CSV with the candidate functions")
+    parser.add_argument("--loss", default="squared_error", help="a registered loss that is a sum over the rows")
+    parser.add_argument("--resamples", type=int, default=DEFAULT_RESAMPLES, help="number of bootstrap resamples")
+    parser.add_argument("--top", type=int, default=DEFAULT_TOP, help="candidates reported per training function")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the resamples")
+    parser.add_argument("--output", default=None, help="write the report as JSON to this path")
+    arguments = parser.parse_args()
+
+    started = time.perf_counter()
+    stability = bootstrap_selection(FunctionManager(arguments.train), FunctionManager(arguments.ideal),
+                                    arguments.loss, resamples=arguments.resamples, top=arguments.top,
+                                    seed=arguments.seed)
+    print(stability)
+    print("Computed in {:.3f}s".format(time.perf_counter() - started))
+    if arguments.output:
+        with open(arguments.output, "w") as file:
+            json.dump(stability.to_dict(), file, indent=2)
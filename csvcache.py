@@ -0,0 +1,108 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+# The sidecar files are stored next to the CSV file
+DATA_SUFFIX = ".cache.npy"
+HEADER_SUFFIX = ".cache.json"
+
+# Files are hashed in blocks of this size to keep memory low
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def hash_file(path):
+    """
+    Hashes the raw bytes of a file, read block by block.
+    :param path: local path of the file
+    :return: the hexadecimal SHA-256 digest
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _cache_paths(path_of_csv):
+    return path_of_csv + DATA_SUFFIX, path_of_csv + HEADER_SUFFIX
+
+
+def load_cached_csv(path_of_csv, parser="pandas"):
+    """
+    Loads the binary cache of a CSV file, if there is a valid one.
+    The cache is valid if it was parsed with the same parser and size and modification time of the CSV are unchanged.
+    If only the modification time differs, the content hash decides and the header is refreshed, so touching a file
+    does not force a re-parse.
+    :param path_of_csv: local path of the CSV file
+    :param parser: the parser the caller would use, see function.read_csv_block
+    :return: a tuple of the column names and the memory-mapped data block, or None if there is no valid cache
+    """
+    data_path, header_path = _cache_paths(path_of_csv)
+    try:
+        with open(header_path) as file:
+            header = json.load(file)
+        status = os.stat(path_of_csv)
+    except (OSError, ValueError):
+        return None
+
+    # The parsers can differ in the last bit of a value, so a block parsed by the other one is not used
+    if header.get("parser") != parser:
+        return None
+    if status.st_size != header.get("size"):
+        return None
+    if status.st_mtime_ns != header.get("mtime_ns"):
+        if hash_file(path_of_csv) != header.get("sha256"):
+            return None
+        header["mtime_ns"] = status.st_mtime_ns
+        _write_header(header_path, header)
+
+    try:
+        data = np.load(data_path, mmap_mode="r")
+    except (OSError, ValueError):
+        return None
+    if list(data.shape) != header.get("shape"):
+        return None
+    return header["columns"], data
+
+
+def write_csv_cache(path_of_csv, columns, data, parser="pandas"):
+    """
+    Writes the parsed data of a CSV file to a binary sidecar cache.
+    The data is stored column-major as .npy, the column names, the parser and the key of the source file go into a
+    JSON header.
+    :param path_of_csv: local path of the CSV file the data was parsed from
+    :param columns: list of column names
+    :param data: 2-D float array with one column per CSV column
+    :param parser: the parser the data was parsed with, see function.read_csv_block
+    """
+    data_path, header_path = _cache_paths(path_of_csv)
+    status = os.stat(path_of_csv)
+    header = {"columns": list(columns), "shape": list(data.shape), "size": status.st_size,
+              "mtime_ns": status.st_mtime_ns, "sha256": hash_file(path_of_csv), "parser": parser}
+
+    # The files are written under a temporary name and moved in place, so a crash never leaves a half-written cache.
+    # The header goes last: without it, the data file is never used
+    temporary_path = data_path + ".tmp"
+    with open(temporary_path, "wb") as file:
+        np.save(file, np.asfortranarray(data))
+    os.replace(temporary_path, data_path)
+    _write_header(header_path, header)
+
+
+def remove_csv_cache(path_of_csv):
+    """
+    Deletes the binary cache of a CSV file, so the next cached load parses the CSV again.
+    :param path_of_csv: local path of the CSV file
+    """
+    for path in _cache_paths(path_of_csv):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _write_header(header_path, header):
+    temporary_path = header_path + ".tmp"
+    with open(temporary_path, "w") as file:
+        json.dump(header, file)
+    os.replace(temporary_path, header_path)
@@ -0,0 +1,201 @@
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+from instrumentation import instrumented
+
+# PRAGMAs that trade durability during the load for speed. A crash while loading can corrupt the database,
+# which is acceptable for output files that are simply written again on the next run
+FAST_LOAD_PRAGMAS = {
+    "journal_mode": "MEMORY",
+    "synchronous": "OFF",
+    "cache_size": -65536,
+    "temp_store": "MEMORY",
+}
+
+# Number of rows handed to a single executemany call
+DEFAULT_CHUNK_SIZE = 50000
+
+
+def quote_identifier(name):
+    """
+    Quotes a table or column name for SQLite, the names required by the assignment contain spaces and parentheses.
+    :param name: the plain name
+    :return: the quoted name
+    """
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def _sql_type(values):
+    kind = np.asarray(values).dtype.kind
+    if kind == "f":
+        return "FLOAT"
+    if kind in "iub":
+        return "INTEGER"
+    return "TEXT"
+
+
+class BulkWriter:
+
+    def __init__(self, file_name, fast_load=False, pragmas=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Writes column data into a local SQLite database in bulk.
+        Rows are inserted with chunked executemany calls inside one explicit transaction per load and indexes are only
+        built once the data is in place. After writing, the counters tell how many rows were written and how fast.
+        :param file_name: the name of the database, without the .db extension
+        :param fast_load: if True, the FAST_LOAD_PRAGMAS are applied to every connection
+        :param pragmas: optional dictionary of additional PRAGMAs, they take precedence over the fast-load ones
+        :param chunk_size: the number of rows per executemany call
+        """
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be at least 1")
+        self.chunk_size = chunk_size
+        # SQLAlchemy is imported by the first writer, modules that only may write a database stay cheap to import
+        from sqlalchemy import create_engine, event
+
+        self.engine = create_engine('sqlite:///{}.db'.format(file_name), echo=False)
+
+        self.pragmas = dict(FAST_LOAD_PRAGMAS) if fast_load else {}
+        self.pragmas.update(pragmas or {})
+        # pysqlite only begins a transaction before INSERT, UPDATE and DELETE, so a CREATE or DROP at the start of a
+        # transaction would be committed right away. Its own handling is switched off and every SQLAlchemy
+        # transaction sends an explicit BEGIN instead, as recommended by the SQLAlchemy documentation for pysqlite
+        event.listen(self.engine, "connect", self._on_connect)
+        event.listen(self.engine, "begin", self._on_begin)
+
+        self.rows_written = 0
+        self.seconds_writing = 0.0
+        # The connection of the transaction opened by transaction(), None outside of it
+        self._connection = None
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+        # The PRAGMAs run outside of any transaction, journal_mode cannot be changed within one
+        cursor = dbapi_connection.cursor()
+        for name, value in self.pragmas.items():
+            cursor.execute("PRAGMA {} = {}".format(name, value))
+        cursor.close()
+
+    @staticmethod
+    def _on_begin(connection):
+        connection.exec_driver_sql("BEGIN")
+
+    @contextmanager
+    def transaction(self):
+        """
+        Runs all writes of the block in one transaction: either all of them are committed or none of them.
+        This includes creating and dropping tables, views and indexes.
+        :return: context manager yielding the SQLAlchemy connection of the transaction
+        """
+        with self.engine.begin() as connection:
+            self._connection = connection
+            try:
+                yield connection
+            finally:
+                self._connection = None
+
+    @contextmanager
+    def begin(self):
+        """
+        Yields the connection of the running transaction, or begins a transaction of its own outside of one.
+        :return: context manager yielding an SQLAlchemy connection
+        """
+        if self._connection is not None:
+            yield self._connection
+        else:
+            with self.engine.begin() as connection:
+                yield connection
+
+    @property
+    def rows_per_second(self):
+        """
+        The throughput of all loads done by this writer so far.
+        :return: number of written rows per second
+        """
+        if self.seconds_writing == 0:
+            return 0.0
+        return self.rows_written / self.seconds_writing
+
+    def create_table(self, table_name, columns, replace=True, column_types=None):
+        """
+        Creates a table with one column per entry of columns. The SQL types are derived from the data.
+        :param table_name: the name of the table
+        :param columns: dictionary mapping column names to arrays, only used to derive the types
+        :param replace: if True, an existing table with the same name is dropped first
+        :param column_types: optional dictionary overriding the SQL type of single columns
+        """
+        column_types = column_types or {}
+        definitions = ", ".join("{} {}".format(quote_identifier(name), column_types.get(name, _sql_type(values)))
+                                for name, values in columns.items())
+        with self.begin() as connection:
+            if replace:
+                connection.exec_driver_sql("DROP TABLE IF EXISTS {}".format(quote_identifier(table_name)))
+            connection.exec_driver_sql("CREATE TABLE IF NOT EXISTS {} ({})".format(quote_identifier(table_name),
+                                                                                  definitions))
+
+    @instrumented("sqlite_append", rows=lambda number_of_rows, *args, **kwargs: number_of_rows)
+    def append(self, table_name, columns):
+        """
+        Appends rows to an existing table. The data is passed column by column, e.g. as NumPy arrays,
+        and converted to rows one chunk at a time, so no list of dictionaries is ever built.
+        :param table_name: the name of the table
+        :param columns: dictionary mapping column names to equally long arrays or sequences
+        :return: the number of rows written
+        """
+        started = time.perf_counter()
+        names = list(columns)
+        values = [np.asarray(column) for column in columns.values()]
+        number_of_rows = len(values[0]) if values else 0
+
+        statement = "INSERT INTO {} ({}) VALUES ({})".format(quote_identifier(table_name),
+                                                            ", ".join(quote_identifier(name) for name in names),
+                                                            ", ".join("?" for _ in names))
+        with self.begin() as connection:
+            for start in range(0, number_of_rows, self.chunk_size):
+                end = start + self.chunk_size
+                # tolist() turns NumPy scalars into plain Python values that sqlite3 can bind
+                rows = list(zip(*(column[start:end].tolist() for column in values)))
+                connection.exec_driver_sql(statement, rows)
+
+        self.rows_written += number_of_rows
+        self.seconds_writing += time.perf_counter() - started
+        return number_of_rows
+
+    def create_indexes(self, table_name, column_names):
+        """
+        Creates one index per entry. Building indexes after the load is much cheaper than maintaining them per row.
+        The index names follow the ix_<table>_<column> scheme used by Pandas.
+        :param table_name: the name of the table
+        :param column_names: the columns to index, a tuple of names gives one index over several columns
+        """
+        started = time.perf_counter()
+        with self.begin() as connection:
+            for names in column_names:
+                names = (names,) if isinstance(names, str) else tuple(names)
+                index_name = "ix_{}_{}".format(table_name, "_".join(names))
+                connection.exec_driver_sql("CREATE INDEX IF NOT EXISTS {} ON {} ({})".format(
+                    quote_identifier(index_name), quote_identifier(table_name),
+                    ", ".join(quote_identifier(name) for name in names)))
+        self.seconds_writing += time.perf_counter() - started
+
+    def write_table(self, table_name, columns, index_columns=(), column_types=None):
+        """
+        Replaces a table with the given column data and builds its indexes afterwards.
+        :param table_name: the name of the table
+        :param columns: dictionary mapping column names to equally long arrays or sequences
+        :param index_columns: the columns to index once the data is loaded
+        :param column_types: optional dictionary overriding the SQL type of single columns
+        :return: the BulkWriter itself, so the counters can be read directly
+        """
+        self.create_table(table_name, columns, replace=True, column_types=column_types)
+        self.append(table_name, columns)
+        self.create_indexes(table_name, index_columns)
+        return self
+
+    def close(self):
+        self.engine.dispose()
+
+    def __repr__(self):
+        return "Wrote {} rows in {:.3f}s ({:.0f} rows/s)".format(self.rows_written, self.seconds_writing,
+                                                                self.rows_per_second)
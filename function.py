@@ -1,63 +1,133 @@
-import pandas as pd
-from sqlalchemy import create_engine
+import csv
+import itertools
+
+import numpy as np
+from csvcache import load_cached_csv, write_csv_cache
+from database import BulkWriter, quote_identifier
+from instrumentation import instrumented
+
+INTERPOLATIONS = ("linear", "nearest", "exact")
+OUT_OF_RANGE_POLICIES = ("raise", "nan", "clip")
+# "pandas" parses with Pandas' C parser, "numpy" with np.loadtxt, which keeps Pandas out of the process
+PARSERS = ("pandas", "numpy")
+# SQLFunctionManager reads this many columns per query
+DEFAULT_COLUMN_BATCH = 100
+
+
+def read_csv_block(path_of_csv, parser="pandas"):
+    """
+    Parses a CSV with a header and numeric columns into one 2-D float block.
+    Pandas is imported on the first call with the "pandas" parser only. The "numpy" parser reads the header with the
+    csv module and the values with np.loadtxt, so fitting and classifying never import Pandas.
+    np.loadtxt rounds every value correctly, Pandas' default parser is faster but can be off in the last bit,
+    e.g. for 6 values of the assignment's ideal.csv.
+    :param path_of_csv: local path of the CSV file
+    :param parser: "pandas" or "numpy"
+    :return: a tuple of the list of column names and the array of shape (rows, columns)
+    """
+    if parser == "numpy":
+        with open(path_of_csv, newline="") as file:
+            columns = next(csv.reader(file))
+            data = np.loadtxt(file, delimiter=",", dtype=float, ndmin=2)
+        # An empty file body gives a (0, 0) block, the columns are kept anyway
+        return columns, data.reshape(-1, len(columns))
+
+    import pandas as pd
+
+    function_data = pd.read_csv(path_of_csv)
+    return list(function_data.columns), function_data.to_numpy(dtype=float)
 
 
 class FunctionManager:
 
-    def __init__(self, path_of_csv):
+    @instrumented("load_csv", rows=lambda result, function_manager, *args, **kwargs: len(function_manager.x_values))
+    def __init__(self, path_of_csv, use_cache=False, parser="pandas"):
         """
         Parses a local .csv into a list of Functions. On iterating the object, it returns a Function.
         The functions can also be retrieved with the .functions property
         The CSV file must have a specific structure where the first column represents x-values and subsequent columns represent y-values.
         :param path_of_csv: local path of the CSV file
+        :param use_cache: if True, the parsed data is kept in a binary file next to the CSV and memory-mapped on later
+                          runs instead of parsing the CSV again. The cache is rebuilt whenever the CSV or the parser
+                          changes
+        :param parser: "pandas" or "numpy", see read_csv_block
         """
+        if parser not in PARSERS:
+            raise ValueError("Unknown parser {}, expected one of {}".format(parser, PARSERS))
         self._functions = []
 
-        # The CSV file is read using the Pandas module and turned into a DataFrame
+        if use_cache:
+            cached = load_cached_csv(path_of_csv, parser)
+            if cached is not None:
+                self._load_block(*cached)
+                return
+
         try:
-            self._function_data = pd.read_csv(path_of_csv)
+            columns, data = read_csv_block(path_of_csv, parser=parser)
         except FileNotFoundError:
             print("Issue while reading file {}".format(path_of_csv))
             raise
 
-        # The x-values are stored and later fed into each Function
-        x_values = self._function_data["x"]
+        if use_cache:
+            write_csv_cache(path_of_csv, columns, data, parser)
+        self._load_block(columns, data)
+
+    def _load_block(self, columns, data):
+        # All values are kept in one 2-D float block, the x-values are its first column.
+        # Column-major order keeps every function contiguous, so the views below need no copies
+        self._columns = columns
+        self._data = np.asfortranarray(data)
+        self._x_values = self._data[:, 0]
+        self._y_values = self._data[:, 1:]
+
+        # Instead of a DataFrame per function, every Function is a lightweight view into the shared block
+        self._functions = [Function.from_block(name_of_column, self._x_values, self._y_values, column)
+                           for column, name_of_column in enumerate(self._columns[1:])]
+
+    @classmethod
+    def from_data(cls, columns, data):
+        """
+        Creates a FunctionManager from data that is already parsed, e.g. a block in shared memory.
+        The block is used without copying if it is column-major.
+        :param columns: list of column names, the first one belongs to the x-values
+        :param data: 2-D float array with one column per name
+        :return: a FunctionManager
+        """
+        function_manager = cls.__new__(cls)
+        function_manager._functions = []
+        function_manager._load_block(list(columns), data)
+        return function_manager
 
-        # The next lines iterate over each column within the Panda DataFrame and create a new Function object from the data
-        for name_of_column, data_of_column in self._function_data.items():
-            if "x" in name_of_column:
-                continue
-            # We already stored the x column, now we have the y column. We can concatenate them together with the concat function
-            subset = pd.concat([x_values, data_of_column], axis=1)
-            function = Function.from_dataframe(name_of_column, subset)
-            self._functions.append(function)
+    def to_dataframe(self):
+        """
+        Builds a DataFrame holding the x-values and all functions. It is only created on demand, e.g. for exports.
+        :return: a new DataFrame
+        """
+        import pandas as pd
 
+        return pd.DataFrame(self._data, columns=self._columns)
 
-    def to_sql(self, file_name, suffix):
+    @instrumented("to_sql", rows=lambda writer, *args, **kwargs: writer.rows_written)
+    def to_sql(self, file_name, suffix, fast_load=False):
         """
-        Writes the data to a local SQLite database using Pandas' to_sql() method.
+        Writes the data to a local SQLite database using the BulkWriter.
         If the file already exists, it will be replaced.
+        The table has the same layout Pandas' to_sql() would produce: the x column first, indexed after the load.
         :param file_name: the name the database gets
         :param suffix: to comply with the assignment, the headers require a specific suffix to the original column name
+        :param fast_load: if True, durability PRAGMAs are relaxed while loading, see database.FAST_LOAD_PRAGMAS
+        :return: the BulkWriter, which reports the number of rows and the rows per second
         """
-        # Using SQLAlchemy, an "engine" is created. It handles the creation of the database for us if it is non-existent
-        engine = create_engine('sqlite:///{}.db'.format(file_name), echo=False)
-
-        # Instead of writing our own implementation and possibly creating bugs,
-        # I decided to use functionality from Pandas to write to an SQL database.
-        # It only needs the "engine" object from SQLAlchemy
         # Some special care has to be taken to fulfill the requirements from the assignment on the naming of the columns
-        # In the next lines, the names of the functions are slightly modified to comply
-        copy_of_function_data = self._function_data.copy()
-        copy_of_function_data.columns = [name.capitalize() + suffix for name in copy_of_function_data.columns]
-        copy_of_function_data.set_index(copy_of_function_data.columns[0], inplace=True)
-
-        copy_of_function_data.to_sql(
-            file_name,
-            engine,
-            if_exists="replace",
-            index=True,
-        )
+        # In the next lines, the names of the functions are slightly modified to comply.
+        # The columns are handed over as views into the block, no DataFrame is built
+        column_names = [name.capitalize() + suffix for name in self._columns]
+        columns = {name: self._data[:, position] for position, name in enumerate(column_names)}
+
+        writer = BulkWriter(file_name, fast_load=fast_load)
+        writer.write_table(file_name, columns, index_columns=[column_names[0]])
+        writer.close()
+        return writer
 
     @property
     def functions(self):
@@ -67,6 +137,34 @@ class FunctionManager:
         """
         return self._functions
 
+    @property
+    def x_values(self):
+        """
+        Returns the shared x-values of all functions as a contiguous NumPy array. No copy is made.
+        :return: array of shape (n,)
+        """
+        return self._x_values
+
+    @property
+    def y_values(self):
+        """
+        Returns the y-values of all functions as one block, one column per function.
+        The columns are stored contiguously so a single function can be read without striding. No copy is made.
+        :return: array of shape (n, number of functions)
+        """
+        return self._y_values
+
+    def locate_rows(self, x_values):
+        """
+        Retrieves the row positions of many X-Values at once, see Function.locate_rows.
+        :param x_values: array of X-Values, all of them have to be present
+        :return: array with the row position of every X-Value
+        """
+        # All functions are views on the same x-values, so the sorted index of any of them can be used
+        if not self._functions:
+            raise IndexError("FunctionManager holds no functions")
+        return self._functions[0].locate_rows(x_values)
+
     def __iter__(self):
         # This makes the object iterable
         return FunctionManagerIterator(self)
@@ -75,6 +173,139 @@ class FunctionManager:
         return "Contains {} number of functions".format(len(self.functions))
 
 
+class SQLFunctionManager(FunctionManager):
+
+    @instrumented("load_sql", rows=lambda result, function_manager, *args, **kwargs: len(function_manager.x_values))
+    def __init__(self, file_name, table_name=None, names=None, x_range=None, batch_size=DEFAULT_COLUMN_BATCH):
+        """
+        Reads functions from a SQLite database written by FunctionManager.to_sql, e.g. output/ideal.db.
+        Only the x-values are read on creation. The y-values are read on first access, batch_size columns per query,
+        and only for the selected functions, so memory and load time scale with what is actually used.
+        :param file_name: the name of the database, without the .db extension
+        :param table_name: the name of the table, defaults to the only table of the database
+        :param names: the names of the functions to read, e.g. ["y1", "y6"], defaults to all of them
+        :param x_range: optional tuple (lowest x, highest x), both inclusive and None for no limit.
+                        The filter runs in SQLite and uses the index on the x column
+        :param batch_size: the number of columns read per query
+        """
+        self._functions = []
+        self._data = None
+        self.batch_size = batch_size
+        self.x_range = x_range
+        # SQLAlchemy is only imported once a database is actually read
+        from sqlalchemy import create_engine
+
+        self._engine = create_engine("sqlite:///{}.db".format(file_name), echo=False)
+        self._file_name = file_name
+
+        with self._engine.connect() as connection:
+            if table_name is None:
+                tables = [row[0] for row in connection.exec_driver_sql(
+                    "SELECT name FROM sqlite_master WHERE type = 'table'")]
+                if len(tables) != 1:
+                    raise ValueError("{}.db holds the tables {}, a table_name is required".format(file_name, tables))
+                table_name = tables[0]
+            self._table_name = table_name
+            sql_columns = [row[1] for row in connection.exec_driver_sql(
+                "PRAGMA table_info({})".format(quote_identifier(table_name)))]
+        if not sql_columns:
+            raise ValueError("{}.db has no table {}".format(file_name, table_name))
+
+        # to_sql stores y1 as "Y1 (ideal func)", the suffix is dropped to get the original names back
+        available = {column.split(" (")[0].lower(): column for column in sql_columns[1:]}
+        names = list(available) if names is None else list(names)
+        missing = [name for name in names if name not in available]
+        if missing:
+            raise KeyError("{}.db has no functions {}".format(file_name, missing))
+        self._columns = ["x"] + names
+        self._sql_columns = [sql_columns[0]] + [available[name] for name in names]
+
+        self._x_values = self._query([self._sql_columns[0]])[:, 0]
+        self._y_values = None
+
+    def _query(self, sql_columns):
+        # Reads some columns of the rows within the x-range, in the order they were written
+        where, parameters = [], []
+        if self.x_range is not None:
+            for operator, limit in zip([">=", "<="], self.x_range):
+                if limit is not None:
+                    where.append("{} {} ?".format(quote_identifier(self._sql_columns[0]), operator))
+                    parameters.append(float(limit))
+        statement = "SELECT {} FROM {}{} ORDER BY rowid".format(
+            ", ".join(quote_identifier(column) for column in sql_columns), quote_identifier(self._table_name),
+            " WHERE " + " AND ".join(where) if where else "")
+        # The plain sqlite3 cursor returns tuples, which NumPy converts much faster than SQLAlchemy's Row objects
+        connection = self._engine.raw_connection()
+        try:
+            rows = connection.cursor().execute(statement, parameters).fetchall()
+        finally:
+            connection.close()
+        values = np.fromiter(itertools.chain.from_iterable(rows), dtype=float, count=len(rows) * len(sql_columns))
+        return values.reshape(len(rows), len(sql_columns))
+
+    def _ensure_loaded(self):
+        if self._data is not None:
+            return
+        data = np.empty((len(self._x_values), len(self._columns)), order="F")
+        data[:, 0] = self._x_values
+        for start in range(1, len(self._columns), self.batch_size):
+            end = min(start + self.batch_size, len(self._columns))
+            data[:, start:end] = self._query(self._sql_columns[start:end])
+        self._load_block(self._columns, data)
+
+    def select(self, names):
+        """
+        Creates a manager reading only some of the functions, e.g. the chosen ideal functions for a classification.
+        :param names: the names of the functions
+        :return: a new SQLFunctionManager on the same table with the same x-range
+        """
+        return SQLFunctionManager(self._file_name, table_name=self._table_name, names=names, x_range=self.x_range,
+                                  batch_size=self.batch_size)
+
+    @property
+    def names(self):
+        """
+        The names of the functions, available without reading any y-values.
+        :return: list of names
+        """
+        return self._columns[1:]
+
+    @property
+    def is_loaded(self):
+        """
+        Tells whether the y-values were read already.
+        :return: True after the first access to the functions or the y-values
+        """
+        return self._data is not None
+
+    # The accessors of FunctionManager read the y-values on first use
+    @property
+    def functions(self):
+        self._ensure_loaded()
+        return self._functions
+
+    @property
+    def y_values(self):
+        self._ensure_loaded()
+        return self._y_values
+
+    def to_dataframe(self):
+        self._ensure_loaded()
+        return super().to_dataframe()
+
+    def to_sql(self, file_name, suffix, fast_load=False):
+        self._ensure_loaded()
+        return super().to_sql(file_name, suffix, fast_load=fast_load)
+
+    def locate_rows(self, x_values):
+        self._ensure_loaded()
+        return super().locate_rows(x_values)
+
+    def __repr__(self):
+        return "Reads {} functions from {}.db ({})".format(len(self.names), self._file_name,
+                                                           "loaded" if self.is_loaded else "not loaded yet")
+
+
 class FunctionManagerIterator:
 
     def __init__(self, function_manager):
@@ -99,10 +330,18 @@ class FunctionManagerIterator:
 
 
 class Function:
+    # Only the name and the location of the data within a block are stored, which keeps thousands of functions cheap
+    __slots__ = ("_name", "_x", "_block", "_column", "_sorted_index", "_version", "interpolation", "out_of_range")
+
+    # Defaults for resolving X-Values that are not part of the function, see locate_y_values.
+    # Every function gets its own copy, so the policy can be changed per function
+    DEFAULT_INTERPOLATION = "linear"
+    DEFAULT_OUT_OF_RANGE = "raise"
 
     def __init__(self, name):
         """
-        Contains the X and Y values of a function. Underneath it uses a Pandas DataFrame.
+        Contains the X and Y values of a function. Underneath it uses NumPy arrays, which are usually
+        views into the shared block of a FunctionManager. A Pandas DataFrame is only built on demand.
         It has some convenient methods that make calculating regressions easy.
         1) you can give it a name that can be retrieved later
         2) it is iterable and returns a point represented as a dictionary
@@ -111,22 +350,147 @@ class Function:
         :param name: the name the function should have
         """
         self._name = name
-        self.dataframe = pd.DataFrame()
+        self._x = np.empty(0)
+        self._block = np.empty((0, 1))
+        self._column = 0
+        # Counts the replacements of the data, so objects caching values derived from it can tell they are outdated
+        self._version = 0
+        self.interpolation = self.DEFAULT_INTERPOLATION
+        self.out_of_range = self.DEFAULT_OUT_OF_RANGE
+        self._invalidate()
+
+    @property
+    def x(self):
+        """
+        The x-values of the function as a view, no copy is made.
+        :return: array of shape (n,)
+        """
+        return self._x
+
+    @property
+    def y(self):
+        """
+        The y-values of the function as a view into its block, no copy is made.
+        :return: array of shape (n,)
+        """
+        return self._block[:, self._column]
+
+    @property
+    def dataframe(self):
+        """
+        A DataFrame with the "x" and "y" columns of the function. It is built on every access, for plotting and exports,
+        so changes to it do not affect the function. Assign a DataFrame to replace the data of the function.
+        :return: a new DataFrame
+        """
+        import pandas as pd
+
+        return pd.DataFrame({"x": self.x, "y": self.y})
+
+    @dataframe.setter
+    def dataframe(self, value):
+        # The first column holds the x-values, the second one the y-values
+        self._x = value.iloc[:, 0].to_numpy(dtype=float)
+        self._block = value.iloc[:, 1].to_numpy(dtype=float).reshape(-1, 1)
+        self._column = 0
+        # Replacing the data invalidates everything derived from it
+        self._invalidate()
+
+    def _invalidate(self):
+        self._sorted_index = None
+        self._version += 1
+
+    def _get_sorted_index(self):
+        # The sorted, de-duplicated x-values are built on first use and reused until the data is replaced.
+        # np.unique returns the first occurrence of every x, so duplicates resolve like the original row-wise search
+        if self._sorted_index is None:
+            sorted_x, first_rows = np.unique(self.x, return_index=True)
+            sorted_y = self.y[first_rows]
+            self._sorted_index = (sorted_x, first_rows, sorted_y)
+        return self._sorted_index
+
+    def locate_rows(self, x_values):
+        """
+        Retrieves the row positions of many X-Values at once by binary search over the sorted x-values.
+        Every X-Value has to be present in the function. If an x occurs more than once, the first row is returned.
+        :param x_values: array of X-Values
+        :return: array with the row position of every X-Value
+        """
+        sorted_x, first_rows, _ = self._get_sorted_index()
+        x_values = np.asarray(x_values, dtype=float)
+
+        positions = np.searchsorted(sorted_x, x_values)
+        found = positions < len(sorted_x)
+        found[found] = sorted_x[positions[found]] == x_values[found]
+        if not found.all():
+            raise IndexError("X-Value not found in function {}".format(self.name))
+        return first_rows[positions]
+
+    def locate_y_values(self, x_values, interpolation=None, out_of_range=None):
+        """
+        Retrieves the Y-Values of many X-Values at once by binary search over the sorted x-values.
+        X-Values between two known points are resolved according to the interpolation:
+        "linear" interpolates between the neighbours, "nearest" takes the closer neighbour
+        and "exact" only accepts X-Values that are present in the function.
+        X-Values outside of the known range are handled according to out_of_range:
+        "raise" raises an IndexError, "nan" returns NaN and "clip" returns the Y-Value of the nearest end.
+        :param x_values: array of X-Values
+        :param interpolation: "linear", "nearest" or "exact", defaults to the interpolation of the function
+        :param out_of_range: "raise", "nan" or "clip", defaults to the out_of_range policy of the function
+        :return: array with the Y-Values
+        """
+        interpolation = interpolation or self.interpolation
+        out_of_range = out_of_range or self.out_of_range
+        if interpolation not in INTERPOLATIONS:
+            raise ValueError("Unknown interpolation {}".format(interpolation))
+        if out_of_range not in OUT_OF_RANGE_POLICIES:
+            raise ValueError("Unknown out_of_range policy {}".format(out_of_range))
+
+        sorted_x, _, sorted_y = self._get_sorted_index()
+        x_values = np.asarray(x_values, dtype=float)
+        if len(sorted_x) == 0:
+            raise IndexError("Function {} holds no points".format(self.name))
+
+        # right is the first known x that is not smaller than the requested x, left is its predecessor
+        right = np.searchsorted(sorted_x, x_values)
+        right = np.minimum(right, len(sorted_x) - 1)
+        left = np.maximum(right - 1, 0)
+        exact = sorted_x[right] == x_values
+
+        outside = (x_values < sorted_x[0]) | (x_values > sorted_x[-1])
+        if out_of_range == "raise" and outside.any():
+            raise IndexError("X-Value outside of the range of function {}".format(self.name))
+
+        if interpolation == "exact":
+            if not (exact | outside).all():
+                raise IndexError("X-Value not found in function {}".format(self.name))
+            y_values = sorted_y[right].copy()
+        elif interpolation == "nearest":
+            take_left = (x_values - sorted_x[left]) <= (sorted_x[right] - x_values)
+            y_values = np.where(take_left & ~exact, sorted_y[left], sorted_y[right])
+        else:
+            width = sorted_x[right] - sorted_x[left]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                slope = (sorted_y[right] - sorted_y[left]) / width
+                interpolated = sorted_y[left] + (x_values - sorted_x[left]) * slope
+            y_values = np.where(exact, sorted_y[right], interpolated)
+
+        if outside.any():
+            if out_of_range == "nan":
+                y_values[outside] = np.nan
+            else:
+                y_values[outside] = np.where(x_values[outside] < sorted_x[0], sorted_y[0], sorted_y[-1])
+        return y_values
 
     def locate_y_based_on_x(self, x):
         """
         Retrieves a Y-Value.
+        X-Values between two known points are interpolated, see locate_y_values.
         :param x: the X-Value
         :return: the Y-Value
         """
-        # use the Pandas iloc function to find the x and return the corresponding y
-        # If it is not found, an exception is raised
-        search_key = self.dataframe["x"] == x
-        try:
-            return self.dataframe.loc[search_key].iat[0, 1]
-        except IndexError:
-            raise IndexError
-
+        # Binary search on the sorted x-values finds the x and returns the corresponding y
+        # If it is outside of the function (or not found with "exact" interpolation), an exception is raised
+        return self.locate_y_values(np.array([x]))[0]
 
     @property
     def name(self):
@@ -144,26 +508,46 @@ class Function:
         Subtracts two functions and returns a new DataFrame.
         :rtype: object
         """
-        diff = self.dataframe - other.dataframe
+        import pandas as pd
+
+        diff = pd.DataFrame({"x": self.x - other.x, "y": self.y - other.y})
         return diff
 
     @classmethod
     def from_dataframe(cls, name, dataframe):
         """
         Immediately creates a function by providing a DataFrame.
-        On creation, the original column names are overwritten to "x" and "y".
+        The first column is taken as "x", the second one as "y", whatever their original names are.
         :rtype: a Function
         """
         function = cls(name)
         function.dataframe = dataframe
-        function.dataframe.columns = ["x", "y"]
+        return function
+
+    @classmethod
+    def from_block(cls, name, x_values, block, column):
+        """
+        Creates a function that is a view into a column of a shared 2-D block, as used by the FunctionManager.
+        :param name: the name the function should have
+        :param x_values: the shared x-values, one per row of the block
+        :param block: 2-D array holding the y-values of many functions
+        :param column: the column of the block holding this function
+        :rtype: a Function
+        """
+        function = cls(name)
+        function._x = x_values
+        function._block = block
+        function._column = column
         return function
 
     def __repr__(self):
         return "Function for {}".format(self.name)
 
 class IdealFunction(Function):
-    def __init__(self, function, training_function, error):
+    __slots__ = ("_training_function", "_training_version", "error", "_tolerance_value", "_tolerance",
+                 "_largest_deviation")
+
+    def __init__(self, function, training_function, error, largest_deviation=None):
         """
         An ideal function stores the predicting function, training data, and the regression.
         Make sure to provide a tolerance_factor if for classification purposes tolerance is allowed.
@@ -171,32 +555,71 @@ class IdealFunction(Function):
         :param function: the ideal function
         :param training_function: the training data the classifying data is based upon
         :param squared_error: the beforehand calculated regression
+        :param largest_deviation: optional, already known largest deviation to the training function
         """
         super().__init__(function.name)
-        self.dataframe = function.dataframe
+        # The ideal function shares the data of the candidate function instead of copying it
+        self._x = function._x
+        self._block = function._block
+        self._column = function._column
+        # The policies of the candidate function are kept, they can be changed on the ideal function afterwards
+        self.interpolation = function.interpolation
+        self.out_of_range = function.out_of_range
 
         self.training_function = training_function
         self.error = error
         self._tolerance_value = 1
-        self._tolerance = 1
+        self._tolerance = None
+        self._largest_deviation = largest_deviation
 
+    def _invalidate(self):
+        # The largest deviation and the tolerance are cached, they depend on both the ideal and the training data
+        super()._invalidate()
+        self._largest_deviation = None
+        self._tolerance = None
+
+    @instrumented("largest_deviation", rows=lambda result, self, ideal_function, train_function: len(train_function.y))
     def _determine_largest_deviation(self, ideal_function, train_function):
         # Accepts two functions and subtracts them
-        # From the resulting DataFrame, it finds the one which is largest
-        distances = train_function - ideal_function
-        distances["y"] = distances["y"].abs()
-        largest_deviation = max(distances["y"])
+        # From the resulting array, it finds the one which is largest
+        distances = np.abs(train_function.y - ideal_function.y)
+        largest_deviation = distances.max()
         return largest_deviation
 
+    @property
+    def training_function(self):
+        """
+        The training function the ideal function was fitted to. Assigning a new one resets the cached tolerance.
+        :return: the training function
+        """
+        return self._training_function
+
+    @training_function.setter
+    def training_function(self, value):
+        self._training_function = value
+        self._training_version = value._version
+        self._invalidate()
+
+    def _check_training_data(self):
+        # The data of the training function can be replaced without assigning it again, its version tells
+        if self._training_version != self._training_function._version:
+            self._training_version = self._training_function._version
+            self._largest_deviation = None
+            self._tolerance = None
+
     @property
     def tolerance(self):
         """
         This property describes the accepted tolerance towards the regression in order to still count as classification.
         Although you can set a tolerance directly (good for unit testing), this is not recommended. Instead, provide
         a tolerance_factor.
+        The value is computed once and cached until the training function, its data, the data of the ideal function or
+        the tolerance_factor change.
         :return: the tolerance
         """
-        self._tolerance = self.tolerance_factor * self.largest_deviation
+        self._check_training_data()
+        if self._tolerance is None:
+            self._tolerance = self.tolerance_factor * self.largest_deviation
         return self._tolerance
 
     @tolerance.setter
@@ -215,15 +638,19 @@ class IdealFunction(Function):
     @tolerance_factor.setter
     def tolerance_factor(self, value):
         self._tolerance_value = value
+        self._tolerance = None
 
     @property
     def largest_deviation(self):
         """
         Retrieves the largest deviation between classifying function and the training function it is based upon.
+        It is computed on first access and cached afterwards.
         :return: the largest deviation
         """
-        largest_deviation = self._determine_largest_deviation(self, self.training_function)
-        return largest_deviation
+        self._check_training_data()
+        if self._largest_deviation is None:
+            self._largest_deviation = self._determine_largest_deviation(self, self.training_function)
+        return self._largest_deviation
 
 
 class FunctionIterator:
@@ -235,9 +662,8 @@ class FunctionIterator:
 
     def __next__(self):
         # On iterating over a function, it returns a dict that describes the point
-        if self._index < len(self._function.dataframe):
-            value_requested_series = (self._function.dataframe.iloc[self._index])
-            point = {"x": value_requested_series.x, "y": value_requested_series.y}
+        if self._index < len(self._function.x):
+            point = {"x": self._function.x[self._index], "y": self._function.y[self._index]}
             self._index += 1
             return point
         raise StopIteration
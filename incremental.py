@@ -0,0 +1,147 @@
+import numpy as np
+
+from function import Function, IdealFunction
+from lossfunction import get_accumulator, loss_name
+from regression import compute_error_matrix
+
+
+class IncrementalFitter:
+
+    def __init__(self, candidate_function_manager, training_names, loss_function):
+        """
+        Keeps running loss accumulators for every pair of training and candidate function, so the ideal functions
+        can be updated when training rows are appended instead of fitting everything again.
+        Besides the loss, the largest deviation of every pair is tracked, which gives the tolerances for free.
+        Appending r rows costs O(r x candidates) per training function, independent of the rows seen before.
+        :param candidate_function_manager: FunctionManager holding the candidate functions
+        :param training_names: the names of the training functions, in the order of the appended columns
+        :param loss_function: a registered loss that can be accumulated, either by name or as the pairwise loss function
+        """
+        self.candidate_function_manager = candidate_function_manager
+        self.training_names = list(training_names)
+        self.loss_name = loss_name(loss_function)
+        self._accumulate = get_accumulator(self.loss_name)
+
+        number_of_training = len(self.training_names)
+        number_of_candidates = len(candidate_function_manager.functions)
+        self.errors = np.zeros((number_of_training, number_of_candidates))
+        self.largest_deviations = np.zeros((number_of_training, number_of_candidates))
+
+        # The appended training rows are kept as chunks and only joined when the training functions are needed
+        self._x_chunks = []
+        self._y_chunks = []
+
+    @property
+    def number_of_rows(self):
+        """
+        The number of training rows appended so far.
+        :return: number of rows
+        """
+        return sum(len(chunk) for chunk in self._x_chunks)
+
+    def append(self, x_values, y_values):
+        """
+        Appends training rows and updates the accumulators. Every x has to be present in the candidate functions.
+        :param x_values: array of shape (r,) with the new x-values
+        :param y_values: array of shape (r, number of training functions) with the new y-values
+        """
+        x_values = np.asarray(x_values, dtype=float)
+        y_values = np.asarray(y_values, dtype=float).reshape(len(x_values), len(self.training_names))
+        if len(x_values) == 0:
+            return
+
+        rows = self.candidate_function_manager.locate_rows(x_values)
+        candidate_rows = self.candidate_function_manager.y_values[rows]
+
+        self.errors = self._accumulate(self.errors, compute_error_matrix(y_values, candidate_rows, self.loss_name))
+        self.largest_deviations = np.maximum(self.largest_deviations,
+                                             compute_error_matrix(y_values, candidate_rows, "max_absolute_error"))
+        self._x_chunks.append(x_values)
+        self._y_chunks.append(y_values)
+
+    def append_function_manager(self, training_function_manager):
+        """
+        Appends all rows of a FunctionManager, e.g. one loaded from a CSV with the newly arrived training rows.
+        :param training_function_manager: FunctionManager with the same training functions as the fitter
+        """
+        names = [function.name for function in training_function_manager.functions]
+        if names != self.training_names:
+            raise ValueError("Expected the training functions {}, got {}".format(self.training_names, names))
+        self.append(training_function_manager.x_values, training_function_manager.y_values)
+
+    def _joined_rows(self):
+        # Joining once and keeping only the joined chunk avoids concatenating all rows again next time
+        if len(self._x_chunks) != 1:
+            x_values = np.concatenate(self._x_chunks) if self._x_chunks else np.empty(0)
+            y_values = np.concatenate(self._y_chunks) if self._y_chunks else np.empty((0, len(self.training_names)))
+            self._x_chunks = [x_values]
+            self._y_chunks = [np.asfortranarray(y_values)]
+        return self._x_chunks[0], self._y_chunks[0]
+
+    def training_functions(self):
+        """
+        Builds the training functions from all rows appended so far.
+        :return: list of Function objects, views into one joined block
+        """
+        x_values, y_values = self._joined_rows()
+        return [Function.from_block(name, x_values, y_values, column)
+                for column, name in enumerate(self.training_names)]
+
+    def ideal_functions(self, tolerance_factor=1):
+        """
+        Emits the currently best IdealFunction per training function.
+        Their largest deviation comes from the running maximum, so the tolerance is not computed again.
+        :param tolerance_factor: the tolerance_factor set on every IdealFunction
+        :return: a list of IdealFunction objects in the order of the training functions
+        """
+        if self.number_of_rows == 0:
+            raise ValueError("No training rows appended yet")
+        # argmin returns the first candidate on ties, just like minimise_loss_batch
+        best_candidates = self.errors.argmin(axis=1)
+        ideal_functions = []
+        for row, training_function in enumerate(self.training_functions()):
+            column = best_candidates[row]
+            ideal_function = IdealFunction(function=self.candidate_function_manager.functions[column],
+                                           training_function=training_function, error=float(self.errors[row, column]),
+                                           largest_deviation=self.largest_deviations[row, column])
+            ideal_function.tolerance_factor = tolerance_factor
+            ideal_functions.append(ideal_function)
+        return ideal_functions
+
+    def save(self, path):
+        """
+        Stores the state of the fitter in a NumPy .npz file, so it survives restarts.
+        The candidate functions are not stored, only their names to check them when loading.
+        :param path: local path of the file, used as given, so it can be passed to load unchanged
+        """
+        x_values, y_values = self._joined_rows()
+        # Through a file object, np.savez does not append ".npz" to a path without that suffix
+        with open(path, "wb") as file:
+            np.savez(file, loss_name=self.loss_name, training_names=np.array(self.training_names),
+                     candidate_names=np.array([function.name
+                                               for function in self.candidate_function_manager.functions]),
+                     errors=self.errors, largest_deviations=self.largest_deviations, x_values=x_values,
+                     y_values=y_values)
+
+    @classmethod
+    def load(cls, path, candidate_function_manager):
+        """
+        Restores a fitter stored with save.
+        :param path: local path of the file
+        :param candidate_function_manager: FunctionManager holding the same candidate functions as when it was saved
+        :return: an IncrementalFitter
+        """
+        with np.load(path) as state:
+            candidate_names = [function.name for function in candidate_function_manager.functions]
+            if state["candidate_names"].tolist() != candidate_names:
+                raise ValueError("The candidate functions differ from the ones the state was saved with")
+            fitter = cls(candidate_function_manager, state["training_names"].tolist(), str(state["loss_name"]))
+            fitter.errors = state["errors"]
+            fitter.largest_deviations = state["largest_deviations"]
+            fitter._x_chunks = [state["x_values"]]
+            fitter._y_chunks = [np.asfortranarray(state["y_values"])]
+        return fitter
+
+    def __repr__(self):
+        return "IncrementalFitter for {} training functions over {} rows".format(len(self.training_names),
+                                                                               self.number_of_rows)
@@ -0,0 +1,222 @@
+import cProfile
+import functools
+import io
+import json
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+class StageStatistics:
+
+    def __init__(self, name):
+        """
+        Collects the measurements of one stage over all its calls.
+        :param name: the name of the stage
+        """
+        self.name = name
+        self.calls = 0
+        self.seconds = 0.0
+        self.rows = 0
+        # Only measured while memory tracing is enabled, None otherwise
+        self.peak_bytes = None
+
+    def to_dict(self):
+        """
+        Converts the measurements into a dictionary that can be written as JSON.
+        :return: dictionary with calls, seconds, rows and peak_bytes
+        """
+        return {"calls": self.calls, "seconds": self.seconds, "rows": self.rows, "peak_bytes": self.peak_bytes}
+
+    def __repr__(self):
+        peak = "" if self.peak_bytes is None else ", peak {:.1f} MiB".format(self.peak_bytes / 2 ** 20)
+        return "{}: {} calls, {:.4f}s, {} rows{}".format(self.name, self.calls, self.seconds, self.rows, peak)
+
+
+class _Frame:
+    # Bookkeeping of a running stage, nested stages are kept on a stack per thread while memory is traced
+    __slots__ = ("rows", "start_bytes", "peak_bytes")
+
+    def __init__(self, rows, start_bytes=0):
+        self.rows = rows
+        self.start_bytes = start_bytes
+        self.peak_bytes = start_bytes
+
+
+class Instrumentation:
+
+    def __init__(self):
+        """
+        Records wall time, call counts, processed rows and optionally the peak memory of the stages of a run.
+        Instrumentation is disabled until enable is called. While disabled, an instrumented function costs a single
+        attribute check on top of the call.
+        """
+        self.enabled = False
+        self.trace_memory = False
+        self._profiler = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets all measurements collected so far.
+        """
+        with self._lock:
+            self.stages = {}
+            self.started = time.perf_counter()
+
+    def enable(self, profile=False, trace_memory=False):
+        """
+        Starts recording.
+        :param profile: if True, the run is profiled with cProfile as well, which slows down Python code considerably
+        :param trace_memory: if True, the peak memory of every stage is measured with tracemalloc
+        """
+        self.enabled = True
+        self.trace_memory = trace_memory
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if profile:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+
+    def disable(self):
+        """
+        Stops recording, the measurements are kept until reset is called.
+        """
+        if self._profiler is not None:
+            self._profiler.disable()
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.enabled = False
+        self.trace_memory = False
+
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    @contextmanager
+    def stage(self, name, rows=0):
+        """
+        Measures a block of code as one call of a stage. Nested stages are measured separately, the time and memory
+        of an inner stage are included in the outer one.
+        Stages running in several threads at once share the process-wide memory tracer, so their peaks overlap.
+        :param name: the name of the stage
+        :param rows: the number of rows processed by the block, it can also be set on the yielded frame
+        """
+        if not self.enabled:
+            yield None
+            return
+
+        frame = _Frame(rows)
+        # Captured once, so disabling the tracer while the stage runs does not unbalance the stack
+        traced = self.trace_memory
+        if traced:
+            stack = self._stack()
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                # The peak of the outer stage so far is saved, as the tracer's peak is reset for the inner stage
+                stack[-1].peak_bytes = max(stack[-1].peak_bytes, peak)
+            tracemalloc.reset_peak()
+            frame.start_bytes = frame.peak_bytes = current
+            stack.append(frame)
+
+        started = time.perf_counter()
+        try:
+            yield frame
+        finally:
+            seconds = time.perf_counter() - started
+            peak_bytes = None
+            if traced and tracemalloc.is_tracing():
+                stack.pop()
+                frame.peak_bytes = max(frame.peak_bytes, tracemalloc.get_traced_memory()[1])
+                peak_bytes = frame.peak_bytes - frame.start_bytes
+                if stack:
+                    stack[-1].peak_bytes = max(stack[-1].peak_bytes, frame.peak_bytes)
+                tracemalloc.reset_peak()
+            self._record(name, seconds, frame.rows, peak_bytes)
+
+    def _record(self, name, seconds, rows, peak_bytes):
+        with self._lock:
+            statistics = self.stages.get(name)
+            if statistics is None:
+                statistics = self.stages[name] = StageStatistics(name)
+            statistics.calls += 1
+            statistics.seconds += seconds
+            statistics.rows += rows
+            if peak_bytes is not None:
+                statistics.peak_bytes = max(statistics.peak_bytes or 0, peak_bytes)
+
+    def profile_summary(self, limit=20):
+        """
+        Summarises the cProfile capture of the run.
+        :param limit: the number of functions listed, sorted by cumulative time
+        :return: the pstats listing as string, None if the run was not profiled
+        """
+        if self._profiler is None:
+            return None
+        stream = io.StringIO()
+        pstats.Stats(self._profiler, stream=stream).sort_stats("cumulative").print_stats(limit)
+        return stream.getvalue()
+
+    def dump_profile(self, path):
+        """
+        Writes the cProfile capture in the pstats format, e.g. for snakeviz.
+        :param path: local path of the file
+        """
+        if self._profiler is None:
+            raise ValueError("The run was not profiled")
+        self._profiler.dump_stats(path)
+
+    def report(self):
+        """
+        Builds the structured report of the run.
+        :return: dictionary with the wall time of the run and the measurements of every stage
+        """
+        with self._lock:
+            stages = {name: statistics.to_dict() for name, statistics in self.stages.items()}
+        return {"wall_seconds": time.perf_counter() - self.started, "stages": stages}
+
+    def write_report(self, path):
+        """
+        Writes the report of the run as JSON.
+        :param path: local path of the file
+        """
+        with open(path, "w") as file:
+            json.dump(self.report(), file, indent=2)
+
+    def __repr__(self):
+        lines = ["Run took {:.4f}s".format(time.perf_counter() - self.started)]
+        lines.extend("  {}".format(statistics) for statistics in self.stages.values())
+        return "\n".join(lines)
+
+
+# The instrumentation shared by all modules of a run
+INSTRUMENTATION = Instrumentation()
+
+
+def instrumented(name, rows=None):
+    """
+    Decorator measuring every call of a function as a stage of the shared instrumentation.
+    :param name: the name of the stage
+    :param rows: optional callable receiving the result followed by the arguments of the call,
+                 it returns the number of rows the call processed
+    :return: the decorator
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not INSTRUMENTATION.enabled:
+                return function(*args, **kwargs)
+            with INSTRUMENTATION.stage(name) as frame:
+                result = function(*args, **kwargs)
+                # The rows are only known after the call
+                if rows is not None:
+                    frame.rows = rows(result, *args, **kwargs)
+            return result
+        return wrapper
+    return decorator
@@ -1,3 +1,9 @@
+import numpy as np
+
+# Huber loss switches from quadratic to linear beyond this deviation
+HUBER_DELTA = 1.0
+
+
 def squared_error(first_function, second_function):
     """
     Computes the squared error with respect to another function.
@@ -11,3 +17,118 @@ def squared_error(first_function, second_function):
     return total_deviation
 
 
+def absolute_error(first_function, second_function):
+    """
+    Computes the sum of absolute deviations with respect to another function.
+    :param first_function: the first function
+    :param second_function: the second function
+    :return: the absolute error
+    """
+    distances = second_function - first_function
+    return float(_absolute(distances["y"].to_numpy()))
+
+
+def max_absolute_error(first_function, second_function):
+    """
+    Computes the largest absolute deviation with respect to another function.
+    :param first_function: the first function
+    :param second_function: the second function
+    :return: the largest absolute deviation
+    """
+    distances = second_function - first_function
+    return float(_max_absolute(distances["y"].to_numpy()))
+
+
+def huber_loss(first_function, second_function):
+    """
+    Computes the Huber loss with respect to another function.
+    Small deviations count quadratically, large ones linearly, which makes it less sensitive to outliers.
+    :param first_function: the first function
+    :param second_function: the second function
+    :return: the Huber loss
+    """
+    distances = second_function - first_function
+    return float(_huber(distances["y"].to_numpy()))
+
+
+# The following reducers are the batched counterparts of the loss functions above.
+# They accept an array of deviations and reduce it along the first axis (the rows),
+# so a single call can compute the loss of many function pairs at once.
+
+def _squared(deviations):
+    return (deviations ** 2).sum(axis=0)
+
+
+def _absolute(deviations):
+    return np.abs(deviations).sum(axis=0)
+
+
+def _max_absolute(deviations):
+    return np.abs(deviations).max(axis=0)
+
+
+def _huber(deviations):
+    absolute = np.abs(deviations)
+    quadratic = 0.5 * deviations ** 2
+    linear = HUBER_DELTA * (absolute - 0.5 * HUBER_DELTA)
+    return np.where(absolute <= HUBER_DELTA, quadratic, linear).sum(axis=0)
+
+
+# The registry maps the name of a loss function to its batched reducer
+LOSS_FUNCTIONS = {}
+
+# Losses that can be computed piece by piece map to the ufunc that combines the results of two sets of rows
+LOSS_ACCUMULATORS = {}
+
+
+def register_loss(name, reducer, accumulator=None):
+    """
+    Registers a batched loss so it can be used by the candidate-matrix engine.
+    :param name: the name of the loss, usually the name of the matching pairwise loss function
+    :param reducer: a callable accepting an array of deviations and reducing it along axis 0
+    :param accumulator: optional ufunc combining the reduced results of two sets of rows, e.g. np.add for sums
+    """
+    LOSS_FUNCTIONS[name] = reducer
+    if accumulator is not None:
+        LOSS_ACCUMULATORS[name] = accumulator
+
+
+def loss_name(loss_function):
+    """
+    Returns the registry name of a loss function.
+    :param loss_function: either the name of a registered loss or the pairwise loss function itself
+    :return: the name as a string
+    """
+    return loss_function if isinstance(loss_function, str) else loss_function.__name__
+
+
+def get_loss(loss_function):
+    """
+    Looks up the batched reducer of a loss function.
+    :param loss_function: either the name of a registered loss or the pairwise loss function itself
+    :return: the batched reducer
+    """
+    name = loss_name(loss_function)
+    try:
+        return LOSS_FUNCTIONS[name]
+    except KeyError:
+        raise KeyError("No batched loss registered for {}".format(name))
+
+
+def get_accumulator(loss_function):
+    """
+    Looks up how partial results of a loss function are combined.
+    :param loss_function: either the name of a registered loss or the pairwise loss function itself
+    :return: the ufunc combining two partial results
+    """
+    name = loss_name(loss_function)
+    try:
+        return LOSS_ACCUMULATORS[name]
+    except KeyError:
+        raise KeyError("Loss {} cannot be accumulated".format(name))
+
+
+register_loss("squared_error", _squared, np.add)
+register_loss("absolute_error", _absolute, np.add)
+register_loss("max_absolute_error", _max_absolute, np.maximum)
+register_loss("huber_loss", _huber, np.add)
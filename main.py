@@ -1,79 +1,136 @@
+import argparse
+import functools
 import math
 
-from function import FunctionManager
+from bootstrap import SelectionStability
+from instrumentation import INSTRUMENTATION
 from lossfunction import squared_error
-from plotting import (plot_ideal_functions,
-                      plot_points_with_their_ideal_function)
-from regression import find_classification, minimise_loss
-from utils import write_deviation_results_to_sqlite
+from parallel import minimise_loss_parallel
+from pipeline import assignment_pipeline
+from regression import minimise_loss_batch
+from search import PrunedSearch, minimise_loss_pruned
 
 # This constant represents the factor for the criterion, specific to the assignment
 ACCEPTED_FACTOR = math.sqrt(2)
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Finds the ideal functions for the training data and classifies the test data")
+    parser.add_argument("--chunk-size", type=int, default=None,
+                        help="stream the test data in chunks of this many rows instead of loading it at once")
+    parser.add_argument("--csv-cache", action="store_true",
+                        help="keep a binary cache next to each CSV and memory-map it on later runs")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="search the candidate functions with this many processes")
+    parser.add_argument("--shard-size", type=int, default=None,
+                        help="number of candidate functions per process task, used together with --workers")
+    parser.add_argument("--prune", action="store_true",
+                        help="skip candidates that provably cannot be the best fit instead of evaluating all of them")
+    parser.add_argument("--force", action="store_true",
+                        help="run every stage even if its inputs did not change since the last run")
+    parser.add_argument("--stage-workers", type=int, default=None,
+                        help="run independent stages concurrently on this many threads, implies --headless")
+    parser.add_argument("--headless", action="store_true",
+                        help="only save the plots instead of opening them in the browser")
+    parser.add_argument("--from-database", action="store_true",
+                        help="read the selected ideal functions from ideal.db instead of parsing all of ideal.csv")
+    parser.add_argument("--parser", choices=["pandas", "numpy"], default="pandas",
+                        help="parse the CSVs with Pandas or with NumPy, which avoids importing Pandas")
+    parser.add_argument("--fast-load", action="store_true",
+                        help="write the databases with relaxed durability, a crash while writing can corrupt them")
+    parser.add_argument("--target", action="append", default=None, metavar="STAGE",
+                        help="only resolve this stage and what it depends on, e.g. fit or classify, can be repeated")
+    parser.add_argument("--bootstrap", type=int, default=None, metavar="RESAMPLES",
+                        help="report how often each candidate wins when the training rows are resampled")
+    parser.add_argument("--instrument", action="store_true",
+                        help="print the wall time, calls and rows of every stage at the end of the run")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="also measure the peak memory of every stage, implies --instrument")
+    parser.add_argument("--profile", default=None, metavar="PATH",
+                        help="profile the run with cProfile and write the capture to PATH, implies --instrument")
+    parser.add_argument("--report", default=None, metavar="PATH",
+                        help="write the stage report as JSON to PATH, implies --instrument")
+    arguments = parser.parse_args()
+
+    # Instrumentation is off unless requested, the instrumented functions then only check a flag
+    instrument = arguments.instrument or arguments.trace_memory or arguments.profile or arguments.report
+    if instrument:
+        INSTRUMENTATION.enable(profile=bool(arguments.profile), trace_memory=arguments.trace_memory)
+
     # Specify paths for csv files
     ideal_path = "data/ideal.csv"
     train_path = "data/train.csv"
-
-    # The FunctionManager accepts a path to a csv and parses Function objects from the data.
-    # A Function stores X and Y points of a function. It utilizes Pandas for efficient data handling.
-    candidate_ideal_function_manager = FunctionManager(path_of_csv=ideal_path)
-    train_function_manager = FunctionManager(path_of_csv=train_path)
-
-    # A FunctionManager uses the .to_sql function from Pandas
-    # The suffix is added to conform to the requirement of the table structure
-    train_function_manager.to_sql(file_name="output/training", suffix=" (training func)")
-    candidate_ideal_function_manager.to_sql(file_name="output/ideal", suffix=" (ideal func)")
-
-    # Recap:
-    # Within train_function_manager, 4 functions are stored.
-    # Within ideal_function_manager, 50 functions are stored.
-    # In the next step, we can use this data to compute an IdealFunction.
-    # An IdealFunction, among other things, stores the best-fitting function, the training data, and is able to compute the tolerance.
-    # All we need to do now is iterate over all train_functions
-    # Matching ideal functions are stored in a list.
-    ideal_functions = []
-    for train_function in train_function_manager:
-        # minimise_loss is capable of computing the best-fitting function given the train function
-        ideal_function = minimise_loss(training_function=train_function,
-                                       list_of_candidate_functions=candidate_ideal_function_manager.functions,
-                                       loss_function=squared_error)
-        ideal_function.tolerance_factor = ACCEPTED_FACTOR
-        ideal_functions.append(ideal_function)
-
-    # We can use the classification to perform some plotting
-    plot_ideal_functions(ideal_functions, "output/train_and_ideal")
-
-    # Now it is time to analyze all points within the test data
-    # The FunctionManager provides all the necessary tools to load a CSV, so it will be reused.
-    # Instead of multiple Functions like before, it will now contain a single "Function" at location [0]
-    # The benefit is that we can iterate over each point with the Function object
     test_path = "data/test.csv"
-    test_function_manager = FunctionManager(path_of_csv=test_path)
-    test_function = test_function_manager.functions[0]
 
-    points_with_ideal_function = []
-    for point in test_function:
-        ideal_function, delta_y = find_classification(point=point, ideal_functions=ideal_functions)
-        result = {"point": point, "classification": ideal_function, "delta_y": delta_y}
-        points_with_ideal_function.append(result)
+    # All candidates are compared with every train function to find the best-fitting one per train function.
+    # minimise_loss_batch computes the whole error matrix in one pass.
+    # With --workers, the candidates are split into shards that are searched by a pool of processes instead,
+    # with --prune, candidates that cannot beat the current best are pruned by a lower bound or abandoned early.
+    # All of them select the same ideal functions
+    if arguments.workers:
+        fit = functools.partial(minimise_loss_parallel, workers=arguments.workers, shard_size=arguments.shard_size)
+    elif arguments.prune:
+        def fit(training_function_manager, candidate_function_manager, loss_function):
+            pruned_search = PrunedSearch(candidate_function_manager.y_values, loss_function)
+            ideal_functions = minimise_loss_pruned(training_function_manager, candidate_function_manager,
+                                                   loss_function, search=pruned_search)
+            print(pruned_search)
+            return ideal_functions
+    else:
+        fit = minimise_loss_batch
+
+    # The work is organized as a graph of stages: load, export, fit, classify, persist and plot.
+    # Every stage is keyed by a hash of the CSV contents and its parameters (loss function, ACCEPTED_FACTOR).
+    # Stages whose key did not change since the last run are skipped and the fitted ideal functions and
+    # the classification are restored from output/.pipeline, so changing only test.csv skips the export and the fit.
+    # The FunctionManagers are created only if a stage that needs them actually runs
+    pipeline = assignment_pipeline(train_path=train_path, ideal_path=ideal_path, test_path=test_path,
+                                   accepted_factor=ACCEPTED_FACTOR, loss_function=squared_error, fit=fit,
+                                   use_cache=arguments.csv_cache, chunk_size=arguments.chunk_size,
+                                   show_plot=not (arguments.headless or arguments.stage_workers),
+                                   force=arguments.force, progress=lambda classifier: print(classifier),
+                                   from_database=arguments.from_database, parser=arguments.parser,
+                                   bootstrap_resamples=arguments.bootstrap, fast_load=arguments.fast_load)
+    # With --stage-workers, stages without a dependency on each other overlap, e.g. the export with the fit and
+    # the plots with the mapping write. The report at the end shows the wall time and the sum of the stage times,
+    # which overstates the time of a serial run. benchmark.py --stage-workers measures the serial and the concurrent
+    # wall times of the same pipeline.
+    # Pandas, SQLAlchemy and Bokeh are imported by the stages that use them, so e.g. --target classify together
+    # with --parser numpy starts without importing any of them
+    pipeline.run(targets=arguments.target, workers=arguments.stage_workers)
 
-    # Recap: within points_with_ideal_functions a list of dictionaries is stored.
-    # These dictionaries represent the classification result of each point.
+    # The bulk writers report the number of rows and the throughput of the databases that were written
+    if pipeline.status.get("export") == "ran":
+        training_writer, ideal_writer = pipeline.results["export"]
+        print("training.db:", training_writer)
+        print("ideal.db:", ideal_writer)
+    if pipeline.status.get("persist") == "ran":
+        print("mapping.db:", pipeline.results["persist"])
+    if pipeline.results.get("stability") is not None:
+        print(SelectionStability.from_dict(pipeline.results["stability"]))
+    print(pipeline)
 
-    # We can plot all the points with the corresponding classification function
-    plot_points_with_their_ideal_function(points_with_ideal_function, "output/point_and_ideal")
+    if instrument:
+        INSTRUMENTATION.disable()
+        print(INSTRUMENTATION)
+        if arguments.report:
+            INSTRUMENTATION.write_report(arguments.report)
+        if arguments.profile:
+            INSTRUMENTATION.dump_profile(arguments.profile)
+            print(INSTRUMENTATION.profile_summary())
 
-    # Finally, the dict object is used to write it to a SQLite database
-    # In this method, a pure SQLAlchemy approach has been chosen with a MetaData object to avoid using SQL language directly
-    write_deviation_results_to_sqlite(points_with_ideal_function)
-    
-    print("Following files were created:")
-    print("training.db: Contains all training functions stored as a SQLite database")
-    print("ideal.db: Contains all ideal functions stored as a SQLite database")
-    print("mapping.db: Contains the results of the point test where the ideal function and its delta are computed")
-    print("train_and_ideal.html: View the training data as scatter and the best-fitting ideal function as a curve")
-    print("points_and_ideal.html: View for those points with a matching ideal function the distance between them in a figure")
+    # A run of some targets only wrote part of the files
+    if not arguments.target:
+        print("Following files were created:")
+        print("training.db: Contains all training functions stored as a SQLite database")
+        print("ideal.db: Contains all ideal functions stored as a SQLite database")
+        print("mapping.db: Contains the results of the point test where the ideal function and its delta are computed")
+        print("mapping.db: Also holds indexes and summary tables of the matches and deltas, "
+              "query them with mappingdb.py")
+        print("train_and_ideal.html: View the training data as scatter and the best-fitting ideal function as a curve")
+        print("points_and_ideal.html: View all points colored by their ideal function, "
+              "drawn on top of the tolerance bands")
+        print("deviations.npz: Distances of all points to all ideal functions, "
+              "try other tolerance factors with whatif.py")
     print("Script completed successfully")
 
 
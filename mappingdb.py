@@ -0,0 +1,135 @@
+import argparse
+import json
+import math
+import sqlite3
+
+from utils import MAPPING_SUMMARY_TABLES, MAPPING_VIEW, MAPPING_VIEW_COLUMNS
+
+
+class MappingDatabase:
+
+    def __init__(self, file_name="output/mapping"):
+        """
+        Answers the common questions about a mapping database written by write_mapping_columns or the
+        StreamingClassifier. The aggregates are read from the summary tables and the rows through the indexes,
+        so no query scans the whole mapping table. The database is opened read-only with the plain sqlite3 module.
+        :param file_name: the name of the database, without the .db extension
+        """
+        self.file_name = file_name
+        self._connection = sqlite3.connect("file:{}.db?mode=ro".format(file_name), uri=True,
+                                           check_same_thread=False)
+        tables = {row[0] for row in self._connection.execute("SELECT name FROM sqlite_master")}
+        missing = [name for name in MAPPING_SUMMARY_TABLES + (MAPPING_VIEW,) if name not in tables]
+        if missing:
+            self._connection.close()
+            raise ValueError("{}.db has no {}, it was not finalized, see utils.finalize_mapping".format(
+                file_name, missing))
+
+    def match_counts(self):
+        """
+        Counts the points per ideal function.
+        :return: dictionary mapping the names of the ideal functions to their number of points,
+                 "-" holds the points without classification
+        """
+        return dict(self._connection.execute("SELECT ideal_function, points FROM mapping_counts "
+                                             "ORDER BY ideal_function"))
+
+    @property
+    def number_of_points(self):
+        """
+        The number of rows of the mapping table.
+        :return: number of points, classified or not
+        """
+        return sum(self.match_counts().values())
+
+    def delta_statistics(self):
+        """
+        Describes the deltas of the points of every ideal function.
+        :return: dictionary mapping the names of the ideal functions to a dictionary with the number of points
+                 and the minimum, maximum, mean and standard deviation of their deltas
+        """
+        statistics = {}
+        for name, points, minimum, maximum, mean, mean_square in self._connection.execute(
+                "SELECT ideal_function, points, min_delta, max_delta, mean_delta, mean_square_delta "
+                "FROM mapping_delta_statistics ORDER BY ideal_function"):
+            # Rounding can make the variance slightly negative if all deltas are equal
+            statistics[name] = {"points": points, "min": minimum, "max": maximum, "mean": mean,
+                                "std": math.sqrt(max(0.0, mean_square - mean * mean))}
+        return statistics
+
+    def delta_histogram(self, ideal_function):
+        """
+        The histogram of the deltas of one ideal function, equal-width bins between the smallest and the largest
+        delta, see utils.finalize_mapping. Empty bins are filled in with a count of zero.
+        :param ideal_function: the name of the ideal function, e.g. "N1"
+        :return: list of tuples (lower delta, upper delta, number of points), empty if the function has no points
+        """
+        extremes = self._connection.execute("SELECT min_delta, max_delta FROM mapping_delta_statistics "
+                                            "WHERE ideal_function = ?", (ideal_function,)).fetchone()
+        if extremes is None:
+            return []
+        rows = self._connection.execute("SELECT bin, lower_delta, upper_delta, points FROM mapping_histogram "
+                                        "WHERE ideal_function = ? ORDER BY bin", (ideal_function,)).fetchall()
+        counts = {row[0]: row[3] for row in rows}
+        minimum, maximum = extremes
+        width = rows[0][2] - rows[0][1]
+        # Only the non-empty bins are stored, their number follows from the width
+        number_of_bins = round((maximum - minimum) / width) if width > 0 else 1
+        return [(minimum + position * width, minimum + (position + 1) * width, counts.get(position, 0))
+                for position in range(number_of_bins)]
+
+    def worst_deviations(self, limit=10, ideal_function=None):
+        """
+        Retrieves the classified points with the largest deltas.
+        :param limit: the number of points
+        :param ideal_function: optional name of an ideal function, defaults to all of them
+        :return: list of tuples (x, y, delta, ideal function), the largest delta first
+        """
+        if ideal_function is not None:
+            return self._query("WHERE ideal_function = ? ORDER BY delta_y DESC LIMIT ?", (ideal_function, limit))
+        # The worst points of every function are read through the index and merged, which reads at most
+        # limit points per function instead of sorting all of them
+        points = []
+        for name in self.match_counts():
+            if name != "-":
+                points.extend(self.worst_deviations(limit, name))
+        return sorted(points, key=lambda point: point[2], reverse=True)[:limit]
+
+    def points_in_range(self, lowest_x, highest_x, ideal_function=None):
+        """
+        Retrieves the points within a range of X, both limits inclusive.
+        :param lowest_x: the lowest x
+        :param highest_x: the highest x
+        :param ideal_function: optional name of an ideal function, "-" for points without classification
+        :return: list of tuples (x, y, delta, ideal function), ordered by x
+        """
+        names = list(self.match_counts()) if ideal_function is None else [ideal_function]
+        # Listing the functions lets SQLite seek the range of X once per function in the index
+        return self._query("WHERE ideal_function IN ({}) AND x BETWEEN ? AND ? ORDER BY x".format(
+            ", ".join("?" for _ in names)), names + [lowest_x, highest_x])
+
+    def _query(self, clause, parameters):
+        # The view only renames the columns, SQLite resolves it to the mapping table and uses its indexes
+        return self._connection.execute("SELECT {} FROM {} {}".format(", ".join(MAPPING_VIEW_COLUMNS), MAPPING_VIEW,
+                                                                      clause), parameters).fetchall()
+
+    def close(self):
+        self._connection.close()
+
+    def __repr__(self):
+        return "Mapping database {}.db with {} points".format(self.file_name, self.number_of_points)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Prints the summaries of a mapping database")
+    parser.add_argument("--database", default="output/mapping", help="the database, without the .db extension")
+    parser.add_argument("--worst", type=int, default=10, help="number of points with the largest deltas")
+    arguments = parser.parse_args()
+
+    mapping_database = MappingDatabase(arguments.database)
+    print(mapping_database)
+    print(json.dumps({"matches": mapping_database.match_counts(), "deltas": mapping_database.delta_statistics()},
+                     indent=2))
+    for point in mapping_database.worst_deviations(arguments.worst):
+        print("x={:<10g} y={:<12g} delta={:<12g} {}".format(*point))
+    mapping_database.close()
@@ -0,0 +1,128 @@
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from function import IdealFunction
+from instrumentation import instrumented
+from lossfunction import loss_name
+from regression import compute_error_matrix
+
+# State of a worker process, set once by _attach_worker
+_worker_state = {}
+
+
+def share_block(block):
+    """
+    Copies a 2-D block into a new shared memory segment, column-major like the block of a FunctionManager.
+    The caller is responsible for closing and unlinking the segment.
+    :param block: the array to share
+    :return: a tuple of the SharedMemory object and a description that lets other processes attach to it
+    """
+    segment = shared_memory.SharedMemory(create=True, size=max(1, block.nbytes))
+    shared = np.ndarray(block.shape, dtype=block.dtype, buffer=segment.buf, order="F")
+    shared[:] = block
+    description = {"name": segment.name, "shape": block.shape, "dtype": block.dtype.str}
+    return segment, description
+
+
+def attach_block(description):
+    """
+    Attaches to a block shared with share_block. No data is copied.
+    :param description: the description returned by share_block
+    :return: a tuple of the SharedMemory object, which must be kept alive while the array is used, and the array
+    """
+    segment = shared_memory.SharedMemory(name=description["name"])
+    block = np.ndarray(description["shape"], dtype=np.dtype(description["dtype"]), buffer=segment.buf, order="F")
+    return segment, block
+
+
+def _attach_worker(description, training_block, loss_name, top_k):
+    # Runs once per worker process: the candidate block is attached instead of being pickled with every task
+    segment, candidate_block = attach_block(description)
+    _worker_state.update(segment=segment, candidate_block=candidate_block, training_block=training_block,
+                         loss_name=loss_name, top_k=top_k)
+
+
+def _search_shard(start, end):
+    # Computes the errors of one shard of candidate columns and keeps only the best top_k per training function
+    errors = compute_error_matrix(_worker_state["training_block"], _worker_state["candidate_block"][:, start:end],
+                                  _worker_state["loss_name"])
+    return _top_k(errors, np.arange(start, end), _worker_state["top_k"])
+
+
+def _top_k(errors, columns, top_k):
+    # Sorts each row by error and, on equal errors, by column, so ties resolve like argmin in the serial path
+    columns = np.broadcast_to(columns, errors.shape)
+    order = np.lexsort((columns, errors), axis=1)[:, :top_k]
+    return np.take_along_axis(columns, order, axis=1), np.take_along_axis(errors, order, axis=1)
+
+
+def search_candidates_parallel(training_block, candidate_block, loss_function, workers=None, shard_size=None,
+                               top_k=1):
+    """
+    Finds the best candidates for every training function by splitting the candidate columns into shards that are
+    searched by a pool of processes. The workers read the candidate block from shared memory.
+    :param training_block: array of shape (n, k) with the y-values of the training functions
+    :param candidate_block: array of shape (n, m) with the y-values of the candidate functions
+    :param loss_function: a registered loss, either by name or as the pairwise loss function
+    :param workers: number of worker processes, defaults to the number of CPUs
+    :param shard_size: number of candidate columns per task, defaults to an even split over the workers
+    :param top_k: number of best candidates returned per training function
+    :return: a tuple of two arrays of shape (k, top_k): the candidate columns and their errors, best first
+    """
+    workers = workers or os.cpu_count() or 1
+    number_of_candidates = candidate_block.shape[1]
+    shard_size = shard_size or max(1, math.ceil(number_of_candidates / workers))
+    if shard_size < 1:
+        raise ValueError("shard_size must be at least 1")
+    top_k = min(top_k, number_of_candidates)
+
+    segment, description = share_block(np.asfortranarray(candidate_block))
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_attach_worker,
+                                 initargs=(description, np.ascontiguousarray(training_block),
+                                           loss_name(loss_function), top_k)) as executor:
+            starts = range(0, number_of_candidates, shard_size)
+            ends = [min(start + shard_size, number_of_candidates) for start in starts]
+            shard_results = list(executor.map(_search_shard, starts, ends))
+    finally:
+        segment.close()
+        segment.unlink()
+
+    # The local winners of all shards are reduced to the global top_k
+    columns = np.concatenate([result[0] for result in shard_results], axis=1)
+    errors = np.concatenate([result[1] for result in shard_results], axis=1)
+    order = np.lexsort((columns, errors), axis=1)[:, :top_k]
+    return np.take_along_axis(columns, order, axis=1), np.take_along_axis(errors, order, axis=1)
+
+
+@instrumented("minimise_loss_parallel",
+              rows=lambda result, training_function_manager, *args, **kwargs: len(training_function_manager.x_values))
+def minimise_loss_parallel(training_function_manager, candidate_function_manager, loss_function, workers=None,
+                           shard_size=None):
+    """
+    Produces one IdealFunction per training function, like minimise_loss_batch, but searches the candidates with a
+    pool of processes. The selection and the errors are identical to the serial path.
+    :param training_function_manager: FunctionManager holding the training functions
+    :param candidate_function_manager: FunctionManager holding the candidate functions
+    :param loss_function: a registered loss, either by name or as the pairwise loss function
+    :param workers: number of worker processes, defaults to the number of CPUs
+    :param shard_size: number of candidate columns per task, defaults to an even split over the workers
+    :return: a list of IdealFunction objects in the order of the training functions
+    """
+    if not np.array_equal(training_function_manager.x_values, candidate_function_manager.x_values):
+        raise ValueError("Training and candidate functions must share the same x-values")
+
+    columns, errors = search_candidates_parallel(training_function_manager.y_values,
+                                                 candidate_function_manager.y_values, loss_function,
+                                                 workers=workers, shard_size=shard_size)
+
+    ideal_functions = []
+    for row, training_function in enumerate(training_function_manager.functions):
+        ideal_function = IdealFunction(function=candidate_function_manager.functions[columns[row, 0]],
+                                       training_function=training_function, error=float(errors[row, 0]))
+        ideal_functions.append(ideal_function)
+    return ideal_functions
@@ -0,0 +1,484 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import numpy as np
+
+from bootstrap import bootstrap_selection
+from csvcache import hash_file
+from function import FunctionManager, IdealFunction, SQLFunctionManager
+from lossfunction import loss_name
+from regression import classify_points, minimise_loss_batch
+from streaming import StreamingClassifier
+from utils import classification_names, write_mapping_columns
+from whatif import DeviationMatrix
+
+# The manifest and the cached results are kept in this directory below the output directory
+CACHE_DIRECTORY = ".pipeline"
+
+
+class Stage:
+
+    def __init__(self, name, function, dependencies=(), inputs=(), parameters=None, outputs=(), cache=None):
+        """
+        Describes one step of a Pipeline.
+        :param name: the name of the stage
+        :param function: callable receiving the results of the dependencies, in their order, and returning the result
+        :param dependencies: the names of the stages whose results the function needs
+        :param inputs: paths of files the stage reads, their content is part of the key
+        :param parameters: dictionary of JSON-serialisable parameters that are part of the key
+        :param outputs: paths of files the stage writes. The stage is skipped while the key is unchanged and the files
+                        are the ones it wrote, i.e. still exist with the recorded size and modification time
+        :param cache: "json" or "npz" to keep the result on disk, None if the result is not cached
+        """
+        if cache not in (None, "json", "npz"):
+            raise ValueError("Unknown cache format {}".format(cache))
+        self.name = name
+        self.function = function
+        self.dependencies = tuple(dependencies)
+        self.inputs = tuple(inputs)
+        self.parameters = parameters or {}
+        self.outputs = tuple(outputs)
+        self.cache = cache
+
+    def __repr__(self):
+        return "Stage {} depending on {}".format(self.name, list(self.dependencies))
+
+
+class Pipeline:
+
+    def __init__(self, stages, cache_directory, force=False):
+        """
+        Runs a graph of stages and skips every stage whose inputs did not change since the last run.
+        Every stage is keyed by a hash of the files it reads, its parameters and the keys of its dependencies,
+        so a change propagates to all stages downstream and to nothing else.
+        Results are resolved lazily: a stage whose result is cached does not run its dependencies at all.
+        :param stages: list of Stage objects, the dependencies of a stage must be part of the list
+        :param cache_directory: the directory for the manifest of keys and the cached results
+        :param force: if True, every stage runs regardless of the manifest
+        """
+        self.stages = {stage.name: stage for stage in stages}
+        for stage in stages:
+            missing = [name for name in stage.dependencies if name not in self.stages]
+            if missing:
+                raise ValueError("Stage {} depends on unknown stages {}".format(stage.name, missing))
+        self.cache_directory = cache_directory
+        self.force = force
+
+        self._manifest_path = os.path.join(cache_directory, "manifest.json")
+        try:
+            with open(self._manifest_path) as file:
+                self._manifest = json.load(file)
+        except (OSError, ValueError):
+            self._manifest = {}
+
+        self._file_hashes = {}
+        self._keys = {}
+        self.results = {}
+        # For every resolved stage: "ran", "cached" (result loaded from disk) or "skipped" (outputs up to date)
+        self.status = {}
+        self.seconds = {}
+        self.wall_seconds = None
+        self._lock = threading.Lock()
+
+    def _hash_input(self, path):
+        if path not in self._file_hashes:
+            self._file_hashes[path] = hash_file(path)
+        return self._file_hashes[path]
+
+    def key(self, name):
+        """
+        Computes the key of a stage without running anything but hashing its input files.
+        :param name: the name of the stage
+        :return: the key as hexadecimal SHA-256 digest
+        """
+        if name not in self._keys:
+            stage = self.stages[name]
+            description = {"name": name, "parameters": stage.parameters,
+                           "inputs": [self._hash_input(path) for path in stage.inputs],
+                           "dependencies": [self.key(dependency) for dependency in stage.dependencies]}
+            self._keys[name] = hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+        return self._keys[name]
+
+    def _cache_path(self, stage):
+        return os.path.join(self.cache_directory, "{}.{}".format(stage.name, stage.cache))
+
+    @staticmethod
+    def _fingerprint(path):
+        # Size and modification time tell whether a file was changed or replaced since the stage wrote it
+        try:
+            status = os.stat(path)
+        except OSError:
+            return None
+        return {"size": status.st_size, "mtime_ns": status.st_mtime_ns}
+
+    def is_up_to_date(self, name):
+        """
+        Checks whether a stage can be skipped: its key matches the last run, its cached result exists and its outputs
+        are unchanged since it wrote them. An output that was deleted, modified or replaced outside the pipeline makes
+        the stage run again. Stages that neither write files nor cache their result are never up to date.
+        :param name: the name of the stage
+        :return: True if the stage does not need to run
+        """
+        stage = self.stages[name]
+        if self.force or not (stage.outputs or stage.cache):
+            return False
+        entry = self._manifest.get(name, {})
+        if entry.get("key") != self.key(name):
+            return False
+        if stage.cache and not os.path.exists(self._cache_path(stage)):
+            return False
+        fingerprints = entry.get("outputs")
+        # Manifests written before the fingerprints were recorded only list the outputs, they are rewritten
+        if not isinstance(fingerprints, dict):
+            return not stage.outputs
+        return all(fingerprints.get(path) is not None and self._fingerprint(path) == fingerprints[path]
+                   for path in stage.outputs)
+
+    def result(self, name):
+        """
+        Returns the result of a stage, loading it from the cache or running the stage and its dependencies as needed.
+        :param name: the name of the stage
+        :return: the result of the stage, None for stages that only write files and were skipped
+        """
+        if name in self.results:
+            return self.results[name]
+
+        stage = self.stages[name]
+        started = time.perf_counter()
+        if self.is_up_to_date(name):
+            self.results[name] = self._load(stage) if stage.cache else None
+            self.status[name] = "cached" if stage.cache else "skipped"
+        else:
+            arguments = [self.result(dependency) for dependency in stage.dependencies]
+            # The dependencies are timed on their own, only the stage itself counts here
+            started = time.perf_counter()
+            self.results[name] = stage.function(*arguments)
+            if stage.cache:
+                self._save(stage, self.results[name])
+            self.status[name] = "ran"
+            if stage.outputs or stage.cache:
+                self._record(name)
+        self.seconds[name] = time.perf_counter() - started
+        return self.results[name]
+
+    def _targets(self, targets):
+        # By default, all stages no other stage depends on are resolved
+        if targets is not None:
+            return list(targets)
+        needed = {dependency for stage in self.stages.values() for dependency in stage.dependencies}
+        return [name for name in self.stages if name not in needed]
+
+    def plan(self, targets=None):
+        """
+        Lists the stages that have to be resolved for the targets, every stage after its dependencies.
+        The dependencies of a stage that is up to date are only part of the plan if another stage needs them.
+        :param targets: names of the stages to resolve, defaults to all stages no other stage depends on
+        :return: list of stage names
+        """
+        targets = self._targets(targets)
+
+        plan = []
+        planned = set()
+
+        def visit(name):
+            if name in planned:
+                return
+            planned.add(name)
+            if not self.is_up_to_date(name):
+                for dependency in self.stages[name].dependencies:
+                    visit(dependency)
+            plan.append(name)
+
+        for name in targets:
+            visit(name)
+        return plan
+
+    @property
+    def summed_stage_seconds(self):
+        """
+        The sum of the times of the resolved stages. After a serial run, this is its wall time apart from scheduling.
+        After a concurrent run it is not the time a serial run would take: the stage times include waiting for the
+        CPU and the GIL, so comparing the sum with the wall time overstates the speed-up. The wall times of a serial
+        and a concurrent run are compared by benchmark.py --stage-workers, see benchmark.measure_pipeline.
+        :return: the sum of the stage times in seconds
+        """
+        return sum(self.seconds.values())
+
+    def run(self, targets=None, workers=None):
+        """
+        Resolves the target stages.
+        With several workers, the stages are scheduled on a thread pool as soon as their dependencies are resolved,
+        so independent stages like the exports, the fit and the plots overlap. Most of their time is spent in I/O or
+        in C code that releases the GIL.
+        :param targets: names of the stages to resolve, defaults to all stages no other stage depends on
+        :param workers: number of threads, None or 1 resolves the stages one after the other
+        :return: dictionary mapping the names of the targets to their results
+        """
+        started = time.perf_counter()
+        targets = self._targets(targets)
+        plan = self.plan(targets)
+        if workers and workers > 1:
+            self._run_concurrently(plan, workers)
+        else:
+            for name in plan:
+                self.result(name)
+        self.wall_seconds = time.perf_counter() - started
+        return {name: self.results[name] for name in targets}
+
+    def _run_concurrently(self, plan, workers):
+        # Stages that run wait for their dependencies, stages that are up to date can be resolved right away
+        waiting = {name: set() if self.is_up_to_date(name) else set(self.stages[name].dependencies) for name in plan}
+        running = {}
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while waiting or running:
+                for name in [name for name, dependencies in waiting.items() if not dependencies]:
+                    del waiting[name]
+                    running[executor.submit(self.result, name)] = name
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    # Raises the exception of a failed stage, the stages already running are finished first
+                    future.result()
+                    for dependencies in waiting.values():
+                        dependencies.discard(name)
+
+    def _load(self, stage):
+        path = self._cache_path(stage)
+        if stage.cache == "json":
+            with open(path) as file:
+                return json.load(file)
+        with np.load(path) as archive:
+            return {name: archive[name] for name in archive.files}
+
+    def _save(self, stage, result):
+        # Written under a temporary name and moved in place, so an interrupted run never leaves a broken cache
+        os.makedirs(self.cache_directory, exist_ok=True)
+        path = self._cache_path(stage)
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "wb") as file:
+            if stage.cache == "json":
+                file.write(json.dumps(result).encode())
+            else:
+                np.savez(file, **result)
+        os.replace(temporary_path, path)
+
+    def _record(self, name):
+        # The key is stored only after the stage finished, so a failed stage runs again next time.
+        # Other stages writing the same files, e.g. persist and stream, are out of date from now on.
+        # The fingerprints of the outputs are taken once they are written, see is_up_to_date
+        outputs = {path: self._fingerprint(path) for path in self.stages[name].outputs}
+        with self._lock:
+            for other, entry in list(self._manifest.items()):
+                if other != name and set(entry.get("outputs", [])) & set(outputs):
+                    del self._manifest[other]
+            self._manifest[name] = {"key": self.key(name), "outputs": outputs}
+            os.makedirs(self.cache_directory, exist_ok=True)
+            temporary_path = self._manifest_path + ".tmp"
+            with open(temporary_path, "w") as file:
+                json.dump(self._manifest, file, indent=2, sort_keys=True)
+            os.replace(temporary_path, self._manifest_path)
+
+    def __repr__(self):
+        lines = ["Pipeline with {} stages".format(len(self.stages))]
+        for name in self.stages:
+            if name in self.status:
+                lines.append("  {:<16} {:<8} {:.4f}s".format(name, self.status[name], self.seconds[name]))
+            else:
+                lines.append("  {:<16} not needed".format(name))
+        if self.wall_seconds is not None:
+            lines.append("Wall time {:.4f}s, sum of stage times {:.4f}s".format(self.wall_seconds,
+                                                                               self.summed_stage_seconds))
+        return "\n".join(lines)
+
+
+def is_pipeline_output(path):
+    """
+    Checks whether a file is written by a stage of the pipeline of its directory, i.e. the pipeline keeping its
+    manifest in the CACHE_DIRECTORY next to the file, as assignment_pipeline does.
+    :param path: local path of the file
+    :return: True if the manifest lists the file as the output of a stage
+    """
+    manifest_path = os.path.join(os.path.dirname(path), CACHE_DIRECTORY, "manifest.json")
+    try:
+        with open(manifest_path) as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        return False
+    # The outputs are compared as absolute paths, the manifest stores them as they were given to the stages
+    outputs = {os.path.abspath(output) for entry in manifest.values() for output in entry.get("outputs", [])}
+    return os.path.abspath(path) in outputs
+
+
+def selection_of(ideal_functions):
+    """
+    Describes fitted ideal functions by names and errors, which is all that is needed to restore them.
+    :param ideal_functions: list of IdealFunction objects
+    :return: list of dictionaries with the names of training and candidate function and the error
+    """
+    return [{"training": ideal_function.training_function.name, "candidate": ideal_function.name,
+             "error": float(ideal_function.error)} for ideal_function in ideal_functions]
+
+
+def restore_ideal_functions(selection, training_function_manager, candidate_function_manager, tolerance_factor=1):
+    """
+    Rebuilds the IdealFunction objects of a selection without fitting again.
+    :param selection: list of dictionaries as returned by selection_of
+    :param training_function_manager: FunctionManager holding the training functions
+    :param candidate_function_manager: FunctionManager holding the candidate functions
+    :param tolerance_factor: the tolerance_factor set on every IdealFunction
+    :return: a list of IdealFunction objects in the order of the selection
+    """
+    training_functions = {function.name: function for function in training_function_manager}
+    candidate_functions = {function.name: function for function in candidate_function_manager}
+    ideal_functions = []
+    for item in selection:
+        ideal_function = IdealFunction(function=candidate_functions[item["candidate"]],
+                                       training_function=training_functions[item["training"]], error=item["error"])
+        ideal_function.tolerance_factor = tolerance_factor
+        ideal_functions.append(ideal_function)
+    return ideal_functions
+
+
+def assignment_pipeline(train_path, ideal_path, test_path, accepted_factor, output_directory="output",
+                        loss_function="squared_error", fit=minimise_loss_batch, use_cache=False, chunk_size=None,
+                        show_plot=True, force=False, progress=None, from_database=False, parser="pandas",
+                        bootstrap_resamples=None, fast_load=False):
+    """
+    Builds the pipeline of main.py: load, export, fit, classify, persist and plot.
+    Changing only the test data reruns classify, persist and the point plot, the export and the fit are skipped.
+    :param train_path: local path of the training CSV
+    :param ideal_path: local path of the CSV with the candidate functions
+    :param test_path: local path of the test CSV
+    :param accepted_factor: the tolerance factor of the ideal functions
+    :param output_directory: the directory of the databases, the plots and the cache
+    :param loss_function: a registered loss, either by name or as the pairwise loss function
+    :param fit: callable(training_function_manager, candidate_function_manager, loss_function) returning the
+                ideal functions, e.g. minimise_loss_batch or a configured minimise_loss_parallel.
+                All fitting paths select the same functions, so the choice is not part of the key
+    :param use_cache: if True, the CSVs are memory-mapped from their binary cache, see FunctionManager
+    :param chunk_size: if set, the test data is streamed in chunks of this size and the point plot is skipped
+    :param show_plot: if True, the plots are opened in the browser, otherwise they are only saved
+    :param force: if True, every stage runs regardless of the cache
+    :param progress: optional callable receiving the StreamingClassifier after every chunk in streaming mode
+    :param from_database: if True, the ideal functions used after the fit are read from training.db and ideal.db,
+                          only the columns of the selected functions. The CSVs are then only parsed for fitting
+    :param parser: "pandas" or "numpy", see read_csv_block. Stages load their heavy dependencies when they run,
+                   so with "numpy", running only the targets up to "classify" imports neither Pandas, SQLAlchemy
+                   nor Bokeh
+    :param bootstrap_resamples: if set, a "stability" stage resamples the training rows this many times and reports
+                                how often every candidate wins, see bootstrap_selection
+    :param fast_load: if True, the databases are written with relaxed durability, see database.FAST_LOAD_PRAGMAS.
+                      The written rows are the same, so the flag is not part of the key
+    :return: the Pipeline
+    """
+    name_of_loss = loss_name(loss_function)
+
+    def path(name):
+        return os.path.join(output_directory, name)
+
+    def export(train_function_manager, candidate_function_manager):
+        # The suffix is added to conform to the requirement of the table structure
+        return (train_function_manager.to_sql(file_name=path("training"), suffix=" (training func)",
+                                              fast_load=fast_load),
+                candidate_function_manager.to_sql(file_name=path("ideal"), suffix=" (ideal func)",
+                                                  fast_load=fast_load))
+
+    def fit_stage(train_function_manager, candidate_function_manager):
+        return selection_of(fit(train_function_manager, candidate_function_manager, name_of_loss))
+
+    def stability(train_function_manager, candidate_function_manager):
+        return bootstrap_selection(train_function_manager, candidate_function_manager, name_of_loss,
+                                   resamples=bootstrap_resamples).to_dict()
+
+    def ideal_functions_stage(train_function_manager, candidate_function_manager, selection):
+        return restore_ideal_functions(selection, train_function_manager, candidate_function_manager,
+                                       tolerance_factor=accepted_factor)
+
+    def ideal_functions_from_database(export_result, selection):
+        # dict.fromkeys drops duplicates, several training functions can select the same candidate
+        train_function_manager = SQLFunctionManager(path("training"), names=list(dict.fromkeys(
+            item["training"] for item in selection)))
+        candidate_function_manager = SQLFunctionManager(path("ideal"), names=list(dict.fromkeys(
+            item["candidate"] for item in selection)))
+        return restore_ideal_functions(selection, train_function_manager, candidate_function_manager,
+                                       tolerance_factor=accepted_factor)
+
+    def classify(ideal_functions, test_function_manager):
+        test_function = test_function_manager.functions[0]
+        assigned, deltas = classify_points(x_values=test_function.x, y_values=test_function.y,
+                                           ideal_functions=ideal_functions)
+        # The columns of the mapping table are cached, so persisting needs no ideal functions
+        names = classification_names(ideal_functions, assigned).astype(str)
+        return {"x": test_function.x, "y": test_function.y, "assigned": assigned, "deltas": deltas, "names": names}
+
+    def deviations(ideal_functions, test_function_manager):
+        # Stored for what-if questions about the tolerance factor, see whatif.py
+        test_function = test_function_manager.functions[0]
+        DeviationMatrix.from_ideal_functions(test_function.x, test_function.y, ideal_functions).save(
+            path("deviations.npz"))
+
+    def persist(classification):
+        return write_mapping_columns(classification["x"], classification["y"],
+                                     np.where(classification["assigned"] < 0, -1, classification["deltas"]),
+                                     classification["names"], file_name=path("mapping"), fast_load=fast_load)
+
+    def plot_ideal(ideal_functions):
+        # Bokeh is the most expensive import of all, it is only paid if a plot is actually drawn
+        from plotting import plot_ideal_functions
+
+        plot_ideal_functions(ideal_functions, path("train_and_ideal"), show_plot=show_plot)
+
+    def plot_points(ideal_functions, classification):
+        from plotting import plot_classification_overview
+
+        plot_classification_overview(ideal_functions, classification["x"], classification["y"],
+                                     classification["assigned"], path("point_and_ideal"), show_plot=show_plot)
+
+    def load(path_of_csv):
+        return FunctionManager(path_of_csv=path_of_csv, use_cache=use_cache, parser=parser)
+
+    def stream(ideal_functions):
+        streaming_classifier = StreamingClassifier(ideal_functions, chunk_size=chunk_size, progress=progress,
+                                                  parser=parser)
+        streaming_classifier.classify_csv(test_path, file_name=path("mapping"), fast_load=fast_load)
+        return streaming_classifier
+
+    stages = [
+        # The parsers can differ in the last bit of a value, so the parser is part of the key
+        Stage("load_train", lambda: load(train_path), inputs=[train_path], parameters={"parser": parser}),
+        Stage("load_ideal", lambda: load(ideal_path), inputs=[ideal_path], parameters={"parser": parser}),
+        Stage("export", export, dependencies=["load_train", "load_ideal"],
+              outputs=[path("training.db"), path("ideal.db")]),
+        Stage("fit", fit_stage, dependencies=["load_train", "load_ideal"], parameters={"loss": name_of_loss},
+              cache="json"),
+        Stage("ideal_functions", ideal_functions_from_database, dependencies=["export", "fit"],
+              parameters={"accepted_factor": accepted_factor})
+        if from_database else
+        Stage("ideal_functions", ideal_functions_stage, dependencies=["load_train", "load_ideal", "fit"],
+              parameters={"accepted_factor": accepted_factor}),
+        Stage("plot_ideal", plot_ideal, dependencies=["ideal_functions"], outputs=[path("train_and_ideal.html")]),
+    ]
+    if bootstrap_resamples:
+        stages.append(Stage("stability", stability, dependencies=["load_train", "load_ideal"],
+                            parameters={"loss": name_of_loss, "resamples": bootstrap_resamples}, cache="json"))
+    if chunk_size:
+        # In streaming mode, the test CSV is read, classified and written to mapping.db chunk by chunk.
+        # Memory stays flat regardless of the size of the test data, so the per-point plot is skipped
+        stages.append(Stage("stream", stream, dependencies=["ideal_functions"], inputs=[test_path],
+                            parameters={"chunk_size": chunk_size, "parser": parser},
+                            outputs=[path("mapping.db")]))
+    else:
+        stages += [
+            Stage("load_test", lambda: load(test_path), inputs=[test_path], parameters={"parser": parser}),
+            Stage("classify", classify, dependencies=["ideal_functions", "load_test"], cache="npz"),
+            Stage("persist", persist, dependencies=["classify"], outputs=[path("mapping.db")]),
+            Stage("deviations", deviations, dependencies=["ideal_functions", "load_test"],
+                  outputs=[path("deviations.npz")]),
+            Stage("plot_points", plot_points, dependencies=["ideal_functions", "classify"],
+                  outputs=[path("point_and_ideal.html")]),
+        ]
+    return Pipeline(stages, os.path.join(output_directory, CACHE_DIRECTORY), force=force)
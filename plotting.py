@@ -1,38 +1,58 @@
-from bokeh.plotting import figure, output_file, show
+import numpy as np
+from bokeh.plotting import figure, output_file, save, show
 from bokeh.layouts import column, grid
 from bokeh.models import Band, ColumnDataSource
+from bokeh.palettes import Category10_10, turbo
+from bokeh.resources import CDN
 
+from instrumentation import instrumented
 
-def plot_ideal_functions(ideal_functions, file_name):
+# Above this number of points, plot_classification_overview samples or aggregates the points
+DEFAULT_MAX_POINTS = 20000
+
+
+@instrumented("plot_ideal_functions")
+def plot_ideal_functions(ideal_functions, file_name, show_plot=True):
     """
     Generates plots for all ideal functions.
     :param ideal_functions: list of ideal functions
     :param file_name: the desired name for the .html file
+    :param show_plot: if True, the file is opened in the browser, otherwise it is only saved
     """
-    ideal_functions.sort(key=lambda ideal_function: ideal_function.training_function.name, reverse=False)
+    # sorted() returns a new list, the list of the caller stays untouched
+    ideal_functions = sorted(ideal_functions, key=lambda ideal_function: ideal_function.training_function.name)
     plots = []
     for ideal_function in ideal_functions:
         p = plot_graph_from_two_functions(line_function=ideal_function, scatter_function=ideal_function.training_function,
                                           squared_error=ideal_function.error)
         plots.append(p)
-    output_file("{}.html".format(file_name))
     # Unpacking is used here to provide the arguments
-    show(column(*plots))
+    _output(column(*plots), file_name, show_plot)
+
 
+def _output(layout, file_name, show_plot):
+    # show() relies on Bokeh's global output state. save() gets the file and the resources explicitly,
+    # so headless plots can be rendered by several threads at once
+    if show_plot:
+        output_file("{}.html".format(file_name))
+        show(layout)
+    else:
+        save(layout, filename="{}.html".format(file_name), resources=CDN, title="Bokeh Plot")
 
-def plot_points_with_their_ideal_function(points_with_classification, file_name):
+
+def plot_points_with_their_ideal_function(points_with_classification, file_name, show_plot=True):
     """
     Plots all points with their matched classification.
     :param points_with_classification: a list containing dictionaries with "classification" and "point"
     :param file_name: the desired name for the .html file
+    :param show_plot: if True, the file is opened in the browser, otherwise it is only saved
     """
     plots = []
     for index, item in enumerate(points_with_classification):
         if item["classification"] is not None:
             p = plot_classification(item["point"], item["classification"])
             plots.append(p)
-    output_file("{}.html".format(file_name))
-    show(column(*plots))
+    _output(column(*plots), file_name, show_plot)
 
 
 def plot_graph_from_two_functions(scatter_function, line_function, squared_error):
@@ -75,11 +95,10 @@ def plot_classification(point, ideal_function):
                 legend_label="Classification function", line_width=2, line_color='black')
 
         # Procedure to show the tolerance within the graph
+        # The band is computed into a separate data source, so the ideal function itself is not modified
         criterion = ideal_function.tolerance
-        classification_function_dataframe['upper'] = classification_function_dataframe['y'] + criterion
-        classification_function_dataframe['lower'] = classification_function_dataframe['y'] - criterion
-
-        source = ColumnDataSource(classification_function_dataframe.reset_index())
+        source = ColumnDataSource({"x": ideal_function.x, "lower": ideal_function.y - criterion,
+                                   "upper": ideal_function.y + criterion})
 
         band = Band(base='x', lower='lower', upper='upper', source=source, level='underlay',
             fill_alpha=0.3, line_width=1, line_color='green', fill_color="green")
@@ -90,3 +109,76 @@ def plot_classification(point, ideal_function):
         p.scatter([point["x"]], [round(point["y"], 4)], fill_color="red", legend_label="Test point", size=8)
 
         return p
+
+
+@instrumented("plot_classification_overview",
+              rows=lambda result, ideal_functions, x_values, *args, **kwargs: len(x_values))
+def plot_classification_overview(ideal_functions, x_values, y_values, assigned, file_name,
+                                 max_points=DEFAULT_MAX_POINTS, aggregate=False, show_plot=True):
+    """
+    Plots all classified points on a single canvas together with the ideal functions and their tolerance bands.
+    Every ideal function and its band is drawn once from one shared data source, the points are colored by their
+    classification and rendered with WebGL. Above max_points, the points are either sampled down or, with aggregate,
+    replaced by a hexagonal density plot, so the size of the .html file stays bounded no matter how many points there are.
+    :param ideal_functions: list of ideal functions, the points were classified with
+    :param x_values: array with the x-coordinates of the points
+    :param y_values: array with the y-coordinates of the points
+    :param assigned: array with the position of the assigned ideal function (-1 if none), as returned by classify_points
+    :param file_name: the desired name for the .html file
+    :param max_points: the largest number of points that is drawn individually
+    :param aggregate: if True, too many points are shown as density instead of a sample
+    :param show_plot: if True, the file is opened in the browser, otherwise it is only saved
+    """
+    x_values = np.asarray(x_values, dtype=float)
+    y_values = np.asarray(y_values, dtype=float)
+    assigned = np.asarray(assigned)
+    colors = Category10_10 if len(ideal_functions) <= len(Category10_10) else turbo(len(ideal_functions))
+
+    title = "{} points classified with {} ideal functions".format(len(x_values), len(ideal_functions))
+    p = figure(title=title, x_axis_label='x', y_axis_label='y', output_backend="webgl", sizing_mode="stretch_width")
+
+    # All ideal functions share one source. Functions on a different grid are interpolated onto the first one
+    shared_x = ideal_functions[0].x if ideal_functions else np.empty(0)
+    functions = {"x": shared_x}
+    for position, ideal_function in enumerate(ideal_functions):
+        if np.array_equal(ideal_function.x, shared_x):
+            y = ideal_function.y
+        else:
+            y = ideal_function.locate_y_values(shared_x, out_of_range="nan")
+        functions["y{}".format(position)] = y
+        functions["lower{}".format(position)] = y - ideal_function.tolerance
+        functions["upper{}".format(position)] = y + ideal_function.tolerance
+    source = ColumnDataSource(functions)
+
+    for position, ideal_function in enumerate(ideal_functions):
+        color = colors[position]
+        p.add_layout(Band(base="x", lower="lower{}".format(position), upper="upper{}".format(position),
+                          source=source, level="underlay", fill_alpha=0.2, fill_color=color, line_color=color))
+        p.line(x="x", y="y{}".format(position), source=source, line_width=2, line_color=color,
+               legend_label="Ideal {}".format(ideal_function.name))
+
+    if aggregate and len(x_values) > max_points:
+        # The density is computed once and drawn as hexagons, their number does not depend on the number of points
+        size = max(np.ptp(x_values), np.ptp(y_values), 1e-9) / 100
+        p.hexbin(x_values, y_values, size=size, palette="Greys256", fill_alpha=0.6)
+        p.title.text = "{} (density)".format(title)
+    else:
+        if len(x_values) > max_points:
+            # A fixed seed keeps the sample, and with it the resulting file, the same between runs
+            sample = np.sort(np.random.default_rng(0).choice(len(x_values), size=max_points, replace=False))
+            x_values, y_values, assigned = x_values[sample], y_values[sample], assigned[sample]
+            p.title.text = "{} (sample of {})".format(title, max_points)
+
+        # One glyph per classification keeps the data numeric, so no color or label is stored per point
+        unclassified = assigned < 0
+        if unclassified.any():
+            p.scatter(x_values[unclassified], y_values[unclassified], size=4, fill_color="lightgrey",
+                      line_color=None, legend_label="No classification")
+        for position, ideal_function in enumerate(ideal_functions):
+            selected = assigned == position
+            if selected.any():
+                p.scatter(x_values[selected], y_values[selected], size=5, fill_color=colors[position],
+                          line_color=None, legend_label="Points of {}".format(ideal_function.name))
+
+    p.legend.click_policy = "hide"
+    _output(p, file_name, show_plot)
@@ -1,5 +1,14 @@
+import numpy as np
+
 from function import IdealFunction
+from instrumentation import instrumented
+from lossfunction import get_loss
+
+# Upper bound for the number of elements of the temporary deviation block (rows x training x candidates)
+BLOCK_ELEMENTS = 2 ** 22
+
 
+@instrumented("minimise_loss", rows=lambda result, training_function, *args, **kwargs: len(training_function.x))
 def minimise_loss(training_function, list_of_candidate_functions, loss_function):
     """
     Produces an IdealFunction based on a training function and a list of candidate functions.
@@ -21,6 +30,62 @@ def minimise_loss(training_function, list_of_candidate_functions, loss_function)
     return ideal_function
 
 
+def compute_error_matrix(training_block, candidate_block, loss_function):
+    """
+    Computes the loss between every training function and every candidate function in one batched pass.
+    Both blocks must share the same x-values row by row.
+    :param training_block: array of shape (n, k) with the y-values of the training functions
+    :param candidate_block: array of shape (n, m) with the y-values of the candidate functions
+    :param loss_function: a registered loss, either by name or as the pairwise loss function
+    :return: array of shape (k, m) with the loss of each training/candidate pair
+    """
+    reducer = get_loss(loss_function)
+    number_of_rows, number_of_training = training_block.shape
+    number_of_candidates = candidate_block.shape[1]
+
+    # The candidates are processed in slices so the temporary (n, k, slice) deviation block stays bounded
+    slice_width = max(1, BLOCK_ELEMENTS // max(1, number_of_rows * number_of_training))
+    errors = np.empty((number_of_training, number_of_candidates))
+    for start in range(0, number_of_candidates, slice_width):
+        end = min(start + slice_width, number_of_candidates)
+        # The rows are made the contiguous axis, so every pair is reduced in the same order
+        # no matter how the input blocks are laid out or sliced
+        deviations = np.empty((number_of_rows, number_of_training, end - start), order="F")
+        np.subtract(candidate_block[:, None, start:end], training_block[:, :, None], out=deviations)
+        errors[:, start:end] = reducer(deviations)
+    return errors
+
+
+@instrumented("minimise_loss_batch",
+              rows=lambda result, training_function_manager, *args, **kwargs: len(training_function_manager.x_values))
+def minimise_loss_batch(training_function_manager, candidate_function_manager, loss_function):
+    """
+    Produces one IdealFunction per training function by evaluating all candidates at once.
+    This gives the same selection as calling minimise_loss for every training function,
+    but works on the contiguous arrays of the FunctionManagers instead of a DataFrame per pair.
+    :param training_function_manager: FunctionManager holding the training functions
+    :param candidate_function_manager: FunctionManager holding the candidate functions
+    :param loss_function: a registered loss, either by name or as the pairwise loss function
+    :return: a list of IdealFunction objects in the order of the training functions
+    """
+    if not np.array_equal(training_function_manager.x_values, candidate_function_manager.x_values):
+        raise ValueError("Training and candidate functions must share the same x-values")
+
+    errors = compute_error_matrix(training_function_manager.y_values, candidate_function_manager.y_values,
+                                  loss_function)
+    # argmin returns the first candidate on ties, just like the strict comparison in minimise_loss
+    best_candidates = errors.argmin(axis=1)
+
+    ideal_functions = []
+    for row, training_function in enumerate(training_function_manager.functions):
+        column = best_candidates[row]
+        ideal_function = IdealFunction(function=candidate_function_manager.functions[column],
+                                       training_function=training_function, error=float(errors[row, column]))
+        ideal_functions.append(ideal_function)
+    return ideal_functions
+
+
+@instrumented("find_classification", rows=lambda result, *args, **kwargs: 1)
 def find_classification(point, ideal_functions):
     """
     Determines if a point falls within the tolerance of a classification.
@@ -49,3 +114,74 @@ def find_classification(point, ideal_functions):
                 current_lowest_distance = distance
 
     return current_lowest_classification, current_lowest_distance
+
+
+@instrumented("classify_points", rows=lambda result, x_values, *args, **kwargs: len(x_values))
+def classify_points(x_values, y_values, ideal_functions, interpolation=None, out_of_range=None):
+    """
+    Classifies a whole set of points at once. It gives the same result as calling find_classification for every point.
+    Points whose x is not part of an ideal function are interpolated, see Function.locate_y_values.
+    With out_of_range="nan", points outside of an ideal function are simply not classified by it.
+    :param x_values: array with the x-coordinates of the points
+    :param y_values: array with the y-coordinates of the points
+    :param ideal_functions: a list of IdealFunction objects
+    :param interpolation: "linear", "nearest" or "exact", defaults to the interpolation of each ideal function
+    :param out_of_range: "raise", "nan" or "clip", defaults to the out_of_range policy of each ideal function
+    :return: a tuple of two arrays: the position of the assigned ideal function within ideal_functions (-1 if none)
+             and the distance to it (NaN if none)
+    """
+    deviations = compute_deviations(x_values, y_values, ideal_functions, interpolation=interpolation,
+                                    out_of_range=out_of_range)
+    tolerances = np.array([ideal_function.tolerance for ideal_function in ideal_functions], dtype=float)
+    return assign_points(deviations, tolerances)
+
+
+def compute_deviations(x_values, y_values, ideal_functions, interpolation=None, out_of_range=None):
+    """
+    Computes the absolute distance of every point to every ideal function.
+    :param x_values: array with the x-coordinates of the points
+    :param y_values: array with the y-coordinates of the points
+    :param ideal_functions: a list of IdealFunction objects
+    :param interpolation: "linear", "nearest" or "exact", defaults to the interpolation of each ideal function
+    :param out_of_range: "raise", "nan" or "clip", defaults to the out_of_range policy of each ideal function
+    :return: array of shape (number of ideal functions, number of points), NaN where a point is out of range
+    """
+    x_values = np.asarray(x_values, dtype=float)
+    y_values = np.asarray(y_values, dtype=float)
+
+    # One row per ideal function, one column per point
+    deviations = np.empty((len(ideal_functions), len(x_values)))
+    for row, ideal_function in enumerate(ideal_functions):
+        try:
+            located_y = ideal_function.locate_y_values(x_values, interpolation=interpolation,
+                                                       out_of_range=out_of_range)
+        except IndexError:
+            print("This point is not in the classification function")
+            raise
+        # Here, absolute distance is used. NaN deviations never fall within the tolerance
+        deviations[row] = np.abs(located_y - y_values)
+    return deviations
+
+
+def assign_points(deviations, tolerances):
+    """
+    Assigns every point to the closest ideal function whose tolerance it is within.
+    :param deviations: array of shape (number of ideal functions, number of points), see compute_deviations
+    :param tolerances: array with the tolerance of every ideal function
+    :return: a tuple of two arrays: the position of the assigned ideal function (-1 if none)
+             and the distance to it (NaN if none)
+    """
+    number_of_points = deviations.shape[1]
+    if deviations.shape[0] == 0:
+        return np.full(number_of_points, -1), np.full(number_of_points, np.nan)
+
+    # Distances outside the tolerance are excluded, argmin then picks the closest remaining classification.
+    # On equal distances argmin returns the first ideal function, which matches find_classification.
+    within_tolerance = np.where(deviations < np.asarray(tolerances)[:, None], deviations, np.inf)
+    assigned = within_tolerance.argmin(axis=0)
+    deltas = within_tolerance[assigned, np.arange(number_of_points)]
+
+    unmatched = np.isinf(deltas)
+    assigned[unmatched] = -1
+    deltas[unmatched] = np.nan
+    return assigned, deltas
@@ -0,0 +1,185 @@
+import numpy as np
+
+from function import IdealFunction
+from instrumentation import instrumented
+from lossfunction import HUBER_DELTA, get_accumulator, get_loss, loss_name
+from regression import compute_error_matrix
+
+# Relative slack when comparing bounds with the current k-th best error, it protects ties against rounding
+PRUNING_TOLERANCE = 1e-9
+
+
+def _huber_of(deviation):
+    absolute = np.abs(deviation)
+    return np.where(absolute <= HUBER_DELTA, 0.5 * absolute ** 2, HUBER_DELTA * (absolute - 0.5 * HUBER_DELTA))
+
+
+# Cheap lower bounds per loss. They only use the mean and the Euclidean norm of both functions:
+# sum(d^2) >= n * mean(d)^2 and, by the triangle inequality, ||d|| >= | ||c|| - ||t|| |
+def _squared_bound(number_of_rows, mean_difference, norm_difference):
+    return np.maximum(number_of_rows * mean_difference ** 2, norm_difference ** 2)
+
+
+def _absolute_bound(number_of_rows, mean_difference, norm_difference):
+    return np.maximum(number_of_rows * np.abs(mean_difference), np.abs(norm_difference))
+
+
+def _max_absolute_bound(number_of_rows, mean_difference, norm_difference):
+    return np.maximum(np.abs(mean_difference), np.abs(norm_difference) / np.sqrt(number_of_rows))
+
+
+def _huber_bound(number_of_rows, mean_difference, norm_difference):
+    # The Huber loss is convex, so by Jensen's inequality the sum is at least n times the loss of the mean
+    return number_of_rows * _huber_of(mean_difference)
+
+
+# The lower bound of every supported loss
+LOWER_BOUNDS = {
+    "squared_error": _squared_bound,
+    "absolute_error": _absolute_bound,
+    "max_absolute_error": _max_absolute_bound,
+    "huber_loss": _huber_bound,
+}
+
+
+class PrunedSearch:
+
+    def __init__(self, candidate_block, loss_function, block_rows=64, batch_size=256):
+        """
+        Finds the best candidates for training functions without computing the full loss of every candidate.
+        The summary statistics of the candidates are computed once on creation and reused for every search.
+        Candidates whose lower bound already exceeds the current k-th best error are skipped without touching a row,
+        the others are accumulated in blocks of rows and abandoned as soon as their partial loss exceeds it.
+        The winners and their errors are the same as those of the exhaustive search.
+        :param candidate_block: array of shape (n, m) with the y-values of the candidate functions
+        :param loss_function: a registered loss, either by name or as the pairwise loss function
+        :param block_rows: number of rows accumulated before checking for early abandoning
+        :param batch_size: number of candidates that are accumulated together
+        """
+        self.loss_name = loss_name(loss_function)
+        if self.loss_name not in LOWER_BOUNDS:
+            raise KeyError("No lower bound known for {}".format(self.loss_name))
+        self._lower_bound = LOWER_BOUNDS[self.loss_name]
+        self._combine = get_accumulator(self.loss_name)
+        self._reducer = get_loss(self.loss_name)
+
+        self.candidate_block = candidate_block
+        self.block_rows = block_rows
+        self.batch_size = batch_size
+        self.means = candidate_block.mean(axis=0)
+        self.norms = np.sqrt((candidate_block ** 2).sum(axis=0))
+        self._reset_counters()
+
+    def _reset_counters(self):
+        self.candidates_considered = 0
+        self.pruned_by_bound = 0
+        self.abandoned_early = 0
+        self.fully_evaluated = 0
+
+    @property
+    def pruned(self):
+        """
+        The number of candidates that were never fully evaluated during the last search.
+        :return: candidates pruned by their lower bound or abandoned early
+        """
+        return self.pruned_by_bound + self.abandoned_early
+
+    def search(self, training_block, top_k=1):
+        """
+        Searches the best candidates for every training function.
+        :param training_block: array of shape (n, k) with the y-values of the training functions
+        :param top_k: number of best candidates returned per training function
+        :return: a tuple of two arrays of shape (k, top_k): the candidate columns and their errors, best first
+        """
+        self._reset_counters()
+        number_of_candidates = self.candidate_block.shape[1]
+        top_k = min(top_k, number_of_candidates)
+        results = [self._search_one(training_block[:, row], top_k) for row in range(training_block.shape[1])]
+        columns = np.array([result[0] for result in results], dtype=int).reshape(-1, top_k)
+        errors = np.array([result[1] for result in results], dtype=float).reshape(-1, top_k)
+        return columns, errors
+
+    def _search_one(self, training_values, top_k):
+        number_of_rows = len(training_values)
+        bounds = self._lower_bound(number_of_rows, self.means - training_values.mean(),
+                                   self.norms - np.sqrt((training_values ** 2).sum()))
+        # The most promising candidates come first, which tightens the threshold as early as possible
+        order = np.argsort(bounds, kind="stable")
+        self.candidates_considered += len(order)
+
+        # The first top_k candidates are evaluated completely, their k-th best error is the first threshold
+        best_columns, best_errors = self._merge(training_values, order[:top_k], np.empty(0, dtype=int),
+                                                np.empty(0), top_k)
+        if top_k == 0:
+            return best_columns, best_errors
+        threshold = best_errors[-1]
+
+        for start in range(top_k, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            within_bound = bounds[batch] <= threshold * (1 + PRUNING_TOLERANCE)
+            self.pruned_by_bound += len(batch) - int(within_bound.sum())
+
+            survivors = self._accumulate(training_values, batch[within_bound], threshold)
+            best_columns, best_errors = self._merge(training_values, survivors, best_columns, best_errors, top_k)
+            threshold = best_errors[-1]
+
+            # The bounds are sorted, so once one exceeds the threshold, all later ones do as well
+            if not within_bound.all():
+                self.pruned_by_bound += len(order) - start - len(batch)
+                break
+        return best_columns, best_errors
+
+    def _accumulate(self, training_values, columns, threshold):
+        # Accumulates the loss block by block and drops every candidate whose partial loss exceeds the threshold
+        partial = None
+        for start in range(0, len(training_values), self.block_rows):
+            if len(columns) == 0:
+                break
+            rows = slice(start, start + self.block_rows)
+            block_loss = self._reducer(self.candidate_block[rows][:, columns] - training_values[rows, None])
+            partial = block_loss if partial is None else self._combine(partial, block_loss)
+            alive = partial <= threshold * (1 + PRUNING_TOLERANCE)
+            self.abandoned_early += int((~alive).sum())
+            columns = columns[alive]
+            partial = partial[alive]
+        return columns
+
+    def _merge(self, training_values, columns, best_columns, best_errors, top_k):
+        # The survivors are evaluated with the exhaustive engine, so their errors are exactly the same
+        if len(columns) == 0:
+            return best_columns, best_errors
+        self.fully_evaluated += len(columns)
+        errors = compute_error_matrix(training_values[:, None], self.candidate_block[:, columns], self.loss_name)[0]
+        all_columns = np.concatenate([best_columns, columns])
+        all_errors = np.concatenate([best_errors, errors])
+        keep = np.lexsort((all_columns, all_errors))[:top_k]
+        return all_columns[keep], all_errors[keep]
+
+    def __repr__(self):
+        return "Considered {} candidates: {} pruned by bound, {} abandoned early, {} fully evaluated".format(
+            self.candidates_considered, self.pruned_by_bound, self.abandoned_early, self.fully_evaluated)
+
+
+@instrumented("minimise_loss_pruned",
+              rows=lambda result, training_function_manager, *args, **kwargs: len(training_function_manager.x_values))
+def minimise_loss_pruned(training_function_manager, candidate_function_manager, loss_function, search=None):
+    """
+    Produces one IdealFunction per training function, like minimise_loss_batch, but prunes hopeless candidates.
+    :param training_function_manager: FunctionManager holding the training functions
+    :param candidate_function_manager: FunctionManager holding the candidate functions
+    :param loss_function: a registered loss, either by name or as the pairwise loss function
+    :param search: optional PrunedSearch over the candidate block, to reuse its summary statistics
+    :return: a list of IdealFunction objects in the order of the training functions
+    """
+    if not np.array_equal(training_function_manager.x_values, candidate_function_manager.x_values):
+        raise ValueError("Training and candidate functions must share the same x-values")
+
+    search = search or PrunedSearch(candidate_function_manager.y_values, loss_function)
+    columns, errors = search.search(training_function_manager.y_values)
+
+    ideal_functions = []
+    for row, training_function in enumerate(training_function_manager.functions):
+        ideal_function = IdealFunction(function=candidate_function_manager.functions[columns[row, 0]],
+                                       training_function=training_function, error=float(errors[row, 0]))
+        ideal_functions.append(ideal_function)
+    return ideal_functions
@@ -0,0 +1,357 @@
+import argparse
+import collections
+import json
+import math
+import os
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from csvcache import hash_file
+from function import FunctionManager
+from lossfunction import loss_name
+from regression import classify_points, minimise_loss_batch
+
+# A micro-batch is classified once it holds this many points or its first request waited this long
+DEFAULT_BATCH_POINTS = 4096
+DEFAULT_MAX_DELAY = 0.002
+# The training and candidate files are checked for changes at this interval, in seconds
+DEFAULT_RELOAD_INTERVAL = 1.0
+# The latency percentiles are computed over this many recent requests
+LATENCY_WINDOW = 10000
+
+
+class _Request:
+    # A classification request waiting in the queue, the batcher fills in the result and sets the event
+    __slots__ = ("x_values", "y_values", "received", "done", "assigned", "deltas", "names", "error")
+
+    def __init__(self, x_values, y_values):
+        self.x_values = x_values
+        self.y_values = y_values
+        self.received = time.perf_counter()
+        self.done = threading.Event()
+        self.assigned = None
+        self.deltas = None
+        self.names = None
+        self.error = None
+
+
+class ClassificationService:
+
+    def __init__(self, train_path, ideal_path, accepted_factor, loss_function="squared_error",
+                 fit=minimise_loss_batch, batch_points=DEFAULT_BATCH_POINTS, max_delay=DEFAULT_MAX_DELAY,
+                 reload_interval=DEFAULT_RELOAD_INTERVAL, parser="pandas"):
+        """
+        Keeps the candidate functions and the fitted ideal functions in memory and classifies points on demand.
+        Requests arriving at the same time are coalesced into micro-batches, so the vectorized classifier runs once
+        per batch instead of once per request. The ideal functions are fitted again when the CSVs change.
+        Points outside of the range of an ideal function are not classified by it instead of failing the batch.
+        :param train_path: local path of the training CSV
+        :param ideal_path: local path of the CSV with the candidate functions
+        :param accepted_factor: the tolerance factor of the ideal functions
+        :param loss_function: a registered loss, either by name or as the pairwise loss function
+        :param fit: callable(training_function_manager, candidate_function_manager, loss_function) returning the
+                    ideal functions
+        :param batch_points: a batch is closed once it holds this many points
+        :param max_delay: a batch is closed once its first request waited this many seconds
+        :param reload_interval: seconds between the checks for changed CSVs, None disables the hot reload
+        :param parser: "pandas" or "numpy", see read_csv_block
+        """
+        self.train_path = train_path
+        self.ideal_path = ideal_path
+        self.accepted_factor = accepted_factor
+        self.loss_name = loss_name(loss_function)
+        self.fit = fit
+        self.batch_points = batch_points
+        self.max_delay = max_delay
+        self.reload_interval = reload_interval
+        self.parser = parser
+
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._threads = []
+        self._reset_counters()
+        self._file_keys = {}
+        self._hashes = {}
+        self._ideal_functions = None
+        self.load()
+
+    def _reset_counters(self):
+        self.started = time.perf_counter()
+        self.requests = 0
+        self.points = 0
+        self.batches = 0
+        self.reloads = 0
+        self.reload_errors = 0
+        self._latencies = collections.deque(maxlen=LATENCY_WINDOW)
+
+    def _file_key(self, path):
+        status = os.stat(path)
+        return status.st_size, status.st_mtime_ns
+
+    def load(self):
+        """
+        Loads the CSVs and fits the ideal functions. The new model replaces the old one in a single assignment,
+        so requests are always classified by a complete model.
+        """
+        file_keys = {path: self._file_key(path) for path in [self.train_path, self.ideal_path]}
+        hashes = {path: hash_file(path) for path in file_keys}
+        candidate_function_manager = FunctionManager(path_of_csv=self.ideal_path, parser=self.parser)
+        training_function_manager = FunctionManager(path_of_csv=self.train_path, parser=self.parser)
+        ideal_functions = self.fit(training_function_manager, candidate_function_manager, self.loss_name)
+        for ideal_function in ideal_functions:
+            ideal_function.tolerance_factor = self.accepted_factor
+
+        self._ideal_functions = ideal_functions
+        self._file_keys = file_keys
+        self._hashes = hashes
+
+    def has_changed(self):
+        """
+        Checks whether the training or candidate CSV changed since the model was loaded.
+        Size and modification time are compared first, the content hash only if they differ.
+        :return: True if the content of one of the files changed
+        """
+        for path, file_key in self._file_keys.items():
+            current_key = self._file_key(path)
+            if current_key != file_key:
+                if hash_file(path) != self._hashes[path]:
+                    return True
+                self._file_keys[path] = current_key
+        return False
+
+    @property
+    def ideal_functions(self):
+        """
+        The ideal functions currently used for the classification.
+        :return: list of IdealFunction objects
+        """
+        return self._ideal_functions
+
+    def start(self):
+        """
+        Starts the batching thread and, if enabled, the thread watching the CSVs.
+        """
+        self._stopped.clear()
+        self._threads = [threading.Thread(target=self._batch_loop, name="batcher", daemon=True)]
+        if self.reload_interval:
+            self._threads.append(threading.Thread(target=self._reload_loop, name="reloader", daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        """
+        Stops the background threads after the batch currently classified.
+        """
+        self._stopped.set()
+        self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def classify(self, x_values, y_values, timeout=None):
+        """
+        Classifies points. The call blocks until the batch containing the points was classified.
+        :param x_values: sequence with the x-coordinates of the points
+        :param y_values: sequence with the y-coordinates of the points
+        :param timeout: seconds to wait for the result, None waits forever
+        :return: a tuple of three arrays: the position of the assigned ideal function (-1 if none),
+                 the distance to it (NaN if none) and the name of the ideal function (None if none)
+        """
+        x_values = np.asarray(x_values, dtype=float).ravel()
+        y_values = np.asarray(y_values, dtype=float).ravel()
+        if len(x_values) != len(y_values):
+            raise ValueError("Got {} x-values but {} y-values".format(len(x_values), len(y_values)))
+
+        request = _Request(x_values, y_values)
+        self._queue.put(request)
+        if not request.done.wait(timeout):
+            raise TimeoutError("The classification did not finish within {}s".format(timeout))
+        if request.error is not None:
+            raise request.error
+        return request.assigned, request.deltas, request.names
+
+    def _next_batch(self):
+        # Blocks for the first request, then collects more until the batch is full or the delay has passed
+        first = self._queue.get()
+        if first is None:
+            return []
+        batch = [first]
+        number_of_points = len(first.x_values)
+        deadline = time.perf_counter() + self.max_delay
+        while number_of_points < self.batch_points:
+            remaining = deadline - time.perf_counter()
+            try:
+                request = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                self._queue.put(None)
+                break
+            batch.append(request)
+            number_of_points += len(request.x_values)
+        return batch
+
+    def _batch_loop(self):
+        while not self._stopped.is_set():
+            batch = self._next_batch()
+            if batch:
+                self._classify_batch(batch)
+
+    def _classify_batch(self, batch):
+        ideal_functions = self._ideal_functions
+        try:
+            assigned, deltas = classify_points(np.concatenate([request.x_values for request in batch]),
+                                               np.concatenate([request.y_values for request in batch]),
+                                               ideal_functions, out_of_range="nan")
+            names = np.array([ideal_function.name for ideal_function in ideal_functions] + [None],
+                             dtype=object)[assigned]
+        except Exception as error:
+            for request in batch:
+                request.error = error
+                request.done.set()
+            return
+
+        # The results are split along the boundaries of the requests
+        boundaries = np.cumsum([len(request.x_values) for request in batch])[:-1]
+        finished = time.perf_counter()
+        for request, request_assigned, request_deltas, request_names in zip(
+                batch, np.split(assigned, boundaries), np.split(deltas, boundaries), np.split(names, boundaries)):
+            request.assigned, request.deltas, request.names = request_assigned, request_deltas, request_names
+            request.done.set()
+
+        with self._lock:
+            self.batches += 1
+            self.requests += len(batch)
+            self.points += len(assigned)
+            self._latencies.extend(finished - request.received for request in batch)
+
+    def _reload_loop(self):
+        while not self._stopped.wait(self.reload_interval):
+            try:
+                if self.has_changed():
+                    self.load()
+                    with self._lock:
+                        self.reloads += 1
+                    print("Reloaded the ideal functions: {}".format(
+                        [ideal_function.name for ideal_function in self._ideal_functions]))
+            except Exception as error:
+                # A file that is still being written must not stop the service, the old model stays in use
+                with self._lock:
+                    self.reload_errors += 1
+                print("Reloading the ideal functions failed: {}".format(error))
+
+    def metrics(self):
+        """
+        Reports the load and the latency of the service.
+        :return: dictionary with counters, throughput, mean batch size and latency percentiles in milliseconds
+        """
+        with self._lock:
+            latencies = np.array(self._latencies)
+            uptime = time.perf_counter() - self.started
+            metrics = {"uptime_seconds": uptime, "requests": self.requests, "points": self.points,
+                       "batches": self.batches, "reloads": self.reloads, "reload_errors": self.reload_errors,
+                       "queued_requests": self._queue.qsize(),
+                       "points_per_second": self.points / uptime if uptime else 0.0,
+                       "mean_batch_requests": self.requests / self.batches if self.batches else 0.0,
+                       "ideal_functions": [ideal_function.name for ideal_function in self._ideal_functions]}
+        for percentile in [50, 90, 99]:
+            metrics["latency_p{}_ms".format(percentile)] = (float(np.percentile(latencies, percentile)) * 1000
+                                                            if len(latencies) else None)
+        return metrics
+
+    def __repr__(self):
+        return "ClassificationService with {} ideal functions, {} requests in {} batches".format(
+            len(self._ideal_functions), self.requests, self.batches)
+
+
+class ClassificationRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves POST /classify with a JSON body {"x": [...], "y": [...]} and GET /metrics.
+    The service is taken from the server, see serve.
+    """
+
+    def _send_json(self, status, body):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            self._send_json(200, self.server.service.metrics())
+        else:
+            self._send_json(404, {"error": "Unknown path {}".format(self.path)})
+
+    def do_POST(self):
+        if self.path != "/classify":
+            self._send_json(404, {"error": "Unknown path {}".format(self.path)})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            assigned, deltas, names = self.server.service.classify(body["x"], body["y"])
+        except (ValueError, KeyError, TypeError) as error:
+            self._send_json(400, {"error": str(error)})
+            return
+        # NaN is not valid JSON, points without classification get null
+        self._send_json(200, {"ideal_function": names.tolist(),
+                              "delta": [None if math.isnan(delta) else delta for delta in deltas.tolist()]})
+
+    def log_message(self, format, *args):
+        # Logging every request would dominate the latency
+        pass
+
+
+def serve(service, host="127.0.0.1", port=8765):
+    """
+    Creates the HTTP server of a service. Every connection is handled in its own thread.
+    :param service: a started ClassificationService
+    :param host: the address to listen on, the default only accepts local connections
+    :param port: the port to listen on, 0 picks a free one
+    :return: the ThreadingHTTPServer, call serve_forever to handle requests
+    """
+    server = ThreadingHTTPServer((host, port), ClassificationRequestHandler)
+    server.daemon_threads = True
+    server.service = service
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Classifies points on demand with the ideal functions of the "
+                                                 "training data")
+    parser.add_argument("--train", default="data/train.csv", help="path of the training CSV")
+    parser.add_argument("--ideal", default="data/ideal.csv", help="path of the CSV with the candidate functions")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", type=int, default=8765, help="port to listen on")
+    parser.add_argument("--batch-points", type=int, default=DEFAULT_BATCH_POINTS,
+                        help="close a micro-batch once it holds this many points")
+    parser.add_argument("--max-delay", type=float, default=DEFAULT_MAX_DELAY,
+                        help="close a micro-batch once its first request waited this many seconds")
+    parser.add_argument("--reload-interval", type=float, default=DEFAULT_RELOAD_INTERVAL,
+                        help="seconds between checks for changed CSVs, 0 disables the hot reload")
+    parser.add_argument("--parser", choices=["pandas", "numpy"], default="pandas",
+                        help="parse the CSVs with Pandas or with NumPy, which avoids importing Pandas")
+    arguments = parser.parse_args()
+
+    # The same factor as ACCEPTED_FACTOR in main.py
+    classification_service = ClassificationService(arguments.train, arguments.ideal, accepted_factor=math.sqrt(2),
+                                                   batch_points=arguments.batch_points,
+                                                   max_delay=arguments.max_delay,
+                                                   reload_interval=arguments.reload_interval or None,
+                                                   parser=arguments.parser)
+    classification_service.start()
+    http_server = serve(classification_service, arguments.host, arguments.port)
+    print("Serving {} on http://{}:{}".format(classification_service, *http_server.server_address[:2]))
+    try:
+        http_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        http_server.server_close()
+        classification_service.stop()
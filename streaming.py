@@ -0,0 +1,138 @@
+import csv
+import itertools
+import time
+
+import numpy as np
+
+from database import BulkWriter
+from instrumentation import instrumented
+from regression import classify_points
+from function import PARSERS
+from utils import (classification_names, create_mapping_table, drop_mapping_summaries, finalize_mapping,
+                   mapping_columns)
+
+# Number of test points read, classified and written at once
+DEFAULT_CHUNK_SIZE = 100000
+
+
+class StreamingClassifier:
+
+    def __init__(self, ideal_functions, chunk_size=DEFAULT_CHUNK_SIZE, interpolation=None, out_of_range=None,
+                 progress=None, parser="pandas"):
+        """
+        Classifies a test CSV chunk by chunk and appends the results to the mapping database as it goes.
+        Only one chunk is held in memory at a time, so the peak memory does not grow with the size of the input.
+        After a run, the counters describe how many points were processed and how fast.
+        :param ideal_functions: a list of IdealFunction objects, loaded once and reused for every chunk
+        :param chunk_size: the number of rows read from the CSV at once
+        :param interpolation: passed on to classify_points
+        :param out_of_range: passed on to classify_points
+        :param progress: optional callable that is called with the StreamingClassifier after every chunk
+        :param parser: "pandas" or "numpy", how the chunks are parsed, see function.read_csv_block
+        """
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be at least 1")
+        if parser not in PARSERS:
+            raise ValueError("Unknown parser {}, expected one of {}".format(parser, PARSERS))
+        self.ideal_functions = ideal_functions
+        self.chunk_size = chunk_size
+        self.interpolation = interpolation
+        self.out_of_range = out_of_range
+        self.progress = progress
+        self.parser = parser
+        self.writer = None
+        self._reset_counters()
+
+    def _reset_counters(self):
+        self.rows_processed = 0
+        self.rows_classified = 0
+        self.chunks_processed = 0
+        self.elapsed_seconds = 0.0
+
+    @property
+    def rows_per_second(self):
+        """
+        The throughput of the last run.
+        :return: number of processed rows per second
+        """
+        if self.elapsed_seconds == 0:
+            return 0.0
+        return self.rows_processed / self.elapsed_seconds
+
+    @instrumented("classify_csv", rows=lambda result, classifier, *args, **kwargs: classifier.rows_processed)
+    def classify_csv(self, path_of_csv, file_name="output/mapping", fast_load=False):
+        """
+        Streams the test CSV into the mapping table of a SQLite database. An existing mapping table is replaced.
+        The CSV must have the columns "x" and "y".
+        :param path_of_csv: local path of the test CSV
+        :param file_name: the name of the database, without the .db extension
+        :param fast_load: if True, durability PRAGMAs are relaxed while loading, see database.FAST_LOAD_PRAGMAS
+        :return: the StreamingClassifier itself, so the counters can be read directly
+        """
+        self._reset_counters()
+        started = time.perf_counter()
+
+        self.writer = BulkWriter(file_name, fast_load=fast_load)
+        create_mapping_table(self.writer.engine, replace=True)
+        drop_mapping_summaries(self.writer)
+
+        try:
+            for x_values, y_values in self._read_chunks(path_of_csv):
+                self._classify_chunk(x_values, y_values)
+                self.elapsed_seconds = time.perf_counter() - started
+                if self.progress is not None:
+                    self.progress(self)
+        except FileNotFoundError:
+            print("Issue while reading file {}".format(path_of_csv))
+            raise
+
+        # The indexes and summary tables are built once all chunks are in place, in a transaction of their own
+        with self.writer.transaction():
+            finalize_mapping(self.writer)
+        self.elapsed_seconds = time.perf_counter() - started
+        self.writer.close()
+        return self
+
+    def _classify_chunk(self, x_values, y_values):
+        assigned, deltas = classify_points(x_values, y_values, self.ideal_functions,
+                                           interpolation=self.interpolation, out_of_range=self.out_of_range)
+
+        # Points without classification get a dash and a distance of -1, as required by the assignment
+        unclassified = assigned < 0
+        deltas[unclassified] = -1
+        names = classification_names(self.ideal_functions, assigned)
+
+        # Each chunk is written in its own transaction, so a crash leaves all previous chunks in place
+        self.writer.append('mapping', mapping_columns(x_values, y_values, deltas, names))
+
+        self.rows_processed += len(x_values)
+        self.rows_classified += int((~unclassified).sum())
+        self.chunks_processed += 1
+
+    def _read_chunks(self, path_of_csv):
+        """
+        Reads the x- and y-values of the CSV chunk by chunk with the configured parser.
+        :param path_of_csv: local path of the CSV, with the columns "x" and "y"
+        :return: generator of tuples (x-values, y-values), each holding at most chunk_size rows
+        """
+        if self.parser == "numpy":
+            with open(path_of_csv, newline="") as file:
+                columns = next(csv.reader(file))
+                x_column, y_column = columns.index("x"), columns.index("y")
+                while True:
+                    # np.loadtxt parses the lines of one chunk at a time, the file is never read as a whole
+                    lines = list(itertools.islice(file, self.chunk_size))
+                    if not lines:
+                        return
+                    data = np.loadtxt(lines, delimiter=",", dtype=float, ndmin=2)
+                    yield data[:, x_column], data[:, y_column]
+
+        import pandas as pd
+
+        with pd.read_csv(path_of_csv, chunksize=self.chunk_size) as reader:
+            for chunk in reader:
+                yield chunk["x"].to_numpy(dtype=float), chunk["y"].to_numpy(dtype=float)
+
+    def __repr__(self):
+        return "Classified {} of {} rows in {} chunks ({:.0f} rows/s)".format(
+            self.rows_classified, self.rows_processed, self.chunks_processed, self.rows_per_second)
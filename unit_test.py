@@ -1,7 +1,34 @@
-from unittest import TestCase
+import json
+import math
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import urllib.request
+from unittest import TestCase, mock
+import numpy as np
 import pandas as pd
-from function import Function
-from lossfunction import squared_error
+from batch import run_batch
+from bootstrap import bootstrap_selection, bootstrap_weights, resampled_error_matrix
+from benchmark import compare, generate_dataset, measure_pipeline, measure_startup, run_benchmark
+from database import BulkWriter
+from function import Function, FunctionManager, IdealFunction, SQLFunctionManager, read_csv_block
+from incremental import IncrementalFitter
+from instrumentation import INSTRUMENTATION, Instrumentation
+from lossfunction import absolute_error, get_loss, huber_loss, max_absolute_error, squared_error
+from mappingdb import MappingDatabase
+from parallel import minimise_loss_parallel, search_candidates_parallel
+from pipeline import Pipeline, Stage, assignment_pipeline
+from plotting import plot_classification_overview
+from regression import (classify_points, compute_error_matrix, find_classification, minimise_loss,
+                        minimise_loss_batch)
+from search import PrunedSearch, minimise_loss_pruned
+from service import ClassificationService, serve
+from streaming import StreamingClassifier
+from utils import classification_names, create_mapping_table, drop_mapping_summaries, write_mapping_columns
+from whatif import DeviationMatrix
 
 class Test(TestCase):
     def setUp(self):
@@ -29,3 +56,864 @@ class Test(TestCase):
         self.assertEqual(squared_error(self.function2, self.function1), 12.0)
         # Test case 3: verifying if regression of two equal functions results in 0
         self.assertEqual(squared_error(self.function1, self.function1), 0.0)
+
+    def test_locate_y_based_on_x(self):
+        # Points on the grid are returned as they are, points in between are interpolated
+        self.assertEqual(self.function1.locate_y_based_on_x(2.0), 6.0)
+        self.assertEqual(self.function1.locate_y_based_on_x(2.5), 6.5)
+        self.assertEqual(self.function1.locate_y_values([1.2, 2.6], interpolation="nearest").tolist(), [5.0, 7.0])
+        with self.assertRaises(IndexError):
+            self.function1.locate_y_values([2.5], interpolation="exact")
+
+    def test_locate_y_out_of_range(self):
+        with self.assertRaises(IndexError):
+            self.function1.locate_y_based_on_x(4.0)
+        self.assertEqual(self.function1.locate_y_values([0.0, 4.0], out_of_range="clip").tolist(), [5.0, 7.0])
+        self.assertTrue(math.isnan(self.function1.locate_y_values([4.0], out_of_range="nan")[0]))
+
+    def test_policies_can_be_set_per_function(self):
+        self.function1.interpolation = "nearest"
+        self.function1.out_of_range = "clip"
+        self.assertEqual(self.function1.locate_y_values([1.2, 4.0]).tolist(), [5.0, 7.0])
+        self.assertEqual(self.function2.locate_y_values([2.5]).tolist(), [8.5])
+        ideal_function = IdealFunction(self.function1, self.function2, error=0.0)
+        self.assertEqual((ideal_function.interpolation, ideal_function.out_of_range), ("nearest", "clip"))
+
+    def test_batched_losses_match_pairwise_losses(self):
+        # The batched reducers of the registry have to produce the same value as the pairwise loss functions
+        for loss_function in [squared_error, absolute_error, max_absolute_error, huber_loss]:
+            deviations = (self.dataframe2["y"] - self.dataframe1["y"]).to_numpy()
+            self.assertAlmostEqual(get_loss(loss_function)(deviations), loss_function(self.function1, self.function2))
+            self.assertAlmostEqual(get_loss(loss_function.__name__)(deviations),
+                                   loss_function(self.function1, self.function2))
+
+
+class TestMinimiseLossBatch(TestCase):
+    def setUp(self):
+        self.candidate_function_manager = FunctionManager("data/ideal.csv")
+        self.training_function_manager = FunctionManager("data/train.csv")
+
+    def test_functions_are_views_into_the_shared_block(self):
+        function = self.candidate_function_manager.functions[3]
+        self.assertTrue(np.shares_memory(function.y, self.candidate_function_manager.y_values))
+        self.assertIs(function.x, self.candidate_function_manager.x_values)
+        self.assertEqual(function.y.tolist(), pd.read_csv("data/ideal.csv")["y4"].tolist())
+        # Changing the DataFrame built for plotting must not change the function
+        dataframe = function.dataframe
+        dataframe["y"] = 0.0
+        self.assertNotEqual(function.y[0], 0.0)
+        self.assertFalse(hasattr(function, "__dict__"))
+
+    def test_error_matrix_matches_pairwise_loss(self):
+        errors = compute_error_matrix(self.training_function_manager.y_values,
+                                      self.candidate_function_manager.y_values, squared_error)
+        self.assertEqual(errors.shape, (4, 50))
+        training_function = self.training_function_manager.functions[1]
+        candidate_function = self.candidate_function_manager.functions[7]
+        self.assertAlmostEqual(errors[1, 7], squared_error(training_function, candidate_function), places=6)
+
+    def test_batch_selects_same_ideal_functions_as_minimise_loss(self):
+        for loss_function in [squared_error, absolute_error, max_absolute_error, huber_loss]:
+            ideal_functions = minimise_loss_batch(self.training_function_manager, self.candidate_function_manager,
+                                                  loss_function)
+            for training_function, ideal_function in zip(self.training_function_manager, ideal_functions):
+                expected = minimise_loss(training_function, self.candidate_function_manager.functions, loss_function)
+                self.assertEqual(ideal_function.name, expected.name)
+                self.assertIs(ideal_function.training_function, training_function)
+                self.assertAlmostEqual(ideal_function.error, expected.error, places=6)
+
+
+    def test_parallel_search_is_identical_to_serial(self):
+        for loss_function in [squared_error, huber_loss]:
+            expected = minimise_loss_batch(self.training_function_manager, self.candidate_function_manager,
+                                           loss_function)
+            ideal_functions = minimise_loss_parallel(self.training_function_manager, self.candidate_function_manager,
+                                                     loss_function, workers=2, shard_size=7)
+            self.assertEqual([(ideal_function.name, ideal_function.error) for ideal_function in ideal_functions],
+                             [(ideal_function.name, ideal_function.error) for ideal_function in expected])
+
+        columns, errors = search_candidates_parallel(self.training_function_manager.y_values,
+                                                     self.candidate_function_manager.y_values, squared_error,
+                                                     workers=2, shard_size=9, top_k=3)
+        error_matrix = compute_error_matrix(self.training_function_manager.y_values,
+                                            self.candidate_function_manager.y_values, squared_error)
+        np.testing.assert_array_equal(columns, np.argsort(error_matrix, axis=1, kind="stable")[:, :3])
+        np.testing.assert_array_equal(errors, np.sort(error_matrix, axis=1)[:, :3])
+
+    def test_pruned_search_returns_exhaustive_winners(self):
+        training_block = self.training_function_manager.y_values
+        candidate_block = self.candidate_function_manager.y_values
+        for loss_function in [squared_error, absolute_error, max_absolute_error, huber_loss]:
+            search = PrunedSearch(candidate_block, loss_function, block_rows=50, batch_size=8)
+            columns, errors = search.search(training_block, top_k=2)
+            error_matrix = compute_error_matrix(training_block, candidate_block, loss_function)
+            expected = np.argsort(error_matrix, axis=1, kind="stable")[:, :2]
+            np.testing.assert_array_equal(columns, expected)
+            np.testing.assert_array_equal(errors, np.take_along_axis(error_matrix, expected, axis=1))
+            self.assertEqual(search.candidates_considered, 4 * 50)
+            self.assertEqual(search.pruned + search.fully_evaluated, 4 * 50)
+            self.assertGreater(search.pruned, 0)
+
+        ideal_functions = minimise_loss_pruned(self.training_function_manager, self.candidate_function_manager,
+                                               squared_error)
+        self.assertEqual([ideal_function.name for ideal_function in ideal_functions], ["y1", "y6", "y28", "y12"])
+
+class TestClassifyPoints(TestCase):
+    def setUp(self):
+        candidate_function_manager = FunctionManager("data/ideal.csv")
+        training_function_manager = FunctionManager("data/train.csv")
+        self.ideal_functions = minimise_loss_batch(training_function_manager, candidate_function_manager,
+                                                   squared_error)
+        for ideal_function in self.ideal_functions:
+            ideal_function.tolerance_factor = math.sqrt(2)
+        self.test_function = FunctionManager("data/test.csv").functions[0]
+
+    def test_batch_matches_find_classification(self):
+        test_x = self.test_function.dataframe["x"].to_numpy()
+        test_y = self.test_function.dataframe["y"].to_numpy()
+        assigned, deltas = classify_points(test_x, test_y, self.ideal_functions)
+        for point, position, delta_y in zip(self.test_function, assigned, deltas):
+            classification, distance = find_classification(point, self.ideal_functions)
+            if classification is None:
+                self.assertEqual(position, -1)
+                self.assertTrue(math.isnan(delta_y))
+            else:
+                self.assertIs(self.ideal_functions[position], classification)
+                self.assertEqual(delta_y, distance)
+
+    def test_x_outside_of_range_raises_index_error(self):
+        with self.assertRaises(IndexError):
+            classify_points([25.0], [1.0], self.ideal_functions)
+        assigned, deltas = classify_points([25.0], [1.0], self.ideal_functions, out_of_range="nan")
+        self.assertEqual(assigned[0], -1)
+
+    def test_off_grid_points_are_classified(self):
+        # Moving the x of a point a tiny bit off the grid should not change its classification
+        point = next(iter(self.test_function))
+        expected, _ = find_classification(point, self.ideal_functions)
+        assigned, _ = classify_points([point["x"] + 1e-6], [point["y"]], self.ideal_functions)
+        self.assertIs(self.ideal_functions[assigned[0]], expected)
+
+    def test_tolerance_is_cached_until_factor_changes(self):
+        ideal_function = self.ideal_functions[0]
+        tolerance = ideal_function.tolerance
+        self.assertIs(ideal_function.tolerance, tolerance)
+        ideal_function.tolerance_factor = 1
+        self.assertEqual(ideal_function.tolerance, ideal_function.largest_deviation)
+
+    def test_tolerance_follows_replaced_training_data(self):
+        training_function = Function("y1")
+        training_function.dataframe = pd.DataFrame({"x": [1.0, 2.0], "y": [1.0, 2.0]})
+        candidate_function = Function("y2")
+        candidate_function.dataframe = pd.DataFrame({"x": [1.0, 2.0], "y": [1.5, 2.0]})
+        ideal_function = IdealFunction(candidate_function, training_function, error=0.25)
+        self.assertEqual(ideal_function.tolerance, 0.5)
+        training_function.dataframe = pd.DataFrame({"x": [1.0, 2.0], "y": [101.5, 2.0]})
+        self.assertEqual(ideal_function.largest_deviation, 100.0)
+        self.assertEqual(ideal_function.tolerance, 100.0)
+
+    def test_streaming_matches_batch_classification(self):
+        test_x = self.test_function.dataframe["x"].to_numpy()
+        test_y = self.test_function.dataframe["y"].to_numpy()
+        assigned, deltas = classify_points(test_x, test_y, self.ideal_functions)
+
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = os.path.join(directory, "mapping")
+            progress = []
+            classifier = StreamingClassifier(self.ideal_functions, chunk_size=30,
+                                             progress=lambda streaming: progress.append(streaming.rows_processed))
+            classifier.classify_csv("data/test.csv", file_name=file_name)
+            connection = sqlite3.connect(file_name + ".db")
+            rows = connection.execute("SELECT * FROM mapping").fetchall()
+            connection.close()
+
+        self.assertEqual(progress, [30, 60, 90, 100])
+        self.assertEqual(classifier.chunks_processed, 4)
+        self.assertEqual(classifier.rows_classified, int((assigned >= 0).sum()))
+        self.assertEqual(len(rows), len(test_x))
+        for row, position, delta_y in zip(rows, assigned, deltas):
+            if position < 0:
+                self.assertEqual(row[2:], (-1.0, "-"))
+            else:
+                self.assertEqual(row[2:], (delta_y, self.ideal_functions[position].name.replace("y", "N")))
+
+    def test_streaming_parsers_agree(self):
+        rows = {}
+        with tempfile.TemporaryDirectory() as directory:
+            for parser in ("pandas", "numpy"):
+                file_name = os.path.join(directory, parser)
+                classifier = StreamingClassifier(self.ideal_functions, chunk_size=30, parser=parser)
+                classifier.classify_csv("data/test.csv", file_name=file_name)
+                self.assertEqual(classifier.chunks_processed, 4)
+                connection = sqlite3.connect(file_name + ".db")
+                rows[parser] = connection.execute("SELECT * FROM mapping").fetchall()
+                connection.close()
+        self.assertEqual(len(rows["numpy"]), 100)
+        self.assertEqual(rows["numpy"], rows["pandas"])
+        with self.assertRaises(ValueError):
+            StreamingClassifier(self.ideal_functions, parser="polars")
+
+
+class TestCsvCache(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path_of_csv = os.path.join(self.directory.name, "candidates.csv")
+        data = np.random.default_rng(0).normal(size=(400, 1001))
+        data[:, 0] = np.arange(400) / 10
+        self.dataframe = pd.DataFrame(data, columns=["x"] + ["y{}".format(column) for column in range(1, 1001)])
+        self.dataframe.to_csv(self.path_of_csv, index=False)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_warm_load_uses_cache_and_is_identical(self):
+        cold = FunctionManager(self.path_of_csv, use_cache=True)
+        # The warm load must come from the memory-mapped sidecar, without parsing the CSV again
+        with mock.patch("function.read_csv_block") as read_csv:
+            warm = FunctionManager(self.path_of_csv, use_cache=True)
+        read_csv.assert_not_called()
+        self.assertFalse(warm.y_values.flags.writeable)
+        np.testing.assert_array_equal(warm.y_values, cold.y_values)
+        np.testing.assert_array_equal(warm.x_values, cold.x_values)
+        self.assertEqual([function.name for function in warm], [function.name for function in cold])
+
+    def test_cache_is_invalidated_when_csv_changes(self):
+        FunctionManager(self.path_of_csv, use_cache=True)
+        self.dataframe["y1"] = 1.0
+        self.dataframe.to_csv(self.path_of_csv, index=False)
+        function_manager = FunctionManager(self.path_of_csv, use_cache=True)
+        self.assertTrue((function_manager.functions[0].y == 1.0).all())
+
+    def test_cache_is_not_shared_between_parsers(self):
+        FunctionManager(self.path_of_csv, use_cache=True, parser="pandas")
+        with mock.patch("function.read_csv_block", wraps=read_csv_block) as read_csv:
+            function_manager = FunctionManager(self.path_of_csv, use_cache=True, parser="numpy")
+        read_csv.assert_called_once_with(self.path_of_csv, parser="numpy")
+        np.testing.assert_array_equal(function_manager.y_values, read_csv_block(self.path_of_csv, "numpy")[1][:, 1:])
+
+
+class TestBulkWriter(TestCase):
+    def test_write_table_in_chunks_with_index(self):
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = os.path.join(directory, "bulk")
+            writer = BulkWriter(file_name, chunk_size=7)
+            columns = {"X (test func)": np.arange(100) / 10, "Name": np.array(["N1", "-"] * 50, dtype=object)}
+            writer.write_table("table", columns, index_columns=["X (test func)"])
+            writer.close()
+
+            connection = sqlite3.connect(file_name + ".db")
+            rows = connection.execute('SELECT * FROM "table"').fetchall()
+            indexes = connection.execute("SELECT name FROM sqlite_master WHERE type = 'index'").fetchall()
+            connection.close()
+
+        self.assertEqual(writer.rows_written, 100)
+        self.assertGreater(writer.rows_per_second, 0)
+        self.assertEqual(rows[:2], [(0.0, "N1"), (0.1, "-")])
+        self.assertEqual(len(rows), 100)
+        self.assertEqual(indexes, [("ix_table_X (test func)",)])
+
+    def test_write_mapping_replaces_earlier_results(self):
+        # Writing the results twice must not duplicate the rows
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = os.path.join(directory, "mapping")
+            for _ in range(2):
+                write_mapping_columns(np.array([1.0]), np.array([2.0]), np.array([-1.0]),
+                                      np.array(["-"], dtype=object), file_name=file_name)
+            connection = sqlite3.connect(file_name + ".db")
+            rows = connection.execute("SELECT * FROM mapping").fetchall()
+            connection.close()
+        self.assertEqual(rows, [(1.0, 2.0, -1.0, "-")])
+
+    def test_transaction_is_rolled_back_on_failure(self):
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = os.path.join(directory, "bulk")
+            writer = BulkWriter(file_name)
+            writer.write_table("table", {"x": np.arange(3.0)})
+            with self.assertRaises(RuntimeError):
+                with writer.transaction():
+                    writer.append("table", {"x": np.arange(5.0)})
+                    raise RuntimeError("load failed")
+            writer.close()
+            connection = sqlite3.connect(file_name + ".db")
+            rows = connection.execute('SELECT COUNT(*) FROM "table"').fetchone()[0]
+            connection.close()
+        self.assertEqual(rows, 3)
+
+    def test_schema_changes_are_rolled_back_on_failure(self):
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = os.path.join(directory, "mapping")
+            write_mapping_columns(np.arange(3.0), np.arange(3.0), np.full(3, -1.0), np.array(["-"] * 3, dtype=object),
+                                  file_name=file_name)
+            writer = BulkWriter(file_name)
+            with self.assertRaises(RuntimeError):
+                with writer.transaction() as connection:
+                    # The table and the summaries are dropped first, before any row is written
+                    drop_mapping_summaries(writer)
+                    create_mapping_table(connection, replace=True)
+                    raise RuntimeError("load failed")
+            writer.close()
+            mapping_database = MappingDatabase(file_name)
+            self.assertEqual(mapping_database.match_counts(), {"-": 3})
+            mapping_database.close()
+
+    def test_durability_is_only_relaxed_on_request(self):
+        with tempfile.TemporaryDirectory() as directory:
+            journal_modes = []
+            for fast_load in (False, True):
+                writer = BulkWriter(os.path.join(directory, str(fast_load)), fast_load=fast_load)
+                with writer.engine.connect() as connection:
+                    journal_modes.append(connection.exec_driver_sql("PRAGMA journal_mode").scalar())
+                writer.close()
+        self.assertEqual(journal_modes, ["delete", "memory"])
+
+
+class TestIncrementalFitter(TestCase):
+    def setUp(self):
+        self.candidate_function_manager = FunctionManager("data/ideal.csv")
+        self.training_function_manager = FunctionManager("data/train.csv")
+        self.names = [function.name for function in self.training_function_manager]
+
+    def test_appending_in_batches_matches_full_fit(self):
+        fitter = IncrementalFitter(self.candidate_function_manager, self.names, squared_error)
+        x_values = self.training_function_manager.x_values
+        y_values = self.training_function_manager.y_values
+        for start in range(0, len(x_values), 150):
+            fitter.append(x_values[start:start + 150], y_values[start:start + 150])
+
+        expected = minimise_loss_batch(self.training_function_manager, self.candidate_function_manager, squared_error)
+        ideal_functions = fitter.ideal_functions(tolerance_factor=math.sqrt(2))
+        for ideal_function, expected_function in zip(ideal_functions, expected):
+            expected_function.tolerance_factor = math.sqrt(2)
+            self.assertEqual(ideal_function.name, expected_function.name)
+            self.assertAlmostEqual(ideal_function.error, expected_function.error, places=9)
+            self.assertEqual(ideal_function.largest_deviation, expected_function.largest_deviation)
+            self.assertEqual(ideal_function.tolerance, expected_function.tolerance)
+
+    def test_state_survives_save_and_load(self):
+        fitter = IncrementalFitter(self.candidate_function_manager, self.names, squared_error)
+        fitter.append(self.training_function_manager.x_values[:200], self.training_function_manager.y_values[:200])
+        with tempfile.TemporaryDirectory() as directory:
+            # The path is used as given, also without the .npz suffix
+            path = os.path.join(directory, "state")
+            fitter.save(path)
+            restored = IncrementalFitter.load(path, self.candidate_function_manager)
+            self.assertEqual(os.listdir(directory), ["state"])
+
+        for current in [fitter, restored]:
+            current.append(self.training_function_manager.x_values[200:],
+                           self.training_function_manager.y_values[200:])
+        np.testing.assert_array_equal(restored.errors, fitter.errors)
+        self.assertEqual(restored.number_of_rows, 400)
+        self.assertEqual([ideal_function.name for ideal_function in restored.ideal_functions()],
+                         ["y1", "y6", "y28", "y12"])
+
+
+class TestPlotting(TestCase):
+    def setUp(self):
+        candidate_function_manager = FunctionManager("data/ideal.csv")
+        training_function_manager = FunctionManager("data/train.csv")
+        self.ideal_functions = minimise_loss_batch(training_function_manager, candidate_function_manager,
+                                                   squared_error)
+        rng = np.random.default_rng(0)
+        self.x_values = rng.uniform(-20, 19.9, size=200000)
+        self.y_values = rng.normal(size=200000)
+        self.assigned, _ = classify_points(self.x_values, self.y_values, self.ideal_functions)
+
+    def test_overview_size_is_bounded(self):
+        with tempfile.TemporaryDirectory() as directory:
+            sizes = []
+            for number_of_points in [10000, 200000]:
+                file_name = os.path.join(directory, "overview{}".format(number_of_points))
+                plot_classification_overview(self.ideal_functions, self.x_values[:number_of_points],
+                                             self.y_values[:number_of_points], self.assigned[:number_of_points],
+                                             file_name, max_points=10000, show_plot=False)
+                sizes.append(os.path.getsize(file_name + ".html"))
+            file_name = os.path.join(directory, "density")
+            plot_classification_overview(self.ideal_functions, self.x_values, self.y_values, self.assigned, file_name,
+                                         max_points=10000, aggregate=True, show_plot=False)
+            sizes.append(os.path.getsize(file_name + ".html"))
+
+        self.assertLess(abs(sizes[1] - sizes[0]), sizes[0] * 0.05)
+        self.assertLess(sizes[2], sizes[0])
+
+    def test_overview_has_no_side_effects(self):
+        ideal_functions = list(reversed(self.ideal_functions))
+        y_before = [ideal_function.y.copy() for ideal_function in ideal_functions]
+        with tempfile.TemporaryDirectory() as directory:
+            plot_classification_overview(ideal_functions, self.x_values[:100], self.y_values[:100],
+                                         self.assigned[:100], os.path.join(directory, "overview"), show_plot=False)
+        self.assertEqual([ideal_function.name for ideal_function in ideal_functions], ["y12", "y28", "y6", "y1"])
+        for ideal_function, y in zip(ideal_functions, y_before):
+            np.testing.assert_array_equal(ideal_function.y, y)
+
+
+class TestBenchmark(TestCase):
+    def test_synthetic_dataset_runs_every_stage(self):
+        with tempfile.TemporaryDirectory() as directory:
+            paths = generate_dataset(directory, rows=200, candidates=20, training_columns=3, test_points=50)
+            self.assertEqual(list(pd.read_csv(paths["ideal"]).columns), ["x"] + ["y{}".format(i) for i in range(1, 21)])
+            stages = run_benchmark(paths, directory, memory=True)
+
+        self.assertIn("minimise_loss_batch", stages)
+        self.assertIn("plot_classification_overview", stages)
+        self.assertIn("load_ideal_cache_cold", stages)
+        self.assertIn("load_ideal_cache_warm", stages)
+        for measurement in stages.values():
+            self.assertGreaterEqual(measurement["seconds"], 0)
+            self.assertIn("peak_bytes", measurement)
+
+    def test_pipeline_is_measured_serial_and_concurrent(self):
+        with tempfile.TemporaryDirectory() as directory:
+            paths = generate_dataset(directory, rows=200, candidates=20, training_columns=3, test_points=50)
+            stages = measure_pipeline(paths, directory, workers=2)
+        self.assertEqual(stages["pipeline_workers"]["workers"], 2)
+        self.assertGreater(stages["pipeline_serial"]["seconds"], 0)
+        self.assertGreater(stages["pipeline_workers"]["seconds"], 0)
+
+    def test_compare_flags_regressions(self):
+        parameters = {"rows": 400}
+        baseline = {"runs": [{"parameters": parameters, "stages": {"fit": {"seconds": 1.0}, "load": {"seconds": 1.0}}}]}
+        results = {"runs": [{"parameters": parameters, "stages": {"fit": {"seconds": 1.5}, "load": {"seconds": 1.1}}}]}
+        regressions = compare(results, baseline, threshold=0.2)
+        self.assertEqual([regression["stage"] for regression in regressions], ["fit"])
+
+    def test_numpy_parser_matches_round_trip_parsing(self):
+        columns, data = read_csv_block("data/ideal.csv", parser="numpy")
+        expected = pd.read_csv("data/ideal.csv", float_precision="round_trip")
+        self.assertEqual(columns, list(expected.columns))
+        np.testing.assert_array_equal(data, expected.to_numpy(dtype=float))
+        self.assertEqual(FunctionManager("data/train.csv", parser="numpy").functions[0].name, "y1")
+
+    def test_core_path_imports_no_heavy_dependencies(self):
+        paths = {name: "data/{}.csv".format(name) for name in ["train", "ideal", "test"]}
+        startup = measure_startup(paths, modes=["fit_classify", "main", "eager"], repeat=1)
+        self.assertEqual(startup["fit_classify"]["heavy_modules"], [])
+        self.assertEqual(startup["main"]["heavy_modules"], [])
+        self.assertEqual(startup["eager"]["heavy_modules"], ["pandas", "sqlalchemy", "bokeh"])
+
+
+class TestInstrumentation(TestCase):
+    def tearDown(self):
+        INSTRUMENTATION.disable()
+        INSTRUMENTATION.reset()
+
+    def test_hot_paths_are_recorded(self):
+        INSTRUMENTATION.reset()
+        INSTRUMENTATION.enable(trace_memory=True)
+        candidate_function_manager = FunctionManager("data/ideal.csv")
+        training_function_manager = FunctionManager("data/train.csv")
+        ideal_functions = minimise_loss_batch(training_function_manager, candidate_function_manager, squared_error)
+        classify_points(np.array([0.0, 1.0, 2.0]), np.zeros(3), ideal_functions)
+        INSTRUMENTATION.disable()
+
+        stages = INSTRUMENTATION.report()["stages"]
+        self.assertEqual(stages["load_csv"]["calls"], 2)
+        self.assertEqual(stages["load_csv"]["rows"], 800)
+        self.assertEqual(stages["minimise_loss_batch"]["rows"], 400)
+        self.assertEqual(stages["largest_deviation"]["calls"], 4)
+        self.assertEqual(stages["classify_points"]["rows"], 3)
+        self.assertGreater(stages["load_csv"]["peak_bytes"], 0)
+
+    def test_nothing_is_recorded_while_disabled(self):
+        INSTRUMENTATION.reset()
+        FunctionManager("data/train.csv")
+        self.assertEqual(INSTRUMENTATION.report()["stages"], {})
+
+    def test_nested_stage_peaks(self):
+        instrumentation = Instrumentation()
+        instrumentation.enable(trace_memory=True)
+        with instrumentation.stage("outer", rows=10):
+            with instrumentation.stage("inner") as frame:
+                block = np.ones(2 ** 20)
+                frame.rows = 5
+            del block
+        instrumentation.disable()
+
+        stages = instrumentation.report()["stages"]
+        self.assertEqual(stages["outer"]["rows"], 10)
+        self.assertEqual(stages["inner"]["rows"], 5)
+        self.assertGreaterEqual(stages["inner"]["peak_bytes"], 8 * 2 ** 20)
+        self.assertGreaterEqual(stages["outer"]["peak_bytes"], stages["inner"]["peak_bytes"])
+
+
+class TestPipeline(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for name in ["train", "ideal", "test"]:
+            shutil.copy("data/{}.csv".format(name), os.path.join(self.directory, "{}.csv".format(name)))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def build(self):
+        return assignment_pipeline(*(os.path.join(self.directory, "{}.csv".format(name))
+                                     for name in ["train", "ideal", "test"]),
+                                   accepted_factor=math.sqrt(2), output_directory=self.directory, show_plot=False)
+
+    def mapping(self):
+        with sqlite3.connect(os.path.join(self.directory, "mapping.db")) as connection:
+            return connection.execute("SELECT * FROM mapping").fetchall()
+
+    def test_unchanged_inputs_skip_every_stage(self):
+        first = self.build()
+        first.run()
+        self.assertEqual(set(first.status.values()), {"ran"})
+        rows = self.mapping()
+        self.assertEqual(sum(row[3] != "-" for row in rows), 48)
+
+        second = self.build()
+        second.run()
+        self.assertEqual(second.status, {"export": "skipped", "plot_ideal": "skipped", "persist": "skipped",
+                                         "plot_points": "skipped", "deviations": "skipped"})
+        self.assertEqual(self.mapping(), rows)
+
+    def test_changed_test_data_skips_export_and_fit(self):
+        self.build().run()
+        with open(os.path.join(self.directory, "test.csv"), "a") as file:
+            file.write("0.0,0.0\n")
+
+        pipeline = self.build()
+        pipeline.run()
+        self.assertEqual(pipeline.status["export"], "skipped")
+        self.assertEqual(pipeline.status["fit"], "cached")
+        self.assertEqual(pipeline.status["classify"], "ran")
+        self.assertEqual([ideal_function.name for ideal_function in pipeline.results["ideal_functions"]],
+                         ["y1", "y6", "y28", "y12"])
+        self.assertEqual(len(self.mapping()), 101)
+
+    def test_outputs_changed_outside_the_pipeline_are_written_again(self):
+        self.build().run()
+        rows = self.mapping()
+        with sqlite3.connect(os.path.join(self.directory, "mapping.db")) as connection:
+            connection.execute("DELETE FROM mapping WHERE rowid % 2 = 0")
+
+        pipeline = self.build()
+        pipeline.run()
+        self.assertEqual(pipeline.status["persist"], "ran")
+        self.assertEqual(pipeline.status["export"], "skipped")
+        self.assertEqual(self.mapping(), rows)
+
+    def test_concurrent_schedule_matches_serial(self):
+        serial = self.build()
+        serial.run()
+        rows = self.mapping()
+
+        concurrent = assignment_pipeline(*(os.path.join(self.directory, "{}.csv".format(name))
+                                           for name in ["train", "ideal", "test"]),
+                                         accepted_factor=math.sqrt(2), output_directory=self.directory,
+                                         show_plot=False, force=True)
+        plan = concurrent.plan()
+        for name in plan:
+            for dependency in concurrent.stages[name].dependencies:
+                self.assertLess(plan.index(dependency), plan.index(name))
+        concurrent.run(workers=4)
+        self.assertEqual(set(concurrent.status.values()), {"ran"})
+        self.assertEqual(self.mapping(), rows)
+        self.assertGreater(concurrent.wall_seconds, 0)
+
+
+class TestClassificationService(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for name in ["train", "ideal"]:
+            shutil.copy("data/{}.csv".format(name), os.path.join(self.directory, "{}.csv".format(name)))
+        self.service = ClassificationService(os.path.join(self.directory, "train.csv"),
+                                             os.path.join(self.directory, "ideal.csv"), accepted_factor=math.sqrt(2),
+                                             max_delay=0.05, reload_interval=0.05)
+        self.service.start()
+        self.test_data = pd.read_csv("data/test.csv")
+
+    def tearDown(self):
+        self.service.stop()
+        shutil.rmtree(self.directory)
+
+    def test_concurrent_requests_are_batched(self):
+        expected, expected_deltas = classify_points(self.test_data["x"], self.test_data["y"],
+                                                    self.service.ideal_functions)
+        results = [None] * 10
+        chunks = np.array_split(np.arange(len(self.test_data)), 10)
+
+        def request(position):
+            rows = chunks[position]
+            results[position] = self.service.classify(self.test_data["x"].to_numpy()[rows],
+                                                      self.test_data["y"].to_numpy()[rows])
+
+        threads = [threading.Thread(target=request, args=(position,)) for position in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        np.testing.assert_array_equal(np.concatenate([result[0] for result in results]), expected)
+        np.testing.assert_array_equal(np.concatenate([result[1] for result in results]), expected_deltas)
+        metrics = self.service.metrics()
+        self.assertEqual(metrics["requests"], 10)
+        self.assertEqual(metrics["points"], 100)
+        self.assertLess(metrics["batches"], 10)
+
+    def test_http_endpoint(self):
+        server = serve(self.service, port=0)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            url = "http://127.0.0.1:{}".format(server.server_address[1])
+            body = json.dumps({"x": [-20.0, 25.0], "y": [-0.9129453, 0.0]}).encode()
+            with urllib.request.urlopen(urllib.request.Request(url + "/classify", data=body)) as response:
+                result = json.loads(response.read())
+            with urllib.request.urlopen(url + "/metrics") as response:
+                metrics = json.loads(response.read())
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(result["ideal_function"], ["y1", None])
+        self.assertEqual(result["delta"][1], None)
+        self.assertEqual(metrics["requests"], 1)
+
+    def test_hot_reload_after_training_data_changes(self):
+        train_path = os.path.join(self.directory, "train.csv")
+        train = pd.read_csv(train_path)
+        train["y1"] = pd.read_csv("data/ideal.csv")["y2"]
+        train.to_csv(train_path, index=False)
+
+        deadline = time.time() + 10
+        while self.service.metrics()["reloads"] == 0 and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual([ideal_function.name for ideal_function in self.service.ideal_functions],
+                         ["y2", "y6", "y28", "y12"])
+
+
+class TestDeviationMatrix(TestCase):
+    def setUp(self):
+        candidate_function_manager = FunctionManager("data/ideal.csv")
+        training_function_manager = FunctionManager("data/train.csv")
+        self.ideal_functions = minimise_loss_batch(training_function_manager, candidate_function_manager,
+                                                   squared_error)
+        test_function = FunctionManager("data/test.csv").functions[0]
+        self.x_values, self.y_values = test_function.x, test_function.y
+        self.matrix = DeviationMatrix.from_ideal_functions(self.x_values, self.y_values, self.ideal_functions)
+
+    def test_classify_matches_classify_points(self):
+        for factor in [0.5, 1, math.sqrt(2), 3]:
+            for ideal_function in self.ideal_functions:
+                ideal_function.tolerance_factor = factor
+            expected = classify_points(self.x_values, self.y_values, self.ideal_functions)
+            actual = self.matrix.classify(factor)
+            np.testing.assert_array_equal(actual[0], expected[0])
+            np.testing.assert_array_equal(actual[1], expected[1])
+        self.assertEqual(self.matrix.summary(math.sqrt(2))["unmatched"], 52)
+
+    def test_sweep_matches_classify(self):
+        rng = np.random.default_rng(0)
+        # Ties and out-of-range points are part of the test
+        deviations = rng.integers(0, 5, size=(4, 500)).astype(float)
+        deviations[0, :20] = np.nan
+        matrix = DeviationMatrix(np.zeros(500), np.zeros(500), deviations, [2.0, 1.0, 3.0, 0.0],
+                                 ["y1", "y2", "y3", "y4"])
+        factors = np.concatenate([rng.uniform(0, 5, size=50), [0, 1, 2, 1.5]])
+
+        summary = matrix.sweep(factors)
+        for position, factor in enumerate(factors):
+            assigned, _ = matrix.classify(factor)
+            counts = np.bincount(assigned + 1, minlength=5)
+            self.assertEqual(summary.loc[position, "tolerance_factor"], factor)
+            self.assertEqual(summary.loc[position, ["y1", "y2", "y3", "y4"]].tolist(), counts[1:].tolist())
+            self.assertEqual(summary.loc[position, "unmatched"], counts[0])
+
+    def test_pipeline_mapping_is_not_overwritten(self):
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = os.path.join(directory, "mapping")
+            Pipeline([Stage("persist", lambda: self.matrix.write_mapping(1.0, file_name, overwrite_pipeline_output=True),
+                            outputs=[file_name + ".db"])], os.path.join(directory, ".pipeline")).run()
+            with self.assertRaises(ValueError):
+                self.matrix.write_mapping(2.0, file_name)
+            self.matrix.write_mapping(2.0, os.path.join(directory, "whatif_mapping"))
+            self.matrix.write_mapping(2.0, file_name, overwrite_pipeline_output=True)
+
+    def test_save_load_and_mapping(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "deviations")
+            self.matrix.save(path)
+            restored = DeviationMatrix.load(path)
+            restored.write_mapping(math.sqrt(2), os.path.join(directory, "mapping"))
+            with sqlite3.connect(os.path.join(directory, "mapping.db")) as connection:
+                rows = connection.execute("SELECT * FROM mapping").fetchall()
+        self.assertEqual(restored.names, ["y1", "y6", "y28", "y12"])
+        self.assertEqual(len(rows), 100)
+        self.assertEqual(sum(row[3] != "-" for row in rows), 48)
+
+
+class TestSQLFunctionManager(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.directory, "ideal")
+        self.csv_function_manager = FunctionManager("data/ideal.csv")
+        self.csv_function_manager.to_sql(file_name=self.file_name, suffix=" (ideal func)")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_same_data_as_csv(self):
+        function_manager = SQLFunctionManager(self.file_name, batch_size=7)
+        self.assertFalse(function_manager.is_loaded)
+        self.assertEqual(function_manager.names, ["y{}".format(i) for i in range(1, 51)])
+        np.testing.assert_array_equal(function_manager.x_values, self.csv_function_manager.x_values)
+        np.testing.assert_array_equal(function_manager.y_values, self.csv_function_manager.y_values)
+        self.assertTrue(function_manager.is_loaded)
+        self.assertTrue(function_manager.y_values.flags.f_contiguous)
+
+    def test_projection_and_x_range(self):
+        function_manager = SQLFunctionManager(self.file_name, names=["y28", "y6"], x_range=(-1, 1))
+        self.assertEqual([function.name for function in function_manager], ["y28", "y6"])
+        rows = (self.csv_function_manager.x_values >= -1) & (self.csv_function_manager.x_values <= 1)
+        np.testing.assert_array_equal(function_manager.x_values, self.csv_function_manager.x_values[rows])
+        np.testing.assert_array_equal(function_manager.functions[1].y,
+                                      self.csv_function_manager.functions[5].y[rows])
+        self.assertEqual(function_manager.select(["y1"]).y_values.shape, (rows.sum(), 1))
+        with self.assertRaises(KeyError):
+            SQLFunctionManager(self.file_name, names=["y51"])
+
+    def test_pipeline_reads_selected_functions_from_database(self):
+        for name in ["train", "ideal", "test"]:
+            shutil.copy("data/{}.csv".format(name), os.path.join(self.directory, "{}.csv".format(name)))
+        pipeline = assignment_pipeline(*(os.path.join(self.directory, "{}.csv".format(name))
+                                         for name in ["train", "ideal", "test"]),
+                                       accepted_factor=math.sqrt(2), output_directory=self.directory,
+                                       show_plot=False, from_database=True)
+        pipeline.run()
+        ideal_functions = pipeline.results["ideal_functions"]
+        self.assertEqual([ideal_function.name for ideal_function in ideal_functions], ["y1", "y6", "y28", "y12"])
+        self.assertEqual(int((pipeline.results["classify"]["assigned"] >= 0).sum()), 48)
+
+
+class TestBatch(TestCase):
+    def test_jobs_share_the_library_and_fail_independently(self):
+        with tempfile.TemporaryDirectory() as directory:
+            jobs = [{"train": "data/train.csv", "test": "data/test.csv",
+                     "output": os.path.join(directory, "job{}".format(position), "")} for position in range(3)]
+            jobs.insert(1, {"train": os.path.join(directory, "missing.csv"), "test": "data/test.csv",
+                            "output": os.path.join(directory, "broken", "")})
+            results, summary = run_batch("data/ideal.csv", jobs, workers=2)
+
+            with sqlite3.connect(os.path.join(directory, "job2", "mapping.db")) as connection:
+                rows = connection.execute("SELECT * FROM mapping").fetchall()
+            with open(os.path.join(directory, "job0", "report.json")) as file:
+                report = json.load(file)
+
+        self.assertEqual([result["status"] for result in results], ["ok", "failed", "ok", "ok"])
+        self.assertIn("FileNotFoundError", results[1]["error"])
+        self.assertEqual((summary["jobs"], summary["succeeded"], summary["failed"]), (4, 3, 1))
+        self.assertEqual(summary["points"], 300)
+        self.assertEqual(sum(row[3] != "-" for row in rows), 48)
+        self.assertEqual([item["ideal"] for item in report["ideal_functions"]], ["y1", "y6", "y28", "y12"])
+        self.assertEqual(report["unmatched"], 52)
+
+
+class TestBootstrap(TestCase):
+    def setUp(self):
+        self.candidate_function_manager = FunctionManager("data/ideal.csv")
+        self.training_function_manager = FunctionManager("data/train.csv")
+
+    def test_weights_match_resampled_rows(self):
+        training_block = self.training_function_manager.y_values
+        candidate_block = self.candidate_function_manager.y_values
+        weights = bootstrap_weights(len(training_block), resamples=5, seed=1)
+        errors = resampled_error_matrix(training_block, candidate_block, weights, "huber_loss")
+        for resample, counts in enumerate(weights.astype(int)):
+            rows = np.repeat(np.arange(len(training_block)), counts)
+            expected = compute_error_matrix(training_block[rows], candidate_block[rows], "huber_loss")
+            np.testing.assert_allclose(errors[resample], expected, rtol=1e-12)
+
+    def test_selection_and_win_frequencies(self):
+        stability = bootstrap_selection(self.training_function_manager, self.candidate_function_manager,
+                                        resamples=200, top=2)
+        ideal_functions = minimise_loss_batch(self.training_function_manager, self.candidate_function_manager,
+                                              squared_error)
+        self.assertEqual([item["selected"] for item in stability.to_dict()["training_functions"]],
+                         [ideal_function.name for ideal_function in ideal_functions])
+        for item in stability.training_functions:
+            self.assertEqual(item["candidates"][0]["name"], item["selected"])
+            self.assertLessEqual(sum(candidate["win_frequency"] for candidate in item["candidates"]), 1)
+        with self.assertRaises(ValueError):
+            bootstrap_selection(self.training_function_manager, self.candidate_function_manager,
+                                "max_absolute_error")
+        with self.assertRaises(ValueError):
+            bootstrap_selection(self.training_function_manager, self.candidate_function_manager, top=0)
+
+    def test_close_candidates_split_the_wins(self):
+        x_values = np.arange(50.0)
+        rng = np.random.default_rng(0)
+        # Both candidates are equally noisy copies of the training function
+        candidates = np.column_stack([x_values] + [np.sin(x_values) + rng.normal(scale=0.01, size=50)
+                                                   for _ in range(2)])
+        training = np.column_stack([x_values, np.sin(x_values)])
+        stability = bootstrap_selection(FunctionManager.from_data(["x", "y1"], training),
+                                        FunctionManager.from_data(["x", "y1", "y2"], candidates), resamples=300)
+        frequencies = [candidate["win_frequency"] for candidate in stability.training_functions[0]["candidates"]]
+        self.assertAlmostEqual(sum(frequencies), 1)
+        self.assertTrue(all(0 < frequency < 1 for frequency in frequencies))
+
+
+class TestMappingDatabase(TestCase):
+    def setUp(self):
+        ideal_functions = minimise_loss_batch(FunctionManager("data/train.csv"), FunctionManager("data/ideal.csv"),
+                                              squared_error)
+        for ideal_function in ideal_functions:
+            ideal_function.tolerance_factor = math.sqrt(2)
+        self.ideal_functions = ideal_functions
+        test_function = FunctionManager("data/test.csv").functions[0]
+        self.x, self.y = test_function.x, test_function.y
+        assigned, deltas = classify_points(self.x, self.y, ideal_functions)
+        self.deltas = np.where(assigned < 0, -1, deltas)
+        self.names = classification_names(ideal_functions, assigned)
+        self.directory = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.directory, "mapping")
+        write_mapping_columns(self.x, self.y, self.deltas, self.names, file_name=self.file_name)
+        self.mapping_database = MappingDatabase(self.file_name)
+
+    def tearDown(self):
+        self.mapping_database.close()
+        shutil.rmtree(self.directory)
+
+    def test_summaries_match_the_rows(self):
+        names, counts = np.unique(self.names.astype(str), return_counts=True)
+        self.assertEqual(self.mapping_database.match_counts(), dict(zip(names.tolist(), counts.tolist())))
+        self.assertEqual(self.mapping_database.number_of_points, 100)
+
+        statistics = self.mapping_database.delta_statistics()
+        self.assertNotIn("-", statistics)
+        for name, item in statistics.items():
+            deltas = self.deltas[self.names == name]
+            self.assertEqual(item["points"], len(deltas))
+            self.assertEqual((item["min"], item["max"]), (deltas.min(), deltas.max()))
+            self.assertAlmostEqual(item["mean"], deltas.mean())
+            self.assertAlmostEqual(item["std"], deltas.std(), places=6)
+            histogram = self.mapping_database.delta_histogram(name)
+            self.assertEqual(sum(count for _, _, count in histogram), len(deltas))
+            self.assertAlmostEqual(histogram[0][0], deltas.min())
+            self.assertAlmostEqual(histogram[-1][1], deltas.max())
+        self.assertEqual(self.mapping_database.delta_histogram("N99"), [])
+
+    def test_queries_use_the_indexes(self):
+        worst = self.mapping_database.worst_deviations(3)
+        self.assertEqual([row[2] for row in worst], sorted(self.deltas, reverse=True)[:3])
+        worst_of_n1 = self.mapping_database.worst_deviations(100, "N1")
+        self.assertEqual(len(worst_of_n1), int((self.names == "N1").sum()))
+        in_range = self.mapping_database.points_in_range(-5, 5)
+        self.assertEqual(len(in_range), int(((self.x >= -5) & (self.x <= 5)).sum()))
+        self.assertEqual([row[0] for row in in_range], sorted(row[0] for row in in_range))
+
+        connection = sqlite3.connect(self.file_name + ".db")
+        plan = connection.execute("EXPLAIN QUERY PLAN SELECT * FROM mapping_points WHERE ideal_function = 'N1' "
+                                  "ORDER BY delta_y DESC LIMIT 3").fetchall()
+        connection.close()
+        self.assertIn("USING INDEX", plan[0][3])
+
+    def test_streaming_finalizes_the_database(self):
+        file_name = os.path.join(self.directory, "streamed")
+        StreamingClassifier(self.ideal_functions, chunk_size=30).classify_csv("data/test.csv", file_name=file_name)
+        streamed = MappingDatabase(file_name)
+        try:
+            self.assertEqual(streamed.match_counts(), self.mapping_database.match_counts())
+            self.assertEqual(streamed.delta_statistics(), self.mapping_database.delta_statistics())
+        finally:
+            streamed.close()
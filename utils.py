@@ -1,16 +1,37 @@
-from sqlalchemy import Column, Float, MetaData, String, Table, create_engine
+import time
 
+import numpy as np
 
-def write_deviation_results_to_sqlite(result):
+from database import BulkWriter, quote_identifier
+from instrumentation import instrumented
+
+# The column names of the mapping table as required by the assignment
+MAPPING_COLUMNS = ('X (test func)', 'Y (test func)', 'Delta Y (test func)', 'No. of ideal func')
+
+# The snake_case names of the mapping columns, used by the view MAPPING_VIEW and the summary tables
+MAPPING_VIEW_COLUMNS = ('x', 'y', 'delta_y', 'ideal_function')
+MAPPING_VIEW = 'mapping_points'
+
+# Both indexes start with the assigned function: one serves the counts and the worst deviations, the other ranges
+# of X. Queries over all functions seek every function, there are only a handful of them
+MAPPING_INDEXES = (('No. of ideal func', 'Delta Y (test func)'), ('No. of ideal func', 'X (test func)'))
+
+# The tables finalize_mapping derives from the mapping table
+MAPPING_SUMMARY_TABLES = ('mapping_counts', 'mapping_delta_statistics', 'mapping_histogram')
+
+# Number of equal-width bins of the delta histogram of every ideal function
+HISTOGRAM_BINS = 20
+
+
+def create_mapping_table(engine, replace=False):
     """
-    Writes results of a classification computation to an SQLite database.
-    It adheres to the requirements specified in the assignment.
-    :param result: a list containing a dictionary describing the result of a classification test
+    Describes the mapping table required by the assignment and creates it if it does not exist yet.
+    :param engine: the SQLAlchemy engine of the database, or a connection to create the table in its transaction
+    :param replace: if True, an existing mapping table is dropped first
+    :return: the SQLAlchemy Table object
     """
-    # In this function, we employ a native SQLAlchemy approach
-    # Instead of using SQL syntax, MetaData is used to describe the table and its columns
-    # SQLAlchemy utilizes this data structure to create the table
-    engine = create_engine('sqlite:///{}.db'.format("output/mapping"), echo=False)
+    from sqlalchemy import Column, Float, MetaData, String, Table
+
     metadata = MetaData()
 
     mapping = Table('mapping', metadata,
@@ -20,38 +41,141 @@ def write_deviation_results_to_sqlite(result):
                     Column('No. of ideal func', String(50))
                     )
 
+    if replace:
+        mapping.drop(engine, checkfirst=True)
     metadata.create_all(engine)
+    return mapping
+
+
+def drop_mapping_summaries(writer):
+    """
+    Drops the view and the summary tables of the mapping table, so no outdated summaries are left while the mapping
+    table is loaded again.
+    :param writer: the BulkWriter of the database
+    """
+    with writer.begin() as connection:
+        connection.exec_driver_sql("DROP VIEW IF EXISTS {}".format(MAPPING_VIEW))
+        for table_name in MAPPING_SUMMARY_TABLES:
+            connection.exec_driver_sql("DROP TABLE IF EXISTS {}".format(table_name))
+
+
+def finalize_mapping(writer, histogram_bins=HISTOGRAM_BINS):
+    """
+    Builds the indexes of the mapping table, the snake_case view MAPPING_VIEW and the summary tables:
+    mapping_counts with the points per ideal function ("-" for points without classification),
+    mapping_delta_statistics with the minimum, maximum, mean and mean square of the deltas per ideal function and
+    mapping_histogram with the non-empty bins of histogram_bins equal-width bins between both extremes.
+    Within writer.transaction(), they are committed together with the rows.
+    :param writer: the BulkWriter that loaded the mapping table
+    :param histogram_bins: the number of bins per ideal function
+    """
+    writer.create_indexes('mapping', MAPPING_INDEXES)
+    drop_mapping_summaries(writer)
+    started = time.perf_counter()
+    delta, name = (quote_identifier(column) for column in MAPPING_COLUMNS[2:])
+    statements = [
+        "CREATE VIEW {} AS SELECT {} FROM mapping".format(MAPPING_VIEW, ", ".join(
+            "{} AS {}".format(quote_identifier(column), view_column)
+            for column, view_column in zip(MAPPING_COLUMNS, MAPPING_VIEW_COLUMNS))),
+        "CREATE TABLE mapping_counts AS SELECT {0} AS ideal_function, COUNT(*) AS points "
+        "FROM mapping GROUP BY {0}".format(name),
+        # Points without classification have no delta, they are left out of the statistics and the histogram
+        "CREATE TABLE mapping_delta_statistics AS SELECT {0} AS ideal_function, COUNT(*) AS points, "
+        "MIN({1}) AS min_delta, MAX({1}) AS max_delta, AVG({1}) AS mean_delta, AVG({1} * {1}) AS mean_square_delta "
+        "FROM mapping WHERE {0} != '-' GROUP BY {0}".format(name, delta),
+        # The largest delta falls into the last bin, a function with a single distinct delta has only one bin
+        "CREATE TABLE mapping_histogram AS SELECT ideal_function, bin, min_delta + bin * width AS lower_delta, "
+        "min_delta + (bin + 1) * width AS upper_delta, COUNT(*) AS points FROM ("
+        "SELECT statistics.ideal_function, statistics.min_delta, "
+        "(statistics.max_delta - statistics.min_delta) / {2} AS width, "
+        "CASE WHEN statistics.max_delta > statistics.min_delta "
+        "THEN MIN(CAST(({1} - statistics.min_delta) * {2} / (statistics.max_delta - statistics.min_delta) "
+        "AS INTEGER), {2} - 1) ELSE 0 END AS bin "
+        "FROM mapping JOIN mapping_delta_statistics AS statistics ON {0} = statistics.ideal_function) "
+        "GROUP BY ideal_function, bin".format(name, delta, int(histogram_bins)),
+    ]
+    with writer.begin() as connection:
+        for statement in statements:
+            connection.exec_driver_sql(statement)
+    writer.seconds_writing += time.perf_counter() - started
 
-    # Rather than inserting values line by line (which is slow),
-    # SQLAlchemy's .execute is utilized with a dictionary containing all the values
-    # The creation of this dictionary involves a straightforward mapping between my internal data structures and
-    # the structure required for the assignment
 
-    execute_map = []
-    for item in result:
+def classification_names(ideal_functions, assigned):
+    """
+    Translates the positions returned by classify_points into the names required by the assignment.
+    :param ideal_functions: the list of IdealFunction objects the points were classified with
+    :param assigned: array with the position of the assigned ideal function (-1 if none)
+    :return: array with the names, "-" for points without classification
+    """
+    # The dash is appended as last entry, so the position -1 of unclassified points picks it
+    names = np.array([ideal_function.name.replace("y", "N") for ideal_function in ideal_functions] + ["-"],
+                     dtype=object)
+    return names[assigned]
+
+
+def mapping_columns(x_values, y_values, deltas, names):
+    """
+    Bundles the arrays of a classification into the columns of the mapping table.
+    The arrays must already use the conventions of the assignment ("-" and -1 for points without classification).
+    :param x_values: array with the x-coordinates
+    :param y_values: array with the y-coordinates
+    :param deltas: array with the deviation to the assigned ideal function
+    :param names: array with the name of the assigned ideal function
+    :return: dictionary mapping the column names to the arrays
+    """
+    return dict(zip(MAPPING_COLUMNS, (x_values, y_values, deltas, names)))
+
+
+@instrumented("write_mapping", rows=lambda writer, x_values, *args, **kwargs: len(x_values))
+def write_mapping_columns(x_values, y_values, deltas, names, file_name="output/mapping", fast_load=False):
+    """
+    Writes the arrays of a classification to the mapping table of an SQLite database, replacing earlier results.
+    :param x_values: array with the x-coordinates
+    :param y_values: array with the y-coordinates
+    :param deltas: array with the deviation to the assigned ideal function (-1 if none)
+    :param names: array with the name of the assigned ideal function ("-" if none)
+    :param file_name: the name of the database, without the .db extension
+    :param fast_load: if True, durability PRAGMAs are relaxed while loading, see database.FAST_LOAD_PRAGMAS
+    :return: the BulkWriter, which reports the number of rows and the rows per second
+    """
+    # The table itself is described with SQLAlchemy's MetaData, the rows are loaded by the BulkWriter.
+    # Readers see either the earlier results or the new rows together with their indexes and summaries
+    writer = BulkWriter(file_name, fast_load=fast_load)
+    with writer.transaction() as connection:
+        create_mapping_table(connection, replace=True)
+        writer.append('mapping', mapping_columns(x_values, y_values, deltas, names))
+        finalize_mapping(writer)
+    writer.close()
+    return writer
+
+
+@instrumented("write_deviation_results", rows=lambda writer, result: len(result))
+def write_deviation_results_to_sqlite(result):
+    """
+    Writes results of a classification computation to an SQLite database.
+    It adheres to the requirements specified in the assignment.
+    :param result: a list containing a dictionary describing the result of a classification test
+    :return: the BulkWriter, which reports the number of rows and the rows per second
+    """
+    # The creation of the columns involves a straightforward mapping between my internal data structures and
+    # the structure required for the assignment
+    x_values = np.empty(len(result))
+    y_values = np.empty(len(result))
+    deltas = np.empty(len(result))
+    names = np.empty(len(result), dtype=object)
+    for row, item in enumerate(result):
         point = item["point"]
         classification = item["classification"]
-        delta_y = item["delta_y"]
+        x_values[row] = point["x"]
+        y_values[row] = point["y"]
 
         # We need to check if there is a classification for a point at all, and if so, rename the function name accordingly
-        classification_name = None
         if classification is not None:
-            classification_name = classification.name.replace("y", "N")
+            names[row] = classification.name.replace("y", "N")
+            deltas[row] = item["delta_y"]
         else:
             # If there is no classification, there is also no distance. In that case, a dash is written
-            classification_name = "-"
-            delta_y = -1
-
-        execute_map.append(
-            {"X (test func)": point["x"], "Y (test func)": point["y"], "Delta Y (test func)": delta_y,
-             "No. of ideal func": classification_name})
-
-    # using the Table object, the dictionary is used to insert the data
-    i = mapping.insert().values(execute_map)
-    with engine.connect() as connection:
-        connection.execute(i.compile(connection))
-        connection.commit()
-
-    #i.execute(execute_map)
-    
-    
\ No newline at end of file
+            names[row] = "-"
+            deltas[row] = -1
+
+    return write_mapping_columns(x_values, y_values, deltas, names)
@@ -0,0 +1,189 @@
+import argparse
+
+import numpy as np
+
+from regression import assign_points, compute_deviations
+from utils import write_mapping_columns
+
+
+class DeviationMatrix:
+
+    def __init__(self, x_values, y_values, deviations, largest_deviations, names):
+        """
+        Stores the distance of every test point to every ideal function together with their largest deviations.
+        Classifying under another tolerance factor then only thresholds the stored matrix,
+        nothing is interpolated or fitted again.
+        :param x_values: array with the x-coordinates of the points
+        :param y_values: array with the y-coordinates of the points
+        :param deviations: array of shape (number of ideal functions, number of points), see compute_deviations
+        :param largest_deviations: array with the largest deviation of every ideal function from its training function
+        :param names: the names of the ideal functions
+        """
+        self.x_values = np.asarray(x_values, dtype=float)
+        self.y_values = np.asarray(y_values, dtype=float)
+        self.deviations = np.asarray(deviations, dtype=float)
+        self.largest_deviations = np.asarray(largest_deviations, dtype=float)
+        self.names = list(names)
+
+    @classmethod
+    def from_ideal_functions(cls, x_values, y_values, ideal_functions, interpolation=None, out_of_range=None):
+        """
+        Computes the matrix for a set of test points.
+        :param x_values: array with the x-coordinates of the points
+        :param y_values: array with the y-coordinates of the points
+        :param ideal_functions: a list of IdealFunction objects
+        :param interpolation: "linear", "nearest" or "exact", defaults to the interpolation of each ideal function
+        :param out_of_range: "raise", "nan" or "clip", defaults to the out_of_range policy of each ideal function
+        :return: a DeviationMatrix
+        """
+        deviations = compute_deviations(x_values, y_values, ideal_functions, interpolation=interpolation,
+                                        out_of_range=out_of_range)
+        largest_deviations = [ideal_function.largest_deviation for ideal_function in ideal_functions]
+        return cls(x_values, y_values, deviations, largest_deviations,
+                   [ideal_function.name for ideal_function in ideal_functions])
+
+    def classify(self, tolerance_factor):
+        """
+        Classifies the points under a tolerance factor. It gives the same result as classify_points with ideal
+        functions using this tolerance_factor.
+        :param tolerance_factor: the factor of the largest deviation that is accepted
+        :return: a tuple of two arrays: the position of the assigned ideal function (-1 if none)
+                 and the distance to it (NaN if none)
+        """
+        # The tolerance is computed exactly like IdealFunction.tolerance, so the thresholds are bitwise identical
+        return assign_points(self.deviations, tolerance_factor * self.largest_deviations)
+
+    def sweep(self, tolerance_factors):
+        """
+        Counts the matches of every ideal function for many tolerance factors at once.
+        A growing factor only adds ideal functions a point is within, so every point is assigned to one function
+        over an interval of factors. These intervals are found once per point with a binary search, which makes a
+        sweep over hundreds of factors barely more expensive than a single classification.
+        :param tolerance_factors: sequence of tolerance factors, in any order
+        :return: DataFrame with one row per factor: the factor, the matches of every ideal function and the
+                 number of unmatched points
+        """
+        tolerance_factors = np.asarray(tolerance_factors, dtype=float)
+        factor_order = np.argsort(tolerance_factors, kind="stable")
+        sorted_factors = tolerance_factors[factor_order]
+        number_of_factors = len(sorted_factors)
+        number_of_functions, number_of_points = self.deviations.shape
+
+        # Position of the first factor whose tolerance exceeds the deviation, len(factors) if there is none.
+        # The tolerances are computed as in classify, so the comparison is the same as there
+        eligible_from = np.empty(self.deviations.shape, dtype=int)
+        for row in range(number_of_functions):
+            eligible_from[row] = np.searchsorted(sorted_factors * self.largest_deviations[row], self.deviations[row],
+                                                 side="right")
+
+        # Going from the closest to the farthest function of a point, each one is assigned from the factor it becomes
+        # eligible until a closer one becomes eligible. The stable sort resolves ties like argmin in classify
+        closeness = np.argsort(self.deviations, axis=0, kind="stable")
+        starts = np.take_along_axis(eligible_from, closeness, axis=0)
+        ends = np.minimum.accumulate(np.vstack([np.full(number_of_points, number_of_factors), starts[:-1]]), axis=0)
+        assigned = starts < ends
+
+        # Every interval adds one match to the factors it covers, which a cumulative sum over the boundaries gives
+        boundaries = np.zeros((number_of_functions, number_of_factors + 1), dtype=int)
+        np.add.at(boundaries, (closeness[assigned], starts[assigned]), 1)
+        np.add.at(boundaries, (closeness[assigned], ends[assigned]), -1)
+        matches = np.empty((number_of_functions, number_of_factors), dtype=int)
+        matches[:, factor_order] = np.cumsum(boundaries, axis=1)[:, :number_of_factors]
+
+        import pandas as pd
+
+        summary = pd.DataFrame({"tolerance_factor": tolerance_factors})
+        for row, name in enumerate(self.names):
+            summary[name] = matches[row]
+        summary["unmatched"] = number_of_points - matches.sum(axis=0)
+        return summary
+
+    def summary(self, tolerance_factor):
+        """
+        Counts the matches of every ideal function under one tolerance factor.
+        :param tolerance_factor: the factor of the largest deviation that is accepted
+        :return: dictionary with the factor, the matches per ideal function and the number of unmatched points
+        """
+        assigned, _ = self.classify(tolerance_factor)
+        counts = np.bincount(assigned + 1, minlength=len(self.names) + 1)
+        return {"tolerance_factor": tolerance_factor, "matches": dict(zip(self.names, counts[1:].tolist())),
+                "unmatched": int(counts[0])}
+
+    def write_mapping(self, tolerance_factor, file_name="output/whatif_mapping", overwrite_pipeline_output=False):
+        """
+        Writes the mapping table of the assignment for one tolerance factor.
+        By default, a database written by the pipeline, e.g. output/mapping.db, is not replaced: the pipeline would
+        consider it up to date although it holds the results of another tolerance factor.
+        :param tolerance_factor: the factor of the largest deviation that is accepted
+        :param file_name: the name of the database, without the .db extension
+        :param overwrite_pipeline_output: if True, a database written by the pipeline is replaced anyway
+        :return: the BulkWriter, which reports the number of rows and the rows per second
+        """
+        # The pipeline imports this module, so it is only imported once it is needed
+        from pipeline import is_pipeline_output
+
+        if not overwrite_pipeline_output and is_pipeline_output(file_name + ".db"):
+            raise ValueError("{}.db is written by the pipeline, choose another file or allow overwriting it".format(
+                file_name))
+        assigned, deltas = self.classify(tolerance_factor)
+        # The same naming convention as classification_names: N instead of y, a dash for no classification
+        names = np.array([name.replace("y", "N") for name in self.names] + ["-"], dtype=object)[assigned]
+        return write_mapping_columns(self.x_values, self.y_values, np.where(assigned < 0, -1, deltas), names,
+                                     file_name=file_name)
+
+    def save(self, path):
+        """
+        Stores the matrix in a NumPy .npz file.
+        :param path: local path of the file, used as given, so it can be passed to load unchanged
+        """
+        # Through a file object, np.savez does not append ".npz" to a path without that suffix
+        with open(path, "wb") as file:
+            np.savez(file, x_values=self.x_values, y_values=self.y_values, deviations=self.deviations,
+                     largest_deviations=self.largest_deviations, names=np.array(self.names))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Restores a matrix stored with save.
+        :param path: local path of the file
+        :return: a DeviationMatrix
+        """
+        with np.load(path) as archive:
+            return cls(archive["x_values"], archive["y_values"], archive["deviations"],
+                       archive["largest_deviations"], archive["names"].tolist())
+
+    def __repr__(self):
+        return "DeviationMatrix of {} points and ideal functions {}".format(len(self.x_values), self.names)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Answers what-if questions about the tolerance factor from the "
+                                                 "deviation matrix stored by main.py")
+    parser.add_argument("--matrix", default="output/deviations.npz", help="path of the stored deviation matrix")
+    parser.add_argument("--sweep", type=float, nargs=3, metavar=("START", "STOP", "STEP"), default=None,
+                        help="print the matches for every factor from START to STOP in steps of STEP")
+    parser.add_argument("--factor", type=float, action="append", default=[],
+                        help="print the matches for this factor, can be repeated")
+    parser.add_argument("--mapping", type=float, default=None, metavar="FACTOR",
+                        help="write the mapping table for this factor")
+    parser.add_argument("--output", default="output/whatif_mapping",
+                        help="database written by --mapping, without .db")
+    parser.add_argument("--overwrite-pipeline-output", action="store_true",
+                        help="allow --output to replace a database written by main.py, e.g. output/mapping")
+    arguments = parser.parse_args()
+
+    deviation_matrix = DeviationMatrix.load(arguments.matrix)
+    print(deviation_matrix)
+    factors = list(arguments.factor)
+    if arguments.sweep:
+        start, stop, step = arguments.sweep
+        factors.extend(np.arange(start, stop + step / 2, step).tolist())
+    if factors:
+        print(deviation_matrix.sweep(factors).to_string(index=False))
+    if arguments.mapping is not None:
+        try:
+            writer = deviation_matrix.write_mapping(arguments.mapping, arguments.output,
+                                                    overwrite_pipeline_output=arguments.overwrite_pipeline_output)
+        except ValueError as error:
+            parser.error("{}, see --overwrite-pipeline-output".format(error))
+        print("{}.db:".format(arguments.output), writer)